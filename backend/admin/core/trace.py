@@ -0,0 +1,204 @@
+'''
+Инструментирование запросов к базе: число, время и нормализованный SQL
+каждого запроса в рамках одного вызова handler'а.
+
+Соединения пула создаются с классом TracedConnection, его курсоры замеряют
+execute/executemany. Декоратор traced собирает замеры за вызов и добавляет
+в ответ заголовок Server-Timing. Запросы медленнее DB_SLOW_QUERY_MS пишутся
+в лог, с DB_SLOW_QUERY_EXPLAIN=1 - вместе с планом EXPLAIN.
+'''
+import functools
+import json
+import os
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+TRACE_ENABLED = os.environ.get('DB_TRACE', '1') == '1'
+SLOW_QUERY_MS = float(os.environ.get('DB_SLOW_QUERY_MS', '200'))
+SLOW_QUERY_EXPLAIN = os.environ.get('DB_SLOW_QUERY_EXPLAIN', '0') == '1'
+SQL_MAX_CHARS = 500
+
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r'\b\d+(?:\.\d+)?\b')
+_SPACE_RE = re.compile(r'\s+')
+_ROWS_RE = re.compile(r'\((?:\?|NULL|DEFAULT)(?:, ?(?:\?|NULL|DEFAULT))*\)(?:, ?\((?:\?|NULL|DEFAULT)(?:, ?(?:\?|NULL|DEFAULT))*\))+', re.I)
+_IN_LIST_RE = re.compile(r'\(\?(?:, ?\?)+\)')
+_EXPLAINABLE_RE = re.compile(r'^\s*(SELECT|WITH|INSERT|UPDATE|DELETE)\b', re.I)
+
+_local = threading.local()
+_cursor_classes: Dict[Any, Any] = {}
+_connection_class: Optional[Any] = None
+
+def normalize(sql: Any) -> str:
+    '''
+    Приводит SQL к виду для группировки: литералы и числа заменяются на ?,
+    списки значений и многострочные VALUES сворачиваются, пробелы схлопываются.
+    '''
+    if isinstance(sql, bytes):
+        sql = sql.decode('utf-8', 'replace')
+    elif not isinstance(sql, str):
+        sql = str(sql)
+    sql = _STRING_RE.sub('?', sql)
+    sql = _NUMBER_RE.sub('?', sql)
+    sql = _SPACE_RE.sub(' ', sql).strip()
+    sql = _ROWS_RE.sub('(...), ...', sql)
+    sql = _IN_LIST_RE.sub('(...)', sql)
+    return sql[:SQL_MAX_CHARS]
+
+class RequestTrace:
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.perf_counter()
+        self.total_ms = 0.0
+        self.queries: List[Tuple[str, float]] = []
+
+    @property
+    def db_ms(self) -> float:
+        return sum(ms for _, ms in self.queries)
+
+    def finish(self) -> None:
+        self.total_ms = (time.perf_counter() - self.started) * 1000
+
+    def statements(self) -> List[Dict[str, Any]]:
+        '''
+        Запросы вызова, сгруппированные по нормализованному SQL, самые
+        дорогие по суммарному времени - первыми.
+        '''
+        grouped: Dict[str, List[float]] = {}
+        for sql, ms in self.queries:
+            grouped.setdefault(sql, []).append(ms)
+        rows = [{'sql': sql, 'count': len(times), 'ms': round(sum(times), 3)} for sql, times in grouped.items()]
+        rows.sort(key=lambda row: row['ms'], reverse=True)
+        return rows
+
+    def server_timing(self) -> str:
+        app_ms = max(self.total_ms - self.db_ms, 0.0)
+        return f'db;desc="{len(self.queries)} queries";dur={self.db_ms:.1f}, app;dur={app_ms:.1f}'
+
+def current() -> Optional[RequestTrace]:
+    return getattr(_local, 'trace', None)
+
+def last_request() -> Optional[RequestTrace]:
+    '''
+    Замеры последнего завершённого в этом потоке вызова - для бенчмарков.
+    '''
+    return getattr(_local, 'last', None)
+
+def explain(cursor: Any) -> Optional[Any]:
+    '''
+    План выполненного запроса без ANALYZE, в отдельной точке сохранения,
+    чтобы ошибка EXPLAIN не ломала транзакцию вызывающего кода.
+    '''
+    import psycopg2
+    import psycopg2.extensions
+
+    conn = cursor.connection
+    if cursor.name or conn.autocommit or not cursor.query:
+        return None
+    statement = cursor.query.decode('utf-8', 'replace')
+    if not _EXPLAINABLE_RE.match(statement):
+        return None
+
+    raw = psycopg2.extensions.cursor(conn)
+    try:
+        raw.execute('SAVEPOINT trace_explain')
+        try:
+            raw.execute('EXPLAIN (FORMAT JSON) ' + statement)
+            plan = raw.fetchone()[0]
+        except psycopg2.Error:
+            raw.execute('ROLLBACK TO SAVEPOINT trace_explain')
+            return None
+        raw.execute('RELEASE SAVEPOINT trace_explain')
+        return plan
+    except psycopg2.Error:
+        return None
+    finally:
+        raw.close()
+
+def _log_slow(cursor: Any, sql: str, ms: float, failed: bool) -> None:
+    # logging грузится только при первом медленном запросе
+    import logging
+
+    trace = current()
+    entry = {'ms': round(ms, 1), 'sql': sql, 'function': trace.name if trace else None}
+    if SLOW_QUERY_EXPLAIN and not failed:
+        entry['plan'] = explain(cursor)
+    logging.getLogger('core.trace').warning('slow query %s', json.dumps(entry, ensure_ascii=False, default=str))
+
+def _record(cursor: Any, query: Any, started: float, failed: bool) -> None:
+    ms = (time.perf_counter() - started) * 1000
+    sql = normalize(cursor.query or query)
+    trace = current()
+    if trace is not None:
+        trace.queries.append((sql, ms))
+    if ms >= SLOW_QUERY_MS:
+        _log_slow(cursor, sql, ms, failed)
+
+class TracedCursorMixin:
+    def execute(self, query: Any, vars: Any = None) -> Any:
+        started = time.perf_counter()
+        try:
+            result = super().execute(query, vars)
+        except Exception:
+            _record(self, query, started, True)
+            raise
+        _record(self, query, started, False)
+        return result
+
+    def executemany(self, query: Any, vars_list: Any) -> Any:
+        started = time.perf_counter()
+        try:
+            result = super().executemany(query, vars_list)
+        except Exception:
+            _record(self, query, started, True)
+            raise
+        _record(self, query, started, False)
+        return result
+
+def cursor_class(base: Any) -> Any:
+    if base not in _cursor_classes:
+        _cursor_classes[base] = type(f'Traced{base.__name__}', (TracedCursorMixin, base), {})
+    return _cursor_classes[base]
+
+def connection_class() -> Any:
+    '''
+    Подкласс соединения psycopg2, все курсоры которого (включая
+    RealDictCursor и именованные) замеряются. Создаётся при первом
+    подключении, чтобы не импортировать psycopg2 заранее.
+    '''
+    global _connection_class
+    if _connection_class is None:
+        import psycopg2.extensions
+
+        class TracedConnection(psycopg2.extensions.connection):
+            def cursor(self, *args: Any, **kwargs: Any) -> Any:
+                base = kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor
+                kwargs['cursor_factory'] = cursor_class(base)
+                return super().cursor(*args, **kwargs)
+
+        _connection_class = TracedConnection
+    return _connection_class
+
+def traced(handler: Callable[[Dict[str, Any], Any], Dict[str, Any]]) -> Callable[[Dict[str, Any], Any], Dict[str, Any]]:
+    @functools.wraps(handler)
+    def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+        if not TRACE_ENABLED:
+            return handler(event, context)
+        trace = RequestTrace(getattr(context, 'function_name', None) or handler.__module__)
+        previous = current()
+        _local.trace = trace
+        try:
+            result = handler(event, context)
+        finally:
+            _local.trace = previous
+            trace.finish()
+            _local.last = trace
+        if not isinstance(result, dict):
+            return result
+        return {
+            **result,
+            'headers': {**(result.get('headers') or {}), 'Server-Timing': trace.server_timing(), 'Timing-Allow-Origin': '*'}
+        }
+    return wrapper
@@ -1,10 +1,30 @@
+import csv
+import io
 import json
 import os
-from typing import Dict, Any
-import psycopg2
+import time
+from typing import Dict, Any, List
+
+from core import catalog, db, http, snapshots, trace
+from core.storage import get_storage
 
 ADMIN_PASSWORD = "2501"
+ADMIN_STICKY_KEY = 'admin'
+
+BULK_MAX_ROWS = 20000
+BULK_PAGE_SIZE = 1000
+EXPORT_ITERSIZE = 2000
+EXPORT_COLUMNS = ['id', 'title', 'description', 'file_url', 'category', 'downloads_count', 'created_at']
+EXPORT_CONTENT_TYPES = {'csv': 'text/csv; charset=utf-8', 'ndjson': 'application/x-ndjson'}
+SOUND_LIMITS = {'title': 255, 'file_url': 500, 'category': 100}
+# Партиции messages: те же месяцы вперёд и тот же advisory lock, что в social
+MESSAGES_PARTITIONS_AHEAD = 3
+MESSAGES_RETENTION_MONTHS = int(os.environ.get('MESSAGES_RETENTION_MONTHS', '24'))
+MESSAGES_MAINTENANCE_LOCK = 5003
+MESSAGES_MAINTENANCE_LOCK_TIMEOUT = '1s'
 
+@http.compressible
+@trace.traced
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Админ-панель для управления звуками WB PVZ
@@ -32,12 +52,22 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         return {
             'statusCode': 401,
             'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-            'body': json.dumps({'error': 'Unauthorized'})
+            'body': http.dumps({'error': 'Unauthorized'})
         }
     
     if method == 'GET':
+        params = event.get('queryStringParameters') or {}
+        if params.get('export') in EXPORT_CONTENT_TYPES:
+            return export_sounds(params['export'])
         return get_all_sounds()
     elif method == 'POST':
+        body_data = json.loads(event.get('body') or '{}')
+        if isinstance(body_data, dict) and body_data.get('action') == 'bulk_upsert':
+            return bulk_upsert_sounds(body_data.get('sounds'))
+        if isinstance(body_data, dict) and body_data.get('action') == 'publish_snapshots':
+            return publish_snapshots(body_data.get('catalogs'))
+        if isinstance(body_data, dict) and body_data.get('action') == 'maintain_messages':
+            return maintain_messages()
         return add_sound(event)
     elif method == 'PUT':
         return update_sound(event)
@@ -47,15 +77,25 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         return {
             'statusCode': 405,
             'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-            'body': json.dumps({'error': 'Method not allowed'})
+            'body': http.dumps({'error': 'Method not allowed'})
         }
 
 def get_all_sounds() -> Dict[str, Any]:
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    # Список читается с реплики, но сразу после правок админки - с основного
+    # сервера, чтобы только что добавленный звук не пропал из таблицы
+    sounds = db.run_read(load_all_sounds, sticky_key=ADMIN_STICKY_KEY)
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
+        'body': http.dumps({'sounds': sounds})
+    }
+
+def load_all_sounds(conn: Any) -> list:
     cur = conn.cursor()
     
     cur.execute(
-        "SELECT id, title, description, file_url, category, downloads_count, created_at FROM wb_sounds ORDER BY created_at DESC"
+        "SELECT id, title, description, file_url, category, downloads_count, created_at, analysis_status FROM wb_sounds ORDER BY created_at DESC"
     )
     
     sounds = []
@@ -67,17 +107,12 @@ def get_all_sounds() -> Dict[str, Any]:
             'file_url': row[3],
             'category': row[4],
             'downloads_count': row[5],
-            'created_at': row[6].isoformat() if row[6] else None
+            'created_at': row[6].isoformat() if row[6] else None,
+            'analysis_status': row[7]
         })
     
     cur.close()
-    conn.close()
-    
-    return {
-        'statusCode': 200,
-        'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-        'body': json.dumps({'sounds': sounds})
-    }
+    return sounds
 
 def add_sound(event: Dict[str, Any]) -> Dict[str, Any]:
     body_data = json.loads(event.get('body', '{}'))
@@ -91,27 +126,51 @@ def add_sound(event: Dict[str, Any]) -> Dict[str, Any]:
         return {
             'statusCode': 400,
             'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-            'body': json.dumps({'error': 'title, file_url and category required'})
+            'body': http.dumps({'error': 'title, file_url and category required'})
         }
     
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
-    cur = conn.cursor()
-    
-    cur.execute(
-        "INSERT INTO wb_sounds (title, description, file_url, category) VALUES (%s, %s, %s, %s) RETURNING id",
-        (title, description, file_url, category)
-    )
-    sound_id = cur.fetchone()[0]
-    conn.commit()
-    cur.close()
-    conn.close()
+    with db.connection() as conn:
+        cur = conn.cursor()
+        
+        cur.execute(
+            "INSERT INTO wb_sounds (title, description, file_url, category) VALUES (%s, %s, %s, %s) RETURNING id",
+            (title, description, file_url, category)
+        )
+        sound_id = cur.fetchone()[0]
+        attach_analysis(cur, sound_id, file_url)
+        catalog.bump_version(cur, 'sounds')
+        conn.commit()
+        cur.close()
+        snapshots.publish_quietly(conn, 'sounds')
+    db.mark_written(ADMIN_STICKY_KEY)
     
     return {
         'statusCode': 200,
         'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-        'body': json.dumps({'id': sound_id, 'success': True})
+        'body': http.dumps({'id': sound_id, 'success': True})
     }
 
+def attach_analysis(cur: Any, sound_id: int, file_url: str) -> None:
+    '''
+    Переносит в wb_sounds сохранённый в sound_file_analysis результат анализа
+    файла звука, в том числе неудачный. pending остаётся только файлам
+    хранилища, загруженным до анализа: повторная загрузка того же файла
+    проанализирует его и обновит звук. Чужие URL анализу недоступны.
+    '''
+    fallback = analysis_fallback(get_storage(), file_url)
+    cur.execute(
+        """UPDATE wb_sounds s
+           SET duration_seconds = a.duration_seconds, waveform_peaks = a.waveform_peaks,
+               loudness_db = a.loudness_db, analysis_status = COALESCE(a.status, %s)
+           FROM (SELECT %s::integer AS id) v
+           LEFT JOIN sound_file_analysis a ON a.file_url = %s
+           WHERE s.id = v.id""",
+        (fallback, sound_id, file_url)
+    )
+
+def analysis_fallback(storage: Any, file_url: str) -> str:
+    return 'pending' if storage.key_for_url(file_url) else 'unavailable'
+
 def update_sound(event: Dict[str, Any]) -> Dict[str, Any]:
     body_data = json.loads(event.get('body', '{}'))
     
@@ -125,24 +184,27 @@ def update_sound(event: Dict[str, Any]) -> Dict[str, Any]:
         return {
             'statusCode': 400,
             'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-            'body': json.dumps({'error': 'id required'})
+            'body': http.dumps({'error': 'id required'})
         }
     
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
-    cur = conn.cursor()
-    
-    cur.execute(
-        "UPDATE wb_sounds SET title = %s, description = %s, file_url = %s, category = %s WHERE id = %s",
-        (title, description, file_url, category, sound_id)
-    )
-    conn.commit()
-    cur.close()
-    conn.close()
+    with db.connection() as conn:
+        cur = conn.cursor()
+        
+        cur.execute(
+            "UPDATE wb_sounds SET title = %s, description = %s, file_url = %s, category = %s WHERE id = %s",
+            (title, description, file_url, category, sound_id)
+        )
+        attach_analysis(cur, sound_id, file_url)
+        catalog.bump_version(cur, 'sounds')
+        conn.commit()
+        cur.close()
+        snapshots.publish_quietly(conn, 'sounds')
+    db.mark_written(ADMIN_STICKY_KEY)
     
     return {
         'statusCode': 200,
         'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-        'body': json.dumps({'success': True})
+        'body': http.dumps({'success': True})
     }
 
 def delete_sound(event: Dict[str, Any]) -> Dict[str, Any]:
@@ -153,19 +215,251 @@ def delete_sound(event: Dict[str, Any]) -> Dict[str, Any]:
         return {
             'statusCode': 400,
             'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-            'body': json.dumps({'error': 'id required'})
+            'body': http.dumps({'error': 'id required'})
         }
     
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
-    cur = conn.cursor()
+    with db.connection() as conn:
+        cur = conn.cursor()
+        
+        cur.execute("DELETE FROM wb_sounds WHERE id = %s", (sound_id,))
+        catalog.bump_version(cur, 'sounds')
+        conn.commit()
+        cur.close()
+        snapshots.publish_quietly(conn, 'sounds')
+    db.mark_written(ADMIN_STICKY_KEY)
     
-    cur.execute("DELETE FROM wb_sounds WHERE id = %s", (sound_id,))
-    conn.commit()
-    cur.close()
-    conn.close()
+    return {
+        'statusCode': 200,
+        'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
+        'body': http.dumps({'success': True})
+    }
+
+def validate_sound(row: Any) -> str:
+    if not isinstance(row, dict):
+        return 'row must be an object'
+    for field in ('title', 'file_url', 'category'):
+        if not row.get(field) or not isinstance(row[field], str):
+            return f'{field} required'
+        if len(row[field]) > SOUND_LIMITS[field]:
+            return f'{field} longer than {SOUND_LIMITS[field]} characters'
+    if row.get('description') is not None and not isinstance(row['description'], str):
+        return 'description must be a string'
+    if row.get('id') is not None and (not isinstance(row['id'], int) or row['id'] <= 0):
+        return 'id must be a positive integer'
+    return ''
+
+def bulk_upsert_sounds(rows: Any) -> Dict[str, Any]:
+    '''
+    Массовая загрузка каталога: строки с id обновляют существующие звуки,
+    без id - добавляются. Невалидные строки пропускаются и возвращаются
+    в errors с индексом, валидные пишутся пачками execute_values в одной
+    транзакции с одним увеличением версии каталога. Анализ аудио берётся
+    из sound_file_analysis в тех же запросах, как в attach_analysis.
+    '''
+    if not isinstance(rows, list) or not rows or len(rows) > BULK_MAX_ROWS:
+        return {
+            'statusCode': 400,
+            'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
+            'body': http.dumps({'error': f'sounds must be a list of 1..{BULK_MAX_ROWS} rows'})
+        }
+    
+    storage = get_storage()
+    errors = []
+    inserts: List[tuple] = []
+    updates: List[tuple] = []
+    for index, row in enumerate(rows):
+        error = validate_sound(row)
+        if error:
+            errors.append({'index': index, 'error': error})
+            continue
+        values = (row['title'], row.get('description'), row['file_url'], row['category'],
+                  analysis_fallback(storage, row['file_url']))
+        if row.get('id'):
+            updates.append((row['id'],) + values)
+        else:
+            inserts.append((index,) + values)
+    
+    from psycopg2.extras import execute_values
+    
+    updated_ids: List[int] = []
+    inserted_ids: List[int] = []
+    with db.connection() as conn:
+        cur = conn.cursor()
+        if updates:
+            # В SET s.file_url - ещё старое значение: анализ сбрасывается и берётся
+            # из sound_file_analysis только у звуков, которым сменили файл
+            updated_ids = [r[0] for r in execute_values(
+                cur,
+                """UPDATE wb_sounds s SET title = v.title, description = v.description,
+                     file_url = v.file_url, category = v.category,
+                     analysis_status = CASE WHEN s.file_url IS DISTINCT FROM v.file_url
+                       THEN COALESCE(a.status, v.fallback) ELSE s.analysis_status END,
+                     duration_seconds = CASE WHEN s.file_url IS DISTINCT FROM v.file_url
+                       THEN a.duration_seconds ELSE s.duration_seconds END,
+                     waveform_peaks = CASE WHEN s.file_url IS DISTINCT FROM v.file_url
+                       THEN a.waveform_peaks ELSE s.waveform_peaks END,
+                     loudness_db = CASE WHEN s.file_url IS DISTINCT FROM v.file_url
+                       THEN a.loudness_db ELSE s.loudness_db END
+                   FROM (VALUES %s) AS v(id, title, description, file_url, category, fallback)
+                   LEFT JOIN sound_file_analysis a ON a.file_url = v.file_url
+                   WHERE s.id = v.id
+                   RETURNING s.id""",
+                updates,
+                template='(%s::integer, %s, %s, %s, %s, %s)',
+                page_size=BULK_PAGE_SIZE,
+                fetch=True
+            )]
+        if inserts:
+            inserted_ids = [r[0] for r in execute_values(
+                cur,
+                """INSERT INTO wb_sounds (title, description, file_url, category, analysis_status,
+                                          duration_seconds, waveform_peaks, loudness_db)
+                   SELECT v.title, v.description, v.file_url, v.category, COALESCE(a.status, v.fallback),
+                          a.duration_seconds, a.waveform_peaks, a.loudness_db
+                   FROM (VALUES %s) AS v(ord, title, description, file_url, category, fallback)
+                   LEFT JOIN sound_file_analysis a ON a.file_url = v.file_url
+                   ORDER BY v.ord
+                   RETURNING id""",
+                inserts,
+                template='(%s::integer, %s, %s, %s, %s, %s)',
+                page_size=BULK_PAGE_SIZE,
+                fetch=True
+            )]
+        if updated_ids or inserted_ids:
+            catalog.bump_version(cur, 'sounds')
+        conn.commit()
+        cur.close()
+        if updated_ids or inserted_ids:
+            snapshots.publish_quietly(conn, 'sounds')
+    db.mark_written(ADMIN_STICKY_KEY)
+    
+    missing = sorted({u[0] for u in updates} - set(updated_ids))
+    for index, row in enumerate(rows):
+        if isinstance(row, dict) and row.get('id') in missing:
+            errors.append({'index': index, 'error': 'sound not found'})
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
+        'body': http.dumps({
+            'success': not errors,
+            'inserted': len(inserted_ids),
+            'updated': len(updated_ids),
+            'inserted_ids': inserted_ids,
+            'errors': sorted(errors, key=lambda e: e['index'])
+        })
+    }
+
+def export_rows(conn: Any):
+    cur = conn.cursor(name='wb_sounds_export')
+    cur.itersize = EXPORT_ITERSIZE
+    cur.execute(f"SELECT {', '.join(EXPORT_COLUMNS)} FROM wb_sounds ORDER BY id")
+    try:
+        for row in cur:
+            yield row
+    finally:
+        cur.close()
+
+def export_sounds(fmt: str) -> Dict[str, Any]:
+    '''
+    Выгрузка каталога в NDJSON или CSV прямо в теле ответа, файлом для
+    скачивания. Строки читаются серверным курсором пачками по EXPORT_ITERSIZE
+    и сразу пишутся в текст ответа, без промежуточного списка строк.
+    '''
+    out = io.StringIO()
+    writer = csv.writer(out) if fmt == 'csv' else None
+    if writer:
+        writer.writerow(EXPORT_COLUMNS)
+    
+    with db.read_connection(ADMIN_STICKY_KEY) as conn:
+        for row in export_rows(conn):
+            values = list(row)
+            values[-1] = values[-1].isoformat() if values[-1] else None
+            if writer:
+                writer.writerow(values)
+            else:
+                out.write(http.dumps(dict(zip(EXPORT_COLUMNS, values))))
+                out.write('\n')
+    
+    filename = f'wb_sounds-{time.strftime("%Y%m%d-%H%M%S")}.{fmt}'
+    return {
+        'statusCode': 200,
+        'headers': {
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Expose-Headers': 'Content-Disposition',
+            'Content-Type': EXPORT_CONTENT_TYPES[fmt],
+            'Content-Disposition': f'attachment; filename="{filename}"'
+        },
+        'isBase64Encoded': False,
+        'body': out.getvalue()
+    }
+
+def publish_snapshots(names: Any) -> Dict[str, Any]:
+    '''
+    Принудительная перепубликация снимков каталогов - например, после правки
+    курсов миграцией, сворачивания скачиваний или анализа загруженного файла,
+    или если публикация после записи не удалась.
+    '''
+    names = names or list(snapshots.RENDERERS)
+    if not isinstance(names, list) or any(name not in snapshots.RENDERERS for name in names):
+        return {
+            'statusCode': 400,
+            'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
+            'body': http.dumps({'error': f'catalogs must be a subset of {sorted(snapshots.RENDERERS)}'})
+        }
+    
+    published = {}
+    with db.connection() as conn:
+        for name in names:
+            published[name] = snapshots.publish(conn, name, force=True)
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
+        'body': http.dumps({'success': True, 'published': published})
+    }
+
+def maintain_messages() -> Dict[str, Any]:
+    '''
+    Обслуживание партиций messages: месяцы вперёд и архивирование месяцев
+    старше MESSAGES_RETENTION_MONTHS в таблицы messages_archive_YYYY_MM.
+    DETACH берёт ACCESS EXCLUSIVE на messages, поэтому ожидание блокировок
+    ограничено lock_timeout: если переписка занята, проход откатывается
+    и его можно повторить.
+    '''
+    from psycopg2.errors import LockNotAvailable
+    
+    with db.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT pg_try_advisory_xact_lock(%s)", (MESSAGES_MAINTENANCE_LOCK,))
+        if not cur.fetchone()[0]:
+            conn.rollback()
+            cur.close()
+            return {
+                'statusCode': 409,
+                'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
+                'body': http.dumps({'error': 'Maintenance is already running'})
+            }
+        cur.execute("SELECT set_config('lock_timeout', %s, true)", (MESSAGES_MAINTENANCE_LOCK_TIMEOUT,))
+        try:
+            cur.execute(
+                "SELECT action, partition_name FROM messages_maintain(%s, %s)",
+                (MESSAGES_PARTITIONS_AHEAD, MESSAGES_RETENTION_MONTHS)
+            )
+        except LockNotAvailable:
+            conn.rollback()
+            cur.close()
+            return {
+                'statusCode': 503,
+                'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json', 'Retry-After': '60'},
+                'body': http.dumps({'error': 'messages table is busy, retry later'})
+            }
+        actions = [{'action': row[0], 'partition': row[1]} for row in cur.fetchall()]
+        conn.commit()
+        cur.close()
     
     return {
         'statusCode': 200,
         'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-        'body': json.dumps({'success': True})
+        'body': http.dumps({'success': True, 'actions': actions, 'retention_months': MESSAGES_RETENTION_MONTHS})
     }
@@ -0,0 +1,282 @@
+'''
+Пул соединений с PostgreSQL, общий для всех backend-функций.
+
+Пул живёт на уровне модуля, поэтому тёплый контейнер функции переиспользует
+уже открытые соединения между вызовами и не платит за TLS и аутентификацию
+на каждом запросе.
+
+Если задан DATABASE_READ_URL, чистые чтения (run_read, read_connection) идут
+на реплику отдельным пулом. При ошибке реплики чтение повторяется на основном
+сервере, а после записи (mark_written) чтения того же ключа, например
+пользователя, ещё DB_READ_STICKY_SECONDS идут на основной сервер, чтобы автор
+видел свои изменения несмотря на отставание реплики.
+'''
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Any, List, Iterator, Optional, Tuple, TypeVar
+
+from core import trace
+
+POOL_MAX_IDLE = int(os.environ.get('DB_POOL_MAX_IDLE', '4'))
+POOL_CHECK_AFTER = float(os.environ.get('DB_POOL_CHECK_AFTER', '30'))
+POOL_MAX_LIFETIME = float(os.environ.get('DB_POOL_MAX_LIFETIME', '1800'))
+READ_STICKY_SECONDS = float(os.environ.get('DB_READ_STICKY_SECONDS', '5'))
+REPLICA_RETRY_AFTER = float(os.environ.get('DB_REPLICA_RETRY_AFTER', '30'))
+STICKY_MAX_KEYS = 10000
+
+PRIMARY = 'primary'
+REPLICA = 'replica'
+
+T = TypeVar('T')
+
+_lock = threading.Lock()
+_idle: Dict[str, List[Tuple[Any, float]]] = {PRIMARY: [], REPLICA: []}
+_born: Dict[int, float] = {}
+_roles: Dict[int, str] = {}
+_sticky_until: Dict[str, float] = {}
+_replica_down_until = 0.0
+_stats: Dict[str, int] = {
+    'hits': 0, 'misses': 0, 'stale': 0, 'discarded': 0,
+    'replica_reads': 0, 'primary_reads': 0, 'sticky_reads': 0, 'replica_fallbacks': 0
+}
+
+# Подкласс psycopg2.extensions.connection для новых соединений. По умолчанию
+# (DB_TRACE=1) - trace.TracedConnection с замером запросов
+connection_factory: Optional[Any] = None
+
+def _psycopg2() -> Any:
+    # psycopg2 импортируется при первом обращении к базе: preflight и ранние
+    # 401/405 не платят за загрузку драйвера на холодном старте
+    import psycopg2
+    import psycopg2.errors
+    import psycopg2.extensions
+    return psycopg2
+
+def __getattr__(name: str) -> Any:
+    if name == 'DatabaseError':
+        return _psycopg2().Error
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+def _connect(role: str = PRIMARY) -> Any:
+    psycopg2 = _psycopg2()
+    url = os.environ['DATABASE_READ_URL'] if role == REPLICA else os.environ['DATABASE_URL']
+    factory = connection_factory or (trace.connection_class() if trace.TRACE_ENABLED else None)
+    if factory is not None:
+        conn = psycopg2.connect(url, connection_factory=factory)
+    else:
+        conn = psycopg2.connect(url)
+    if role == REPLICA:
+        # На настоящей реплике это и так так; на второй независимой базе
+        # (локальная проверка) случайная запись упадёт, а не разойдётся
+        conn.set_session(readonly=True)
+    _born[id(conn)] = time.monotonic()
+    _roles[id(conn)] = role
+    return conn
+
+def _is_alive(conn: Any, idle_since: float) -> bool:
+    psycopg2 = _psycopg2()
+    if conn.closed:
+        return False
+    if time.monotonic() - idle_since < POOL_CHECK_AFTER:
+        return True
+    try:
+        cur = conn.cursor()
+        cur.execute('SELECT 1')
+        cur.close()
+        conn.rollback()
+        return True
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        return False
+
+def _close_quietly(conn: Any) -> None:
+    psycopg2 = _psycopg2()
+    _born.pop(id(conn), None)
+    _roles.pop(id(conn), None)
+    try:
+        conn.close()
+    except psycopg2.Error:
+        pass
+
+def acquire(role: str = PRIMARY) -> Any:
+    '''
+    Берёт соединение из пула или открывает новое, если свободных нет.
+    Соединения, простоявшие дольше DB_POOL_CHECK_AFTER секунд, проверяются
+    запросом SELECT 1 и при обрыве заменяются новыми.
+    '''
+    idle = _idle[role]
+    while True:
+        with _lock:
+            if not idle:
+                _stats['misses'] += 1
+                break
+            conn, idle_since = idle.pop()
+        age = time.monotonic() - _born.get(id(conn), 0.0)
+        if age < POOL_MAX_LIFETIME and _is_alive(conn, idle_since):
+            with _lock:
+                _stats['hits'] += 1
+            return conn
+        with _lock:
+            _stats['stale'] += 1
+        _close_quietly(conn)
+
+    return _connect(role)
+
+def release(conn: Any) -> None:
+    '''
+    Возвращает соединение в пул. Незавершённая транзакция откатывается,
+    сломанные соединения и излишки сверх DB_POOL_MAX_IDLE закрываются.
+    '''
+    psycopg2 = _psycopg2()
+    if conn.closed:
+        with _lock:
+            _stats['discarded'] += 1
+        _born.pop(id(conn), None)
+        _roles.pop(id(conn), None)
+        return
+
+    try:
+        if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            conn.rollback()
+    except psycopg2.Error:
+        with _lock:
+            _stats['discarded'] += 1
+        _close_quietly(conn)
+        return
+
+    idle = _idle[_roles.get(id(conn), PRIMARY)]
+    with _lock:
+        if len(idle) < POOL_MAX_IDLE:
+            idle.append((conn, time.monotonic()))
+            return
+        _stats['discarded'] += 1
+    _close_quietly(conn)
+
+@contextmanager
+def connection(role: str = PRIMARY) -> Iterator[Any]:
+    '''
+    Соединение из пула на время блока with. Коммит остаётся за вызывающим
+    кодом, как и раньше с psycopg2.connect().
+    '''
+    conn = acquire(role)
+    try:
+        yield conn
+    finally:
+        release(conn)
+
+class DeferredCommit:
+    '''
+    Обёртка соединения, у которой commit() ничего не делает: код действий,
+    написанный с собственным commit, выполняется внутри чужой транзакции,
+    а коммитит её владелец - batch в социальной функции или idempotency.
+    '''
+    def __init__(self, conn: Any):
+        self._conn = conn
+
+    def commit(self) -> None:
+        pass
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._conn, name)
+
+def mark_written(*keys: Any) -> None:
+    '''
+    Отмечает запись от имени ключей (обычно id пользователей): их чтения
+    DB_READ_STICKY_SECONDS идут на основной сервер. Отметки живут в памяти
+    контейнера, поэтому покрывают типичный сценарий «записал и сразу
+    перечитал» в тёплом контейнере, но не все контейнеры сразу.
+    '''
+    if not os.environ.get('DATABASE_READ_URL'):
+        return
+    until = time.monotonic() + READ_STICKY_SECONDS
+    with _lock:
+        if len(_sticky_until) >= STICKY_MAX_KEYS:
+            now = time.monotonic()
+            for key in [k for k, t in _sticky_until.items() if t < now]:
+                del _sticky_until[key]
+        for key in keys:
+            if key is not None:
+                _sticky_until[str(key)] = until
+
+def read_role(sticky_key: Any = None) -> str:
+    '''
+    Куда идти за чтением: на реплику, если она настроена, жива и ключ не
+    писал только что, иначе на основной сервер.
+    '''
+    if not os.environ.get('DATABASE_READ_URL'):
+        return PRIMARY
+    now = time.monotonic()
+    with _lock:
+        if now < _replica_down_until:
+            _stats['primary_reads'] += 1
+            return PRIMARY
+        if sticky_key is not None and _sticky_until.get(str(sticky_key), 0.0) > now:
+            _stats['sticky_reads'] += 1
+            return PRIMARY
+        _stats['replica_reads'] += 1
+    return REPLICA
+
+def _replica_failed() -> None:
+    global _replica_down_until
+    with _lock:
+        _stats['replica_fallbacks'] += 1
+        _replica_down_until = time.monotonic() + REPLICA_RETRY_AFTER
+
+def _replica_errors() -> tuple:
+    # Обрыв или недоступность реплики, конфликт с восстановлением (40001)
+    # и случайная запись в read-only транзакции - во всех случаях чтение
+    # можно безопасно повторить на основном сервере
+    psycopg2 = _psycopg2()
+    return (psycopg2.OperationalError, psycopg2.InterfaceError,
+            psycopg2.extensions.TransactionRollbackError, psycopg2.errors.ReadOnlySqlTransaction)
+
+@contextmanager
+def read_connection(sticky_key: Any = None) -> Iterator[Any]:
+    '''
+    Соединение для чтения. Если реплика не отвечает при подключении, блок
+    получает соединение основного сервера. Ошибки внутри блока не
+    повторяются - для этого есть run_read.
+    '''
+    role = read_role(sticky_key)
+    if role == REPLICA:
+        try:
+            conn = acquire(REPLICA)
+        except _replica_errors():
+            _replica_failed()
+            conn = acquire(PRIMARY)
+    else:
+        conn = acquire(PRIMARY)
+    try:
+        yield conn
+    finally:
+        release(conn)
+
+def run_read(fn: Callable[[Any], T], sticky_key: Any = None) -> T:
+    '''
+    Выполняет чтение fn(conn) на реплике. При ошибке реплики (подключение или
+    сам запрос) реплика на DB_REPLICA_RETRY_AFTER секунд считается недоступной,
+    а fn повторяется на основном сервере. fn не должна ничего записывать.
+    '''
+    if read_role(sticky_key) == PRIMARY:
+        with connection(PRIMARY) as conn:
+            return fn(conn)
+    try:
+        with connection(REPLICA) as conn:
+            return fn(conn)
+    except _replica_errors():
+        _replica_failed()
+    with connection(PRIMARY) as conn:
+        return fn(conn)
+
+def pool_stats() -> Dict[str, int]:
+    '''
+    Счётчики пула: hits - соединение взято из пула, misses - открыто новое,
+    stale - выброшено при проверке, discarded - закрыто при возврате;
+    *_reads - куда ушли чтения, replica_fallbacks - повторы на основном сервере.
+    '''
+    with _lock:
+        stats = dict(_stats)
+        stats['idle'] = len(_idle[PRIMARY])
+        stats['idle_replica'] = len(_idle[REPLICA])
+    return stats
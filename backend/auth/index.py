@@ -1,11 +1,15 @@
 import json
 import os
-import hashlib
-import jwt
 from datetime import datetime, timedelta
 from typing import Dict, Any
-import psycopg2
 
+from core import db, http, ratelimit, trace
+
+LOGIN_BY_IP = ratelimit.Limit('login_ip', 30, 60)
+LOGIN_BY_EMAIL = ratelimit.Limit('login_email', 10, 300)
+
+@http.compressible
+@trace.traced
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Регистрация и авторизация пользователей
@@ -30,7 +34,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         return {
             'statusCode': 405,
             'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-            'body': json.dumps({'error': 'Method not allowed'})
+            'body': http.dumps({'error': 'Method not allowed'})
         }
     
     body_data = json.loads(event.get('body', '{}'))
@@ -39,12 +43,12 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     if action == 'register':
         return register_user(body_data)
     elif action == 'login':
-        return login_user(body_data)
+        return login_user(body_data, ratelimit.client_ip(event))
     else:
         return {
             'statusCode': 400,
             'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-            'body': json.dumps({'error': 'Invalid action'})
+            'body': http.dumps({'error': 'Invalid action'})
         }
 
 def register_user(data: Dict[str, Any]) -> Dict[str, Any]:
@@ -56,32 +60,33 @@ def register_user(data: Dict[str, Any]) -> Dict[str, Any]:
         return {
             'statusCode': 400,
             'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-            'body': json.dumps({'error': 'Email, password and username required'})
+            'body': http.dumps({'error': 'Email, password and username required'})
         }
     
-    password_hash = hashlib.sha256(password.encode()).hexdigest()
+    import hashlib
+    import jwt
     
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
-    cur = conn.cursor()
+    password_hash = hashlib.sha256(password.encode()).hexdigest()
     
-    cur.execute("SELECT id FROM users WHERE email = %s", (email,))
-    if cur.fetchone():
+    with db.connection() as conn:
+        cur = conn.cursor()
+        
+        cur.execute("SELECT id FROM users WHERE email = %s", (email,))
+        if cur.fetchone():
+            cur.close()
+            return {
+                'statusCode': 400,
+                'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
+                'body': http.dumps({'error': 'User already exists'})
+            }
+        
+        cur.execute(
+            "INSERT INTO users (email, password_hash, username) VALUES (%s, %s, %s) RETURNING id",
+            (email, password_hash, username)
+        )
+        user_id = cur.fetchone()[0]
+        conn.commit()
         cur.close()
-        conn.close()
-        return {
-            'statusCode': 400,
-            'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-            'body': json.dumps({'error': 'User already exists'})
-        }
-    
-    cur.execute(
-        "INSERT INTO users (email, password_hash, username) VALUES (%s, %s, %s) RETURNING id",
-        (email, password_hash, username)
-    )
-    user_id = cur.fetchone()[0]
-    conn.commit()
-    cur.close()
-    conn.close()
     
     token = jwt.encode(
         {'user_id': user_id, 'email': email, 'exp': datetime.utcnow() + timedelta(days=30)},
@@ -92,10 +97,10 @@ def register_user(data: Dict[str, Any]) -> Dict[str, Any]:
     return {
         'statusCode': 200,
         'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-        'body': json.dumps({'token': token, 'username': username, 'email': email})
+        'body': http.dumps({'token': token, 'username': username, 'email': email})
     }
 
-def login_user(data: Dict[str, Any]) -> Dict[str, Any]:
+def login_user(data: Dict[str, Any], client_ip: Any = None) -> Dict[str, Any]:
     email = data.get('email')
     password = data.get('password')
     
@@ -103,27 +108,34 @@ def login_user(data: Dict[str, Any]) -> Dict[str, Any]:
         return {
             'statusCode': 400,
             'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-            'body': json.dumps({'error': 'Email and password required'})
+            'body': http.dumps({'error': 'Email and password required'})
         }
     
-    password_hash = hashlib.sha256(password.encode()).hexdigest()
+    # Перебор паролей режется и по адресу, и по атакуемому email - до хэширования и запроса к users
+    retry_after = ratelimit.check([(LOGIN_BY_IP, client_ip), (LOGIN_BY_EMAIL, email)])
+    if retry_after:
+        return ratelimit.too_many_requests(retry_after)
     
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
-    cur = conn.cursor()
+    import hashlib
+    import jwt
     
-    cur.execute(
-        "SELECT id, username, email FROM users WHERE email = %s AND password_hash = %s",
-        (email, password_hash)
-    )
-    user = cur.fetchone()
-    cur.close()
-    conn.close()
+    password_hash = hashlib.sha256(password.encode()).hexdigest()
+    
+    with db.connection() as conn:
+        cur = conn.cursor()
+        
+        cur.execute(
+            "SELECT id, username, email FROM users WHERE email = %s AND password_hash = %s",
+            (email, password_hash)
+        )
+        user = cur.fetchone()
+        cur.close()
     
     if not user:
         return {
             'statusCode': 401,
             'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-            'body': json.dumps({'error': 'Invalid credentials'})
+            'body': http.dumps({'error': 'Invalid credentials'})
         }
     
     user_id, username, user_email = user
@@ -137,5 +149,5 @@ def login_user(data: Dict[str, Any]) -> Dict[str, Any]:
     return {
         'statusCode': 200,
         'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-        'body': json.dumps({'token': token, 'username': username, 'email': user_email})
+        'body': http.dumps({'token': token, 'username': username, 'email': user_email})
     }
@@ -0,0 +1,3 @@
+'''
+Общий код backend-функций: пул соединений с БД и вспомогательные утилиты
+'''
@@ -0,0 +1,128 @@
+'''
+Анализ загруженного аудио: длительность, огрубленная волна (пики) и громкость.
+Результат хранится в базе по URL файла (sound_file_analysis): одинаковые файлы
+не анализируются повторно, а админка подхватывает его при создании звука в
+любом контейнере. Неудачный анализ сохраняется так же, со status failed.
+'''
+import io
+import json
+import os
+import wave
+from typing import Any, Dict, Optional
+
+from core.storage import Storage
+
+ANALYSIS_SAMPLE_RATE = 22050
+WAVEFORM_PEAKS = 200
+# Анализ идёт прямо в запросе загрузки, поэтому размер файла ограничен:
+# 10 МБ mp3 - это десятки минут звука, уведомления ПВЗ много короче
+ANALYSIS_MAX_SIZE = int(os.environ.get('ANALYSIS_MAX_SIZE', str(10 * 1024 * 1024)))
+
+def decode(data: bytes, ext: str):
+    '''
+    Декодирует файл в моно float32. WAV читается стандартным модулем wave,
+    mp3, flac и ogg - встроенными декодерами miniaudio с пересэмплированием
+    в ANALYSIS_SAMPLE_RATE, без внешних программ.
+    '''
+    import numpy as np
+
+    if ext == 'wav':
+        with wave.open(io.BytesIO(data)) as w:
+            rate = w.getframerate()
+            channels = w.getnchannels()
+            width = w.getsampwidth()
+            frames = w.readframes(w.getnframes())
+        dtypes = {1: np.uint8, 2: np.int16, 4: np.int32}
+        if width not in dtypes:
+            raise ValueError(f'Unsupported sample width: {width}')
+        samples = np.frombuffer(frames, dtype=dtypes[width]).astype(np.float32)
+        if width == 1:
+            samples = (samples - 128.0) / 128.0
+        else:
+            samples /= float(2 ** (8 * width - 1))
+        if channels > 1:
+            samples = samples.reshape(-1, channels).mean(axis=1)
+        return samples, rate
+
+    import miniaudio
+
+    try:
+        decoded = miniaudio.decode(data, output_format=miniaudio.SampleFormat.FLOAT32,
+                                   nchannels=1, sample_rate=ANALYSIS_SAMPLE_RATE)
+    except miniaudio.MiniaudioError as e:
+        raise ValueError(f'Cannot decode .{ext} file: {e}')
+    return np.frombuffer(decoded.samples, dtype=np.float32), ANALYSIS_SAMPLE_RATE
+
+def compute_features(samples: Any, rate: int, peaks: int = WAVEFORM_PEAKS) -> Dict[str, Any]:
+    import numpy as np
+
+    duration = len(samples) / float(rate) if rate else 0.0
+    if len(samples) == 0:
+        return {'duration_seconds': 0.0, 'waveform_peaks': [0] * peaks, 'loudness_db': None}
+
+    bucket = -(-len(samples) // peaks)
+    padded = np.zeros(bucket * peaks, dtype=np.float32)
+    padded[:len(samples)] = np.abs(samples)
+    bucket_peaks = padded.reshape(peaks, bucket).max(axis=1)
+    top = float(bucket_peaks.max()) or 1.0
+    waveform = np.rint(bucket_peaks / top * 100).astype(np.int16).tolist()
+
+    rms = float(np.sqrt(np.mean(np.square(samples, dtype=np.float64))))
+    loudness = round(20 * np.log10(rms), 2) if rms > 0 else None
+
+    return {'duration_seconds': round(duration, 3), 'waveform_peaks': waveform, 'loudness_db': loudness}
+
+def analyze_stored(storage: Storage, key: str) -> Dict[str, Any]:
+    '''
+    Анализирует файл. Ошибка анализа - тоже результат, {'status': 'failed',
+    'error': ...}: его сохраняют так же, чтобы звук с этим файлом не остался
+    pending и файл не разбирался заново при каждой загрузке.
+    '''
+    try:
+        with storage.open(key) as f:
+            data = f.read(ANALYSIS_MAX_SIZE + 1)
+        if len(data) > ANALYSIS_MAX_SIZE:
+            raise ValueError(f'Files larger than {ANALYSIS_MAX_SIZE} bytes are not analyzed')
+        samples, rate = decode(data, key.rsplit('.', 1)[-1].lower())
+        return dict(compute_features(samples, rate), status='done')
+    except (OSError, ValueError, EOFError, wave.Error) as e:
+        return {'status': 'failed', 'error': str(e) or type(e).__name__}
+
+def load_analysis(cur: Any, file_url: str) -> Optional[Dict[str, Any]]:
+    cur.execute(
+        """SELECT status, duration_seconds, waveform_peaks, loudness_db, error
+           FROM sound_file_analysis WHERE file_url = %s""",
+        (file_url,)
+    )
+    row = cur.fetchone()
+    if row is None:
+        return None
+    return {'status': row[0], 'duration_seconds': row[1], 'waveform_peaks': row[2], 'loudness_db': row[3], 'error': row[4]}
+
+def save_analysis(cur: Any, file_url: str, analysis: Dict[str, Any]) -> int:
+    '''
+    Сохраняет результат по файлу и проставляет его звукам, уже ссылающимся
+    на этот файл. Возвращает число обновлённых звуков.
+    '''
+    peaks = analysis.get('waveform_peaks')
+    cur.execute(
+        """INSERT INTO sound_file_analysis (file_url, status, duration_seconds, waveform_peaks, loudness_db, error)
+           VALUES (%s, %s, %s, %s, %s, %s)
+           ON CONFLICT (file_url) DO UPDATE
+           SET status = EXCLUDED.status, duration_seconds = EXCLUDED.duration_seconds,
+               waveform_peaks = EXCLUDED.waveform_peaks, loudness_db = EXCLUDED.loudness_db,
+               error = EXCLUDED.error, analyzed_at = CURRENT_TIMESTAMP""",
+        (file_url, analysis['status'], analysis.get('duration_seconds'),
+         json.dumps(peaks) if peaks is not None else None, analysis.get('loudness_db'), analysis.get('error'))
+    )
+    cur.execute(
+        """UPDATE wb_sounds s SET duration_seconds = a.duration_seconds, waveform_peaks = a.waveform_peaks,
+               loudness_db = a.loudness_db, analysis_status = a.status
+           FROM sound_file_analysis a
+           WHERE a.file_url = %s AND s.file_url = a.file_url""",
+        (file_url,)
+    )
+    return cur.rowcount
+
+def analysis_status(analysis: Optional[Dict[str, Any]]) -> str:
+    return 'pending' if analysis is None else analysis['status']
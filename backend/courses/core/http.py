@@ -0,0 +1,123 @@
+'''
+Сборка HTTP-ответов backend-функций: компактная сериализация JSON и сжатие
+тела по Accept-Encoding.
+
+orjson и brotli подключаются, если установлены; без них используются json
+и gzip из стандартной библиотеки с тем же результатом.
+'''
+import base64
+import datetime
+import decimal
+import functools
+import gzip
+import json
+from typing import Any, Callable, Dict, Optional
+
+from core.cache import TTLCache
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_MIN_BYTES = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+CORS_HEADERS = {'Access-Control-Allow-Origin': '*'}
+
+compressed_cache = TTLCache(maxsize=32, ttl=300.0)
+
+def _default(value: Any) -> Any:
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+def dumps(payload: Any) -> str:
+    '''
+    JSON без лишних пробелов и \\u-экранирования кириллицы. Даты - ISO 8601,
+    Decimal - числа.
+    '''
+    if orjson is not None:
+        return orjson.dumps(payload, default=_default, option=orjson.OPT_NON_STR_KEYS).decode()
+    return json.dumps(payload, default=_default, ensure_ascii=False, separators=(',', ':'))
+
+def response(status: int, payload: Any, headers: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    return {
+        'statusCode': status,
+        'headers': {**CORS_HEADERS, 'Content-Type': 'application/json', **(headers or {})},
+        'isBase64Encoded': False,
+        'body': dumps(payload)
+    }
+
+def accepted_encodings(event: Dict[str, Any]) -> Dict[str, float]:
+    headers = event.get('headers') or {}
+    value = headers.get('Accept-Encoding') or headers.get('accept-encoding') or ''
+    encodings = {}
+    for part in value.split(','):
+        name, _, params = part.strip().partition(';')
+        q = 1.0
+        if params.strip().startswith('q='):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        if name:
+            encodings[name.lower()] = q
+    return encodings
+
+def compress(event: Dict[str, Any], result: Dict[str, Any]) -> Dict[str, Any]:
+    body = result.get('body')
+    if not isinstance(body, str) or result.get('isBase64Encoded') or len(body) < COMPRESS_MIN_BYTES:
+        return result
+    headers = result.get('headers') or {}
+    if 'Content-Encoding' in headers:
+        return result
+
+    accepted = accepted_encodings(event)
+    if brotli is not None and accepted.get('br', 0) > 0:
+        encoding = 'br'
+    elif accepted.get('gzip', 0) > 0:
+        encoding = 'gzip'
+    else:
+        return result
+
+    # Тела каталогов приходят из кэша одним и тем же объектом строки,
+    # поэтому повторное сжатие тоже берётся из кэша
+    cache_key = (encoding, id(body), len(body))
+    cached = compressed_cache.get(cache_key)
+    if cached is not None and cached[0] is body:
+        encoded = cached[1]
+    else:
+        raw = body.encode('utf-8')
+        if encoding == 'br':
+            data = brotli.compress(raw, quality=BROTLI_QUALITY)
+        else:
+            data = gzip.compress(raw, compresslevel=GZIP_LEVEL, mtime=0)
+        encoded = base64.b64encode(data).decode('ascii')
+        compressed_cache.set(cache_key, (body, encoded))
+
+    vary = headers.get('Vary')
+    return {
+        **result,
+        'headers': {
+            **headers,
+            'Content-Encoding': encoding,
+            'Vary': f'{vary}, Accept-Encoding' if vary else 'Accept-Encoding'
+        },
+        'isBase64Encoded': True,
+        'body': encoded
+    }
+
+def compressible(handler: Callable[[Dict[str, Any], Any], Dict[str, Any]]) -> Callable[[Dict[str, Any], Any], Dict[str, Any]]:
+    @functools.wraps(handler)
+    def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+        return compress(event, handler(event, context))
+    return wrapper
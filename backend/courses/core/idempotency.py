@@ -0,0 +1,153 @@
+'''
+Идемпотентные записи по заголовку Idempotency-Key: повтор запроса с тем же
+ключом получает сохранённый первый ответ, а действие не выполняется снова.
+
+Ключ занимается вставкой в idempotency_keys в той же транзакции, что и сама
+запись, а ответ сохраняется перед её коммитом - запись и ответ появляются
+вместе или не появляются вовсе. Параллельный повтор ждёт на уникальном ключе,
+пока первый запрос не закончится, и получает его ответ. Готовые ответы
+дополнительно держатся в памяти контейнера, и частые повторы не доходят до
+базы.
+'''
+import hashlib
+import json
+import os
+import time
+import uuid
+from typing import Any, Callable, Dict, Optional
+
+from core import db, http
+from core.cache import TTLCache
+
+IDEMPOTENCY_TTL_HOURS = float(os.environ.get('IDEMPOTENCY_TTL_HOURS', '24'))
+KEY_MAX_LENGTH = 255
+CLEANUP_INTERVAL = 600.0
+CLEANUP_BATCH = 1000
+
+response_cache = TTLCache(maxsize=2048, ttl=300.0)
+_last_cleanup = 0.0
+
+def request_key(event: Dict[str, Any]) -> Optional[str]:
+    headers = event.get('headers') or {}
+    return headers.get('Idempotency-Key') or headers.get('idempotency-key')
+
+def _uuid(value: str) -> str:
+    return str(uuid.UUID(bytes=hashlib.md5(value.encode('utf-8')).digest()))
+
+def _fingerprint(event: Dict[str, Any]) -> str:
+    # Тот же JSON с другим порядком полей - тот же запрос
+    raw = event.get('body') or ''
+    try:
+        raw = json.dumps(json.loads(raw), sort_keys=True, ensure_ascii=False)
+    except ValueError:
+        pass
+    return _uuid(raw)
+
+def _replay(status: int, body: str) -> Dict[str, Any]:
+    return {
+        'statusCode': status,
+        'headers': {
+            **http.CORS_HEADERS,
+            'Content-Type': 'application/json',
+            'Idempotent-Replayed': 'true',
+            'Access-Control-Expose-Headers': 'Idempotent-Replayed'
+        },
+        'isBase64Encoded': False,
+        'body': body
+    }
+
+def _stored(request_hash: str, stored: tuple) -> Dict[str, Any]:
+    stored_hash, status, body = stored
+    if stored_hash != request_hash:
+        return http.response(422, {'error': 'Idempotency-Key was already used with a different request'})
+    return _replay(status, body)
+
+def _cleanup(cur: Any) -> None:
+    global _last_cleanup
+    now = time.monotonic()
+    if now - _last_cleanup < CLEANUP_INTERVAL:
+        return
+    _last_cleanup = now
+    cur.execute(
+        """DELETE FROM idempotency_keys WHERE id IN (
+               SELECT id FROM idempotency_keys
+               WHERE created_at < LOCALTIMESTAMP - make_interval(hours => %s)
+               LIMIT %s FOR UPDATE SKIP LOCKED
+           )""",
+        (IDEMPOTENCY_TTL_HOURS, CLEANUP_BATCH)
+    )
+
+def run(conn: Any, event: Dict[str, Any], scope: str, execute: Callable[[Any], Dict[str, Any]],
+        on_claim: Optional[Callable[[], Optional[Dict[str, Any]]]] = None) -> Dict[str, Any]:
+    '''
+    Выполняет execute(conn) не больше одного раза на (scope, Idempotency-Key).
+    scope включает и действие, и того, от чьего имени запрос: иначе ключи
+    разных пользователей совпадали бы.
+    Без заголовка просто вызывает execute. execute может вызывать
+    conn.commit() - коммит откладывается до сохранения ответа. Ответы 429 и
+    5xx не сохраняются: такой запрос можно повторить с тем же ключом.
+
+    on_claim() вызывается, только когда ключ занят этим запросом, а не найден
+    готовым ответом (в кэше или в базе), - так повтор не тратит лимит частоты.
+    Ответ не None отклоняет запрос и освобождает ключ. Транзакция conn в этот
+    момент держит ключ, поэтому свои коммиты on_claim делает на другом
+    соединении.
+    '''
+    key = request_key(event)
+    if key is None:
+        if on_claim is not None:
+            rejected = on_claim()
+            if rejected is not None:
+                return rejected
+        return execute(conn)
+    if not key or len(key) > KEY_MAX_LENGTH:
+        return http.response(400, {'error': f'Idempotency-Key must be 1..{KEY_MAX_LENGTH} characters'})
+
+    key_id = _uuid(f'{scope}\n{key}')
+    request_hash = _fingerprint(event)
+    cached = response_cache.get(key_id)
+    if cached is not None:
+        return _stored(request_hash, cached)
+
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            "INSERT INTO idempotency_keys (id, request_hash) VALUES (%s, %s) ON CONFLICT (id) DO NOTHING RETURNING id",
+            (key_id, request_hash)
+        )
+        if cur.fetchone() is None:
+            cur.execute("SELECT request_hash::text, status_code, response FROM idempotency_keys WHERE id = %s", (key_id,))
+            stored = cur.fetchone()
+            conn.rollback()
+            response_cache.set(key_id, stored)
+            return _stored(request_hash, stored)
+
+        try:
+            rejected = on_claim() if on_claim is not None else None
+            if rejected is not None:
+                conn.rollback()
+                return rejected
+            result = execute(db.DeferredCommit(conn))
+        except Exception:
+            conn.rollback()
+            raise
+        status = result['statusCode']
+        if status == 429 or status >= 500 or result.get('isBase64Encoded'):
+            conn.rollback()
+            return result
+
+        cur.execute(
+            "UPDATE idempotency_keys SET status_code = %s, response = %s WHERE id = %s",
+            (status, result.get('body') or '', key_id)
+        )
+        if cur.rowcount != 1:
+            # Действие откатило транзакцию вместе с ключом: без него повтор
+            # выполнил бы запись ещё раз, поэтому не коммитим и её
+            conn.rollback()
+            return http.response(500, {'error': 'Idempotency key was not recorded, retry the request'})
+        _cleanup(cur)
+        conn.commit()
+        response_cache.set(key_id, (request_hash, status, result.get('body') or ''))
+        return result
+    finally:
+        cur.close()
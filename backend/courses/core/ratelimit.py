@@ -0,0 +1,148 @@
+'''
+Ограничение частоты запросов token bucket'ами для дорогих и часто
+злоупотребляемых действий: вход, сообщения, заявки в друзья.
+
+Проверка в два шага. Сначала локальная копия bucket'а в памяти контейнера:
+если по ней токенов нет, запрос отклоняется сразу, без базы - другие
+контейнеры токены только тратят, так что общий bucket полнее не бывает.
+Иначе токен списывается в общей таблице rate_limit_buckets функцией
+rate_limit_take, и её остаток становится новой локальной копией.
+
+Если база недоступна, решение принимается по локальной копии: лимитер не
+должен сам становиться причиной отказа.
+'''
+import math
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from core import db, http
+from core.cache import TTLCache
+
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', '1') == '1'
+CLEANUP_INTERVAL = 600.0
+CLEANUP_BATCH = 1000
+STALE_BUCKET_SECONDS = 86400
+BUCKET_KEY_MAX = 200
+
+class Limit:
+    '''
+    Не больше capacity запросов подряд и в среднем capacity за period секунд.
+    '''
+    def __init__(self, name: str, capacity: int, period: float):
+        self.name = name
+        self.capacity = float(capacity)
+        self.rate = capacity / period
+
+_lock = threading.Lock()
+# bucket -> (tokens, monotonic-время замера); вытесненная запись равна полному bucket'у
+_local = TTLCache(maxsize=10000, ttl=3600.0)
+_last_cleanup = 0.0
+_stats: Dict[str, int] = {'local_rejects': 0, 'shared_checks': 0, 'shared_rejects': 0, 'fallbacks': 0}
+
+def bucket_name(limit: Limit, key: Any) -> str:
+    return f'{limit.name}:{str(key).strip().lower()[:BUCKET_KEY_MAX]}'
+
+def _local_tokens(bucket: str, limit: Limit, now: float) -> float:
+    entry = _local.get(bucket)
+    if entry is None:
+        return limit.capacity
+    tokens, measured_at = entry
+    return min(limit.capacity, tokens + (now - measured_at) * limit.rate)
+
+def _take_shared(conn: Any, buckets: List[Tuple[str, Limit]]) -> List[tuple]:
+    global _last_cleanup
+    cur = conn.cursor()
+    cur.execute(
+        """SELECT r.allowed, r.remaining, r.retry_after
+           FROM unnest(%s::text[], %s::float8[], %s::float8[]) WITH ORDINALITY AS t(bucket, capacity, rate, n)
+           CROSS JOIN LATERAL rate_limit_take(t.bucket, t.capacity, t.rate) r
+           ORDER BY t.n""",
+        ([b for b, _ in buckets], [l.capacity for _, l in buckets], [l.rate for _, l in buckets])
+    )
+    rows = cur.fetchall()
+    now = time.monotonic()
+    if now - _last_cleanup > CLEANUP_INTERVAL:
+        _last_cleanup = now
+        # Bucket, не тронутый сутки, давно полон - строка ему не нужна
+        cur.execute(
+            """DELETE FROM rate_limit_buckets WHERE bucket IN (
+                   SELECT bucket FROM rate_limit_buckets
+                   WHERE updated_at < LOCALTIMESTAMP - make_interval(secs => %s)
+                   LIMIT %s FOR UPDATE SKIP LOCKED
+               )""",
+            (STALE_BUCKET_SECONDS, CLEANUP_BATCH)
+        )
+    conn.commit()
+    cur.close()
+    return rows
+
+def check(checks: List[Tuple[Limit, Any]], conn: Optional[Any] = None) -> Optional[float]:
+    '''
+    Списывает по токену из каждого bucket'а (limit, key); ключ None
+    пропускается. Возвращает None, если запрос разрешён, иначе через сколько
+    секунд повторить. conn - соединение вызывающего кода без открытой
+    транзакции: списание коммитится сразу, чтобы не держать блокировку.
+    '''
+    if not RATE_LIMIT_ENABLED:
+        return None
+    # Одинаковый порядок блокировок строк в rate_limit_take у всех вызовов
+    buckets = sorted((bucket_name(limit, key), limit) for limit, key in checks if key is not None)
+    if not buckets:
+        return None
+    now = time.monotonic()
+
+    with _lock:
+        local = [(_local_tokens(b, limit, now), limit) for b, limit in buckets]
+        retry_after = max(((1 - tokens) / limit.rate for tokens, limit in local if tokens < 1), default=0.0)
+        if retry_after:
+            _stats['local_rejects'] += 1
+            return retry_after
+
+    try:
+        if conn is not None:
+            rows = _take_shared(conn, buckets)
+        else:
+            with db.connection() as own_conn:
+                rows = _take_shared(own_conn, buckets)
+    except db.DatabaseError:
+        if conn is not None:
+            conn.rollback()
+        with _lock:
+            _stats['fallbacks'] += 1
+            for (b, limit), (tokens, _) in zip(buckets, local):
+                _local.set(b, (tokens - 1, now))
+        return None
+
+    with _lock:
+        _stats['shared_checks'] += 1
+        for (b, _), (allowed, remaining, _) in zip(buckets, rows):
+            _local.set(b, (remaining, now))
+        retry_after = max((row[2] for row in rows if not row[0]), default=0.0)
+        if retry_after:
+            _stats['shared_rejects'] += 1
+    return retry_after or None
+
+def too_many_requests(retry_after: float) -> Dict[str, Any]:
+    seconds = max(1, math.ceil(retry_after))
+    return http.response(429, {'error': 'Too many requests', 'retry_after': seconds}, {
+        'Retry-After': str(seconds),
+        'Access-Control-Expose-Headers': 'Retry-After'
+    })
+
+def client_ip(event: Dict[str, Any]) -> Optional[str]:
+    '''
+    Адрес клиента от шлюза; X-Forwarded-For - только если шлюз его не передал,
+    потому что заголовок клиент может подставить сам.
+    '''
+    identity = (event.get('requestContext') or {}).get('identity') or {}
+    if identity.get('sourceIp'):
+        return identity['sourceIp']
+    headers = event.get('headers') or {}
+    forwarded = headers.get('X-Forwarded-For') or headers.get('x-forwarded-for')
+    return forwarded.split(',')[0].strip() if forwarded else None
+
+def stats() -> Dict[str, int]:
+    with _lock:
+        return dict(_stats)
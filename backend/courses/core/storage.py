@@ -0,0 +1,189 @@
+'''
+Хранилище файлов с подменяемым backend'ом. Локальный backend пишет в каталог
+на диске (STORAGE_ROOT) и нужен для работы и проверки без облака; другой
+backend подключается через STORAGE_BACKEND и реализует тот же интерфейс.
+
+Диск у каждого контейнера свой, поэтому локальный backend не считается
+общим, если STORAGE_SHARED=1 не говорит, что STORAGE_ROOT - общий том.
+'''
+import json
+import os
+import shutil
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Any, BinaryIO, ContextManager, Dict, Iterator, Optional
+
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'local')
+STORAGE_ROOT = os.environ.get('STORAGE_ROOT', '/tmp/storage')
+STORAGE_PUBLIC_URL = os.environ.get('STORAGE_PUBLIC_URL', 'https://cdn.poehali.dev')
+STORAGE_SHARED = os.environ.get('STORAGE_SHARED') == '1'
+
+class StorageError(Exception):
+    pass
+
+class Storage(ABC):
+    '''
+    Интерфейс хранилища: объекты по ключу и многошаговые загрузки, которые
+    собираются из последовательных чанков и переживают обрыв соединения.
+    Backend без какого-либо из абстрактных методов не создаётся вовсе.
+
+    shared - объекты, записанные одним контейнером, видны всем остальным.
+    '''
+    shared = True
+
+    @abstractmethod
+    def exists(self, key: str) -> bool:
+        ...
+
+    @abstractmethod
+    def put(self, key: str, data: bytes) -> None:
+        ...
+
+    @abstractmethod
+    def open(self, key: str) -> BinaryIO:
+        ...
+
+    @abstractmethod
+    def open_write(self, key: str) -> ContextManager[BinaryIO]:
+        '''
+        Потоковая запись объекта: данные пишутся по мере поступления, объект
+        появляется под ключом только после успешного закрытия.
+        '''
+
+    @abstractmethod
+    def delete(self, key: str) -> None:
+        ...
+
+    def url(self, key: str) -> str:
+        return f'{STORAGE_PUBLIC_URL.rstrip("/")}/{key}'
+
+    def key_for_url(self, url: str) -> Optional[str]:
+        prefix = self.url('')
+        if url and url.startswith(prefix):
+            return url[len(prefix):]
+        return None
+
+    @abstractmethod
+    def create_upload(self, upload_id: str, meta: Dict[str, Any]) -> None:
+        ...
+
+    @abstractmethod
+    def upload_meta(self, upload_id: str) -> Optional[Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    def uploaded_size(self, upload_id: str) -> int:
+        ...
+
+    @abstractmethod
+    def write_chunk(self, upload_id: str, offset: int, data: bytes) -> int:
+        ...
+
+    @abstractmethod
+    def open_upload(self, upload_id: str) -> BinaryIO:
+        ...
+
+    @abstractmethod
+    def complete_upload(self, upload_id: str, key: str) -> None:
+        ...
+
+    @abstractmethod
+    def abort_upload(self, upload_id: str) -> None:
+        ...
+
+class LocalStorage(Storage):
+    shared = STORAGE_SHARED
+
+    def __init__(self, root: str = STORAGE_ROOT):
+        self.root = root
+
+    def _path(self, key: str) -> str:
+        path = os.path.normpath(os.path.join(self.root, key))
+        if not path.startswith(os.path.normpath(self.root) + os.sep):
+            raise StorageError(f'Invalid key: {key}')
+        return path
+
+    def _upload_dir(self, upload_id: str) -> str:
+        return self._path(f'.uploads/{upload_id}')
+
+    def exists(self, key: str) -> bool:
+        return os.path.isfile(self._path(key))
+
+    def put(self, key: str, data: bytes) -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def open(self, key: str) -> BinaryIO:
+        return open(self._path(key), 'rb')
+
+    @contextmanager
+    def open_write(self, key: str) -> Iterator[BinaryIO]:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                yield f
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def delete(self, key: str) -> None:
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def create_upload(self, upload_id: str, meta: Dict[str, Any]) -> None:
+        upload_dir = self._upload_dir(upload_id)
+        os.makedirs(upload_dir, exist_ok=True)
+        with open(os.path.join(upload_dir, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        open(os.path.join(upload_dir, 'data.part'), 'wb').close()
+
+    def upload_meta(self, upload_id: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(os.path.join(self._upload_dir(upload_id), 'meta.json')) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def uploaded_size(self, upload_id: str) -> int:
+        return os.path.getsize(os.path.join(self._upload_dir(upload_id), 'data.part'))
+
+    def write_chunk(self, upload_id: str, offset: int, data: bytes) -> int:
+        part_path = os.path.join(self._upload_dir(upload_id), 'data.part')
+        with open(part_path, 'r+b') as f:
+            f.seek(offset)
+            f.write(data)
+            f.truncate()
+        return offset + len(data)
+
+    def open_upload(self, upload_id: str) -> BinaryIO:
+        return open(os.path.join(self._upload_dir(upload_id), 'data.part'), 'rb')
+
+    def complete_upload(self, upload_id: str, key: str) -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(os.path.join(self._upload_dir(upload_id), 'data.part'), path)
+        self.abort_upload(upload_id)
+
+    def abort_upload(self, upload_id: str) -> None:
+        shutil.rmtree(self._upload_dir(upload_id), ignore_errors=True)
+
+BACKENDS = {'local': LocalStorage}
+
+_storage: Optional[Storage] = None
+
+def get_storage() -> Storage:
+    global _storage
+    if _storage is None:
+        if STORAGE_BACKEND not in BACKENDS:
+            raise StorageError(f'Unknown storage backend: {STORAGE_BACKEND}')
+        _storage = BACKENDS[STORAGE_BACKEND]()
+    return _storage
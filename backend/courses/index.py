@@ -0,0 +1,86 @@
+from typing import Dict, Any
+
+from core import catalog, db, http, snapshots, trace
+from core.cache import TTLCache
+
+CATALOG_MAX_AGE = 300
+
+catalog_cache = TTLCache(maxsize=16, ttl=300.0)
+
+@http.compressible
+@trace.traced
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Business: Каталог курсов - список курсов, целиком или по категории
+    Args: event с httpMethod, queryStringParameters, headers
+    Returns: HTTP response со списком курсов
+    '''
+    method: str = event.get('httpMethod', 'GET')
+    
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'GET, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type, If-None-Match',
+                'Access-Control-Max-Age': '86400'
+            },
+            'body': ''
+        }
+    
+    if method != 'GET':
+        return {
+            'statusCode': 405,
+            'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
+            'body': http.dumps({'error': 'Method not allowed'})
+        }
+    
+    params = event.get('queryStringParameters') or {}
+    category = params.get('category')
+    
+    snapshot = snapshots.serve(event, 'courses', category, CATALOG_MAX_AGE)
+    if snapshot is not None:
+        return snapshot
+    
+    headers = event.get('headers') or {}
+    if_none_match = headers.get('If-None-Match') or headers.get('if-none-match')
+    return db.run_read(lambda conn: courses_response(conn, category, if_none_match))
+
+def courses_response(conn: Any, category: Any, if_none_match: Any) -> Dict[str, Any]:
+    '''
+    Живой запрос, пока снимок курсов не опубликован. ETag тот же, что у
+    снимка той же версии, так что клиенту переход не виден.
+    '''
+    cur = conn.cursor()
+    version = catalog.get_version(cur, 'courses')
+    etag = catalog.make_etag('courses', version, category)
+    cache_headers = {
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Expose-Headers': 'ETag',
+        'ETag': etag,
+        'Cache-Control': f'public, max-age={CATALOG_MAX_AGE}, must-revalidate'
+    }
+    
+    if catalog.etag_matches(if_none_match, etag):
+        cur.close()
+        return {'statusCode': 304, 'headers': cache_headers, 'body': ''}
+    
+    body = catalog_cache.get((version, category))
+    if body is None:
+        if category:
+            cur.execute(
+                f"SELECT {catalog.COURSE_COLUMNS} FROM courses c WHERE c.category = %s ORDER BY c.id",
+                (category,)
+            )
+        else:
+            cur.execute(f"SELECT {catalog.COURSE_COLUMNS} FROM courses c ORDER BY c.id")
+        body = http.dumps({'courses': [catalog.course_from_row(row) for row in cur.fetchall()]})
+        catalog_cache.set((version, category), body)
+    
+    cur.close()
+    return {
+        'statusCode': 200,
+        'headers': {**cache_headers, 'Content-Type': 'application/json'},
+        'body': body
+    }
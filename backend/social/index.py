@@ -1,9 +1,54 @@
+import datetime
 import json
-import os
-import psycopg2
-from psycopg2.extras import RealDictCursor
+import select
+import time
 from typing import Dict, Any
 
+from core import db, http, idempotency, ratelimit, trace
+from core.cache import TTLCache
+
+MESSAGES_PAGE_SIZE = 100
+CONVERSATIONS_LIMIT = 100
+COMPACT_MESSAGE_COLUMNS = ('id', 'sender_id', 'receiver_id', 'message_type', 'content', 'media_url', 'created_at')
+WAIT_TIMEOUT = 25.0
+SUGGESTIONS_LIMIT = 20
+SUGGESTIONS_POOL = 200
+SUGGESTION_MUTUAL_WEIGHT = 10
+SUGGESTION_WORKPLACE_WEIGHT = 15
+BATCH_MAX_ITEMS = 10
+BATCH_ACTIONS = {'search', 'friends', 'requests', 'messages', 'conversations', 'suggestions'}
+SEARCH_MIN_LENGTH = 2
+# В ILIKE '%xx%' нет ни одной полной триграммы, и GIN-индекс не помогает:
+# более короткие запросы ищутся только по префиксу имени
+TRIGRAM_MIN_LENGTH = 3
+AUTOCOMPLETE_LIMIT = 10
+# GET-действия без записей и LISTEN - их можно читать с реплики
+READ_REPLICA_ACTIONS = {'search', 'friends', 'requests', 'conversations', 'suggestions'}
+MESSAGE_LIMIT = ratelimit.Limit('send_message', 30, 30)
+FRIEND_REQUEST_LIMIT = ratelimit.Limit('send_request', 20, 3600)
+# Действие -> (лимит, поле тела с отправителем)
+WRITE_LIMITS = {
+    'send_message': (MESSAGE_LIMIT, 'sender_id'),
+    'send_request': (FRIEND_REQUEST_LIMIT, 'user_id')
+}
+# Записи, которые мобильные клиенты повторяют после таймаута, и поле тела,
+# чьи это ключи: одинаковый Idempotency-Key разных пользователей не должен
+# совпасть. Заявку принимает только её адресат, так что для accept_request
+# владельца ключа задаёт сама заявка
+IDEMPOTENT_ACTIONS = {'send_message': 'sender_id', 'send_request': 'user_id', 'accept_request': 'request_id'}
+# messages разбита на помесячные партиции; переписка читается сначала из последних
+MESSAGES_RECENT_MONTHS = 2
+MESSAGES_PARTITIONS_AHEAD = 3
+MESSAGES_MAINTENANCE_INTERVAL = 3600.0
+MESSAGES_MAINTENANCE_LOCK = 5003
+MESSAGES_MAINTENANCE_LOCK_TIMEOUT = '100ms'
+
+search_cache = TTLCache(maxsize=512, ttl=30.0)
+recent_min_id_cache = TTLCache(maxsize=4, ttl=60.0)
+last_maintenance_at = 0.0
+
+@http.compressible
+@trace.traced
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Единый API для друзей и сообщений - поиск, заявки, чаты
@@ -19,13 +64,57 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, POST, PUT, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
+                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id, Idempotency-Key',
                 'Access-Control-Max-Age': '86400'
             },
             'body': ''
         }
     
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    params = event.get('queryStringParameters') or {}
+    if method == 'GET' and params.get('action', 'search') in READ_REPLICA_ACTIONS:
+        return db.run_read(lambda conn: route(event, conn), sticky_key=params.get('user_id'))
+    
+    with db.connection() as conn:
+        if method == 'POST':
+            body_data = json.loads(event.get('body') or '{}')
+            action = body_data.get('action')
+            if action in IDEMPOTENT_ACTIONS and idempotency.request_key(event) is not None:
+                headers = event.get('headers') or {}
+                owner = headers.get('X-User-Id') or headers.get('x-user-id') or body_data.get(IDEMPOTENT_ACTIONS[action])
+                # Повтор получает сохранённый ответ без лимита и обслуживания;
+                # новый ключ держит транзакцию conn, поэтому они идут на своём соединении
+                return idempotency.run(
+                    conn, event, f'{action}:{owner}', lambda c: route(event, c),
+                    on_claim=lambda: before_write_separately(body_data)
+                )
+            limited = before_write(conn, body_data)
+            if limited is not None:
+                return limited
+        return route(event, conn)
+
+def before_write(conn: Any, body_data: Dict[str, Any]) -> Any:
+    '''
+    Обслуживание партиций и списание лимита перед записью. Оба коммитятся на
+    conn сразу и не держат блокировки всю запись.
+    '''
+    maybe_maintain_partitions(conn)
+    return check_write_limit(conn, body_data)
+
+def before_write_separately(body_data: Dict[str, Any]) -> Any:
+    with db.connection() as conn:
+        return before_write(conn, body_data)
+
+def check_write_limit(conn: Any, body_data: Dict[str, Any]) -> Any:
+    limit = WRITE_LIMITS.get(body_data.get('action'))
+    if limit is None:
+        return None
+    retry_after = ratelimit.check([(limit[0], body_data.get(limit[1]))], conn)
+    return ratelimit.too_many_requests(retry_after) if retry_after else None
+
+def route(event: Dict[str, Any], conn: Any) -> Dict[str, Any]:
+    method: str = event.get('httpMethod', 'GET')
+    from psycopg2.extras import RealDictCursor
+    
     cursor = conn.cursor(cursor_factory=RealDictCursor)
     
     try:
@@ -35,17 +124,17 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             user_id = params.get('user_id')
             
             if action == 'search':
-                search_query = params.get('q', '')
-                cursor.execute(
-                    "SELECT id, username, email, bio, workplace, avatar_url FROM users WHERE username ILIKE %s OR email ILIKE %s LIMIT 20",
-                    (f'%{search_query}%', f'%{search_query}%')
-                )
-                users = cursor.fetchall()
+                search_query = (params.get('q') or '').strip()
+                mode = params.get('mode', 'search')
+                if len(search_query) < SEARCH_MIN_LENGTH:
+                    users = []
+                else:
+                    users = search_users(cursor, search_query, mode)
                 return {
                     'statusCode': 200,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
                     'isBase64Encoded': False,
-                    'body': json.dumps({'users': [dict(u) for u in users]})
+                    'body': http.dumps({'users': users})
                 }
             
             elif action == 'friends':
@@ -61,7 +150,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'statusCode': 200,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
                     'isBase64Encoded': False,
-                    'body': json.dumps({'friends': [dict(f) for f in friends]})
+                    'body': http.dumps({'friends': [dict(f) for f in friends]})
                 }
             
             elif action == 'requests':
@@ -77,44 +166,180 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'statusCode': 200,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
                     'isBase64Encoded': False,
-                    'body': json.dumps({'requests': [dict(r) for r in requests]}, default=str)
+                    'body': http.dumps({'requests': [dict(r) for r in requests]})
+                }
+            
+            elif action == 'conversations':
+                cursor.execute(
+                    """SELECT c.peer_id, u.username AS peer_name, u.avatar_url AS peer_avatar,
+                       c.last_message_id, c.last_message_at, c.last_sender_id,
+                       c.last_message_type, c.last_message_preview, c.unread_count
+                       FROM conversations c
+                       JOIN users u ON u.id = c.peer_id
+                       WHERE c.user_id = %s
+                       ORDER BY c.last_message_at DESC
+                       LIMIT %s""",
+                    (user_id, CONVERSATIONS_LIMIT)
+                )
+                conversations = cursor.fetchall()
+                return {
+                    'statusCode': 200,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'isBase64Encoded': False,
+                    'body': http.dumps({'conversations': [dict(c) for c in conversations]})
+                }
+            
+            elif action == 'wait':
+                try:
+                    after_id = int(params.get('after_id') or 0)
+                    timeout = min(float(params.get('timeout') or WAIT_TIMEOUT), WAIT_TIMEOUT)
+                    user_id = int(user_id)
+                except (TypeError, ValueError):
+                    return {
+                        'statusCode': 400,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'isBase64Encoded': False,
+                        'body': http.dumps({'error': 'user_id required, after_id and timeout must be numbers'})
+                    }
+                messages = wait_for_messages(conn, cursor, user_id, after_id, timeout)
+                return {
+                    'statusCode': 200,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'isBase64Encoded': False,
+                    'body': http.dumps({
+                        'messages': [dict(m) for m in messages],
+                        'after_id': messages[-1]['id'] if messages else after_id
+                    })
+                }
+            
+            elif action == 'suggestions':
+                cursor.execute(
+                    """WITH me AS (
+                         SELECT workplace FROM users WHERE id = %(user)s
+                       ), candidates AS (
+                         -- Друзья и заявки отсеиваются до LIMIT, иначе они занимают весь пул
+                         (SELECT m.candidate_id, m.mutual_count FROM friend_mutuals m
+                          WHERE m.user_id = %(user)s
+                            AND NOT EXISTS (SELECT 1 FROM friendships f WHERE f.user_id = %(user)s AND f.friend_id = m.candidate_id)
+                            AND NOT EXISTS (SELECT 1 FROM friendships f WHERE f.user_id = m.candidate_id AND f.friend_id = %(user)s)
+                          ORDER BY m.mutual_count DESC, m.candidate_id LIMIT %(pool)s)
+                         UNION ALL
+                         (SELECT u.id, 0 FROM users u JOIN me ON u.workplace = me.workplace
+                          WHERE u.id <> %(user)s
+                            AND NOT EXISTS (SELECT 1 FROM friendships f WHERE f.user_id = %(user)s AND f.friend_id = u.id)
+                            AND NOT EXISTS (SELECT 1 FROM friendships f WHERE f.user_id = u.id AND f.friend_id = %(user)s)
+                          ORDER BY u.id LIMIT %(pool)s)
+                       )
+                       SELECT u.id, u.username, u.bio, u.workplace, u.avatar_url,
+                              MAX(c.mutual_count) AS mutual_friends,
+                              COALESCE(u.workplace = me.workplace, false) AS same_workplace
+                       FROM candidates c
+                       JOIN users u ON u.id = c.candidate_id
+                       CROSS JOIN me
+                       GROUP BY u.id, me.workplace
+                       ORDER BY MAX(c.mutual_count) * %(mutual_weight)s
+                                + CASE WHEN u.workplace = me.workplace THEN %(workplace_weight)s ELSE 0 END DESC,
+                                u.id
+                       LIMIT %(limit)s""",
+                    {
+                        'user': user_id, 'pool': SUGGESTIONS_POOL, 'limit': SUGGESTIONS_LIMIT,
+                        'mutual_weight': SUGGESTION_MUTUAL_WEIGHT, 'workplace_weight': SUGGESTION_WORKPLACE_WEIGHT
+                    }
+                )
+                suggestions = cursor.fetchall()
+                return {
+                    'statusCode': 200,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'isBase64Encoded': False,
+                    'body': http.dumps({'suggestions': [dict(u) for u in suggestions]})
                 }
             
             elif action == 'messages':
                 friend_id = params.get('friend_id')
-                cursor.execute(
-                    """SELECT m.*, 
+                try:
+                    pair = sorted((int(user_id), int(friend_id)))
+                    before_id = int(params['before_id']) if params.get('before_id') else None
+                    after_id = int(params['after_id']) if params.get('after_id') else None
+                    limit = min(max(int(params.get('limit') or MESSAGES_PAGE_SIZE), 1), MESSAGES_PAGE_SIZE)
+                except (TypeError, ValueError):
+                    return {
+                        'statusCode': 400,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'isBase64Encoded': False,
+                        'body': http.dumps({'error': 'user_id and friend_id required, cursors and limit must be integers'})
+                    }
+                
+                full_format = params.get('format') == 'full'
+                if full_format:
+                    columns = """m.*,
                        u1.username as sender_name, u1.avatar_url as sender_avatar,
                        u2.username as receiver_name, u2.avatar_url as receiver_avatar
                        FROM messages m
                        JOIN users u1 ON m.sender_id = u1.id
-                       JOIN users u2 ON m.receiver_id = u2.id
-                       WHERE (m.sender_id = %s AND m.receiver_id = %s) 
-                          OR (m.sender_id = %s AND m.receiver_id = %s)
-                       ORDER BY m.created_at ASC
-                       LIMIT 100""",
-                    (user_id, friend_id, friend_id, user_id)
-                )
-                messages = cursor.fetchall()
+                       JOIN users u2 ON m.receiver_id = u2.id"""
+                else:
+                    columns = f"{', '.join('m.' + c for c in COMPACT_MESSAGE_COLUMNS)} FROM messages m"
+                
+                messages = fetch_message_page(cursor, columns, pair, before_id, after_id, limit)
+                has_more = len(messages) > limit
+                messages = messages[:limit]
+                if after_id is None:
+                    messages.reverse()
+                
+                # Прочитанность хранится водяным знаком last_read_message_id в conversations:
+                # одно обновление на чтение вместо перезаписи всех строк переписки
+                received_ids = [m['id'] for m in messages if m['receiver_id'] == int(user_id)]
+                if received_ids:
+                    cursor.execute(
+                        """UPDATE conversations SET
+                             last_read_message_id = GREATEST(last_read_message_id, %(wm)s),
+                             unread_count = CASE
+                               WHEN GREATEST(last_read_message_id, %(wm)s) >= last_message_id THEN 0
+                               ELSE (SELECT COUNT(*) FROM messages m
+                                     WHERE LEAST(m.sender_id, m.receiver_id) = %(low)s
+                                       AND GREATEST(m.sender_id, m.receiver_id) = %(high)s
+                                       AND m.sender_id = %(peer)s
+                                       AND m.id > GREATEST(last_read_message_id, %(wm)s))
+                             END
+                           WHERE user_id = %(user)s AND peer_id = %(peer)s AND last_read_message_id < %(wm)s""",
+                        {'wm': max(received_ids), 'low': pair[0], 'high': pair[1], 'user': user_id, 'peer': friend_id}
+                    )
+                    conn.commit()
                 
                 cursor.execute(
-                    "UPDATE messages SET is_read = true WHERE receiver_id = %s AND sender_id = %s",
-                    (user_id, friend_id)
+                    "SELECT user_id, last_read_message_id FROM conversations WHERE (user_id, peer_id) IN ((%s, %s), (%s, %s))",
+                    (user_id, friend_id, friend_id, user_id)
                 )
-                conn.commit()
+                watermarks = {row['user_id']: row['last_read_message_id'] for row in cursor.fetchall()}
+                for m in messages:
+                    m['is_read'] = m['id'] <= watermarks.get(m['receiver_id'], 0)
+                
+                if full_format:
+                    payload = {'messages': [dict(m) for m in messages]}
+                else:
+                    cursor.execute("SELECT id, username, avatar_url FROM users WHERE id IN (%s, %s)", tuple(pair))
+                    payload = compact_messages(messages, cursor.fetchall())
                 
                 return {
                     'statusCode': 200,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
                     'isBase64Encoded': False,
-                    'body': json.dumps({'messages': [dict(m) for m in messages]}, default=str)
+                    'body': http.dumps({
+                        **payload,
+                        'has_more': has_more,
+                        'before_id': messages[0]['id'] if messages else before_id,
+                        'after_id': messages[-1]['id'] if messages else after_id
+                    })
                 }
         
         elif method == 'POST':
             body_data = json.loads(event.get('body', '{}'))
             action = body_data.get('action')
             
-            if action == 'send_request':
+            if action == 'batch':
+                return run_batch(event, conn, body_data.get('requests') or [])
+            
+            elif action == 'send_request':
                 user_id = body_data.get('user_id')
                 friend_id = body_data.get('friend_id')
                 cursor.execute(
@@ -122,40 +347,53 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     (user_id, friend_id)
                 )
                 conn.commit()
+                db.mark_written(user_id, friend_id)
                 return {
                     'statusCode': 200,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
                     'isBase64Encoded': False,
-                    'body': json.dumps({'success': True, 'message': 'Заявка отправлена'})
+                    'body': http.dumps({'success': True, 'message': 'Заявка отправлена'})
                 }
             
             elif action == 'accept_request':
                 request_id = body_data.get('request_id')
-                cursor.execute("UPDATE friendships SET status = 'accepted' WHERE id = %s", (request_id,))
-                cursor.execute("SELECT user_id, friend_id FROM friendships WHERE id = %s", (request_id,))
+                cursor.execute(
+                    "UPDATE friendships SET status = 'accepted' WHERE id = %s AND status <> 'accepted' RETURNING user_id, friend_id",
+                    (request_id,)
+                )
                 friendship = cursor.fetchone()
                 if friendship:
                     cursor.execute(
-                        "INSERT INTO friendships (user_id, friend_id, status) VALUES (%s, %s, 'accepted') ON CONFLICT DO NOTHING",
+                        """INSERT INTO friendships (user_id, friend_id, status) VALUES (%s, %s, 'accepted')
+                           ON CONFLICT (user_id, friend_id) DO UPDATE SET status = 'accepted'""",
                         (friendship['friend_id'], friendship['user_id'])
                     )
+                    add_mutual_friends(cursor, friendship['user_id'], friendship['friend_id'])
                 conn.commit()
+                if friendship:
+                    db.mark_written(friendship['user_id'], friendship['friend_id'])
                 return {
                     'statusCode': 200,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
                     'isBase64Encoded': False,
-                    'body': json.dumps({'success': True, 'message': 'Заявка принята'})
+                    'body': http.dumps({'success': True, 'message': 'Заявка принята'})
                 }
             
             elif action == 'reject_request':
                 request_id = body_data.get('request_id')
-                cursor.execute("UPDATE friendships SET status = 'rejected' WHERE id = %s", (request_id,))
+                cursor.execute(
+                    "UPDATE friendships SET status = 'rejected' WHERE id = %s RETURNING user_id, friend_id",
+                    (request_id,)
+                )
+                friendship = cursor.fetchone()
                 conn.commit()
+                if friendship:
+                    db.mark_written(friendship['user_id'], friendship['friend_id'])
                 return {
                     'statusCode': 200,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
                     'isBase64Encoded': False,
-                    'body': json.dumps({'success': True, 'message': 'Заявка отклонена'})
+                    'body': http.dumps({'success': True, 'message': 'Заявка отклонена'})
                 }
             
             elif action == 'send_message':
@@ -171,13 +409,47 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     (sender_id, receiver_id, message_type, content, media_url)
                 )
                 new_message = cursor.fetchone()
+                
+                # Сводка диалога у обоих участников: у получателя растёт счётчик непрочитанных.
+                # Строки блокируются по возрастанию user_id - встречные сообщения A и B
+                # ждут друг друга, а не взаимоблокируются. Последнее сообщение заменяется
+                # только более новым: меньший id может закоммититься позже
+                cursor.execute(
+                    """INSERT INTO conversations
+                       (user_id, peer_id, last_message_id, last_message_at, last_sender_id,
+                        last_message_type, last_message_preview, unread_count)
+                       SELECT v.user_id, v.peer_id, %(id)s, %(at)s, %(sender)s, %(type)s, LEFT(%(content)s, 200), v.unread
+                       FROM (VALUES (%(sender)s, %(receiver)s, 0), (%(receiver)s, %(sender)s, 1)) AS v(user_id, peer_id, unread)
+                       ORDER BY v.user_id
+                       ON CONFLICT (user_id, peer_id) DO UPDATE SET
+                         last_message_id = GREATEST(conversations.last_message_id, EXCLUDED.last_message_id),
+                         last_message_at = CASE WHEN EXCLUDED.last_message_id > conversations.last_message_id
+                           THEN EXCLUDED.last_message_at ELSE conversations.last_message_at END,
+                         last_sender_id = CASE WHEN EXCLUDED.last_message_id > conversations.last_message_id
+                           THEN EXCLUDED.last_sender_id ELSE conversations.last_sender_id END,
+                         last_message_type = CASE WHEN EXCLUDED.last_message_id > conversations.last_message_id
+                           THEN EXCLUDED.last_message_type ELSE conversations.last_message_type END,
+                         last_message_preview = CASE WHEN EXCLUDED.last_message_id > conversations.last_message_id
+                           THEN EXCLUDED.last_message_preview ELSE conversations.last_message_preview END,
+                         unread_count = conversations.unread_count + EXCLUDED.unread_count""",
+                    {
+                        'sender': sender_id, 'receiver': receiver_id, 'id': new_message['id'],
+                        'at': new_message['created_at'], 'type': message_type, 'content': content
+                    }
+                )
+                # Будим long-poll получателя; уведомление уходит только при коммите
+                cursor.execute(
+                    "SELECT pg_notify(%s, %s)",
+                    (notify_channel(receiver_id), json.dumps({'id': new_message['id'], 'sender_id': sender_id}))
+                )
                 conn.commit()
+                db.mark_written(sender_id, receiver_id)
                 
                 return {
                     'statusCode': 200,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
                     'isBase64Encoded': False,
-                    'body': json.dumps({
+                    'body': http.dumps({
                         'success': True,
                         'message_id': new_message['id'],
                         'created_at': str(new_message['created_at'])
@@ -188,9 +460,305 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'statusCode': 405,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
             'isBase64Encoded': False,
-            'body': json.dumps({'error': 'Method not allowed'})
+            'body': http.dumps({'error': 'Method not allowed'})
         }
     
     finally:
         cursor.close()
-        conn.close()
+
+
+def like_pattern(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def search_users(cursor: Any, search_query: str, mode: str) -> list:
+    '''
+    Поиск по триграммным индексам из V0005. Режим autocomplete ранжирует
+    совпадения по префиксу имени выше нечётких; частые префиксы отдаются
+    из in-process кэша. Запросы короче TRIGRAM_MIN_LENGTH идут только по
+    префиксному индексу idx_users_username_prefix.
+    '''
+    cache_key = (mode, search_query.lower())
+    cached = search_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    
+    escaped = like_pattern(search_query)
+    columns = 'id, username, avatar_url' if mode == 'autocomplete' else 'id, username, email, bio, workplace, avatar_url'
+    if len(search_query) < TRIGRAM_MIN_LENGTH:
+        cursor.execute(
+            f"""SELECT {columns}
+               FROM users
+               WHERE lower(username) LIKE lower(%s)
+               ORDER BY lower(username)
+               LIMIT %s""",
+            (escaped + '%', AUTOCOMPLETE_LIMIT if mode == 'autocomplete' else 20)
+        )
+    elif mode == 'autocomplete':
+        cursor.execute(
+            """SELECT id, username, avatar_url
+               FROM users
+               WHERE lower(username) LIKE lower(%s) OR username %% %s
+               ORDER BY lower(username) LIKE lower(%s) DESC,
+                        similarity(username, %s) DESC,
+                        username
+               LIMIT %s""",
+            (escaped + '%', search_query, escaped + '%', search_query, AUTOCOMPLETE_LIMIT)
+        )
+    else:
+        cursor.execute(
+            "SELECT id, username, email, bio, workplace, avatar_url FROM users WHERE username ILIKE %s OR email ILIKE %s LIMIT 20",
+            (f'%{escaped}%', f'%{escaped}%')
+        )
+    users = [dict(u) for u in cursor.fetchall()]
+    search_cache.set(cache_key, users)
+    return users
+
+def add_mutual_friends(cursor: Any, user_a: int, user_b: int) -> None:
+    '''
+    Инкрементально обновляет friend_mutuals после новой дружбы A-B: каждый
+    друг A получает общего друга с B, каждый друг B - с A. Обновляются
+    только строки соседей пары, без пересчёта всего графа. Пары, которые
+    уже дружат, в таблице не держатся - сами A и B из неё удаляются.
+    '''
+    cursor.execute(
+        """INSERT INTO friend_mutuals (user_id, candidate_id, mutual_count)
+           SELECT p.user_id, p.candidate_id, 1 FROM (
+             SELECT f.friend_id, %(b)s FROM friendships f
+             WHERE f.user_id = %(a)s AND f.status = 'accepted' AND f.friend_id <> %(b)s
+             UNION ALL
+             SELECT %(b)s, f.friend_id FROM friendships f
+             WHERE f.user_id = %(a)s AND f.status = 'accepted' AND f.friend_id <> %(b)s
+             UNION ALL
+             SELECT f.friend_id, %(a)s FROM friendships f
+             WHERE f.user_id = %(b)s AND f.status = 'accepted' AND f.friend_id <> %(a)s
+             UNION ALL
+             SELECT %(a)s, f.friend_id FROM friendships f
+             WHERE f.user_id = %(b)s AND f.status = 'accepted' AND f.friend_id <> %(a)s
+           ) AS p(user_id, candidate_id)
+           WHERE NOT EXISTS (
+             SELECT 1 FROM friendships f
+             WHERE f.user_id = p.user_id AND f.friend_id = p.candidate_id AND f.status = 'accepted'
+           )
+           ON CONFLICT (user_id, candidate_id) DO UPDATE
+           SET mutual_count = friend_mutuals.mutual_count + 1""",
+        {'a': user_a, 'b': user_b}
+    )
+    cursor.execute(
+        "DELETE FROM friend_mutuals WHERE (user_id, candidate_id) IN ((%(a)s, %(b)s), (%(b)s, %(a)s))",
+        {'a': user_a, 'b': user_b}
+    )
+
+def compact_messages(messages: list, users: list) -> Dict[str, Any]:
+    '''
+    Компактная страница переписки: профили собеседников один раз в users,
+    в сообщениях только id и нужные поля, пустые поля опускаются.
+    '''
+    return {
+        'users': {str(u['id']): {'username': u['username'], 'avatar_url': u['avatar_url']} for u in users},
+        'messages': [{k: v for k, v in m.items() if v is not None} for m in messages]
+    }
+
+def notify_channel(user_id: Any) -> str:
+    return f'chat_user_{int(user_id)}'
+
+def fetch_new_messages(cursor: Any, user_id: int, after_id: int) -> list:
+    # Курсор внутри недавнего окна - старые партиции можно не трогать
+    boundary = recent_boundary()
+    window = 'AND created_at >= %s' if after_id >= recent_min_id(cursor, boundary) else ''
+    cursor.execute(
+        f"""SELECT id, sender_id, receiver_id, message_type, content, media_url, sticker_id, created_at
+           FROM messages
+           WHERE receiver_id = %s AND id > %s {window}
+           ORDER BY id
+           LIMIT %s""",
+        (user_id, after_id, *((boundary,) if window else ()), MESSAGES_PAGE_SIZE)
+    )
+    return cursor.fetchall()
+
+def recent_boundary() -> datetime.datetime:
+    '''
+    Начало окна недавних партиций: первое число месяца MESSAGES_RECENT_MONTHS - 1
+    месяцев назад. Граница влияет только на то, сколько партиций затронет
+    запрос, но не на его результат.
+    '''
+    today = datetime.date.today()
+    month = today.year * 12 + today.month - 1 - (MESSAGES_RECENT_MONTHS - 1)
+    return datetime.datetime(month // 12, month % 12 + 1, 1)
+
+def recent_min_id(cursor: Any, boundary: datetime.datetime) -> float:
+    '''
+    Наименьший id в недавнем окне (бесконечность, если окно пусто). id растут
+    вместе с created_at, поэтому курсор меньше этого id указывает в историю.
+    Пустое окно не кэшируется: первое же новое сообщение его заполнит, а
+    закэшированная бесконечность отрезала бы его от страниц с before_id.
+    '''
+    min_id = recent_min_id_cache.get(boundary)
+    if min_id is None:
+        cursor.execute("SELECT MIN(id) AS min_id FROM messages WHERE created_at >= %s", (boundary,))
+        min_id = cursor.fetchone()['min_id']
+        if min_id is None:
+            return float('inf')
+        recent_min_id_cache.set(boundary, min_id)
+    return min_id
+
+def fetch_message_page(cursor: Any, columns: str, pair: list, before_id: Any, after_id: Any, limit: int) -> list:
+    '''
+    До limit + 1 сообщений переписки по индексу idx_messages_conversation:
+    последние без курсора, более старые до before_id, новые после after_id.
+    
+    Сначала читаются только партиции недавнего окна, старые - если страница
+    там не набралась или курсор сам указывает в историю. Строки по обе
+    стороны границы объединяются и сортируются по id, так что страница та
+    же, что и без отсечения; растёт история - число затронутых партиций нет.
+    '''
+    if after_id is not None:
+        cursor_filter, order, cursor_id = 'AND m.id > %s', 'ASC', after_id
+    elif before_id is not None:
+        cursor_filter, order, cursor_id = 'AND m.id < %s', 'DESC', before_id
+    else:
+        cursor_filter, order, cursor_id = '', 'DESC', None
+    boundary = recent_boundary()
+    min_id = recent_min_id(cursor, boundary)
+
+    def window(condition: str) -> list:
+        cursor.execute(
+            f"""SELECT {columns}
+               WHERE LEAST(m.sender_id, m.receiver_id) = %s
+                 AND GREATEST(m.sender_id, m.receiver_id) = %s
+                 {cursor_filter}
+                 AND m.created_at {condition} %s
+               ORDER BY m.id {order}
+               LIMIT %s""",
+            (pair[0], pair[1], *(() if cursor_id is None else (cursor_id,)), boundary, limit + 1)
+        )
+        return cursor.fetchall()
+    
+    if order == 'DESC':
+        messages = [] if cursor_id is not None and cursor_id <= min_id else window('>=')
+        if len(messages) <= limit:
+            messages += window('<')
+    else:
+        messages = window('>=')
+        if cursor_id < min_id:
+            messages += window('<')
+    messages.sort(key=lambda m: m['id'], reverse=order == 'DESC')
+    return messages[:limit + 1]
+
+def maybe_maintain_partitions(conn: Any) -> None:
+    '''
+    Создание партиций messages на месяцы вперёд не чаще раза в
+    MESSAGES_MAINTENANCE_INTERVAL на контейнер, по пути записи. Архивирование
+    старых месяцев (DETACH) сюда не входит - это действие maintain_messages
+    в админке.
+    '''
+    global last_maintenance_at
+    now = time.monotonic()
+    if now - last_maintenance_at < MESSAGES_MAINTENANCE_INTERVAL:
+        return
+    last_maintenance_at = now
+    try:
+        create_future_partitions(conn)
+    except db.DatabaseError:
+        conn.rollback()
+
+def create_future_partitions(conn: Any) -> list:
+    '''
+    messages_maintain без срока хранения только создаёт недостающие месяцы.
+    Advisory lock не даёт двум контейнерам делать это одновременно, а
+    lock_timeout не даёт запросу пользователя встать в очередь блокировок
+    messages: не дождались - пропускаем, месяцы создаются заранее.
+    '''
+    cur = conn.cursor()
+    cur.execute("SELECT pg_try_advisory_xact_lock(%s)", (MESSAGES_MAINTENANCE_LOCK,))
+    if not cur.fetchone()[0]:
+        conn.rollback()
+        cur.close()
+        return []
+    cur.execute("SELECT set_config('lock_timeout', %s, true)", (MESSAGES_MAINTENANCE_LOCK_TIMEOUT,))
+    cur.execute("SELECT action, partition_name FROM messages_maintain(%s, 0)", (MESSAGES_PARTITIONS_AHEAD,))
+    actions = [{'action': row[0], 'partition': row[1]} for row in cur.fetchall()]
+    conn.commit()
+    cur.close()
+    return actions
+
+def wait_for_messages(conn: Any, cursor: Any, user_id: int, after_id: int, timeout: float) -> list:
+    '''
+    Long-poll новых входящих сообщений после after_id. Подписка LISTEN
+    оформляется до первой проверки, чтобы не потерять сообщение между ними;
+    пока сообщений нет, соединение просто ждёт NOTIFY без запросов к базе.
+    '''
+    channel = notify_channel(user_id)
+    conn.commit()
+    conn.autocommit = True
+    try:
+        cursor.execute(f'LISTEN {channel}')
+        messages = fetch_new_messages(cursor, user_id, after_id)
+        deadline = time.monotonic() + timeout
+        while not messages:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            ready, _, _ = select.select([conn], [], [], remaining)
+            if not ready:
+                break
+            conn.poll()
+            if conn.notifies:
+                conn.notifies.clear()
+                messages = fetch_new_messages(cursor, user_id, after_id)
+        return messages
+    finally:
+        cursor.execute('UNLISTEN *')
+        conn.autocommit = False
+
+def run_batch(event: Dict[str, Any], conn: Any, items: list) -> Dict[str, Any]:
+    '''
+    Выполняет несколько GET-действий за один вызов функции на одном соединении
+    в одной транзакции REPEATABLE READ. Каждый под-запрос изолирован
+    SAVEPOINT'ом, так что ошибка одного не ломает остальные.
+    '''
+    if not isinstance(items, list) or not items or len(items) > BATCH_MAX_ITEMS:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'isBase64Encoded': False,
+            'body': http.dumps({'error': f'requests must be a list of 1..{BATCH_MAX_ITEMS} items'})
+        }
+    
+    conn.commit()
+    cursor = conn.cursor()
+    cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+    batch_conn = db.DeferredCommit(conn)
+    parts = []
+    
+    for item in items:
+        action = item.get('action') if isinstance(item, dict) else None
+        if action not in BATCH_ACTIONS:
+            parts.append(http.dumps({'action': action, 'status': 400, 'body': {'error': 'Action not allowed in batch'}}))
+            continue
+        
+        sub_event = {
+            'httpMethod': 'GET',
+            'headers': event.get('headers') or {},
+            'queryStringParameters': {k: str(v) for k, v in item.items() if v is not None}
+        }
+        cursor.execute('SAVEPOINT batch_item')
+        try:
+            result = route(sub_event, batch_conn)
+            cursor.execute('RELEASE SAVEPOINT batch_item')
+        except db.DatabaseError as e:
+            cursor.execute('ROLLBACK TO SAVEPOINT batch_item')
+            result = {'statusCode': 500, 'body': http.dumps({'error': e.pgerror or str(e)})}
+        
+        # Тела под-ответов уже сериализованы - вклеиваем их без повторного разбора
+        parts.append('{"action":%s,"status":%d,"body":%s}' % (
+            http.dumps(action), result['statusCode'], result.get('body') or 'null'
+        ))
+    
+    conn.commit()
+    cursor.close()
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'isBase64Encoded': False,
+        'body': '{"results":[' + ','.join(parts) + ']}'
+    }
@@ -0,0 +1,63 @@
+'''
+Версии read-mostly каталогов (звуки, курсы). Версия растёт при каждой записи
+из админки в той же транзакции и служит ETag для публичных ответов. Здесь же
+общий вид строк каталогов - его используют и живые запросы, и снимки.
+'''
+import hashlib
+from typing import Any, Dict, Optional
+
+SOUND_COLUMNS = 's.id, s.title, s.description, s.file_url, s.category, s.downloads_count, s.duration_seconds, s.waveform_peaks, s.loudness_db'
+COURSE_COLUMNS = 'c.id, c.title, c.category, c.description, c.cover_url, c.status, c.created_at'
+
+def get_version(cur: Any, name: str) -> int:
+    cur.execute("SELECT version FROM catalog_versions WHERE name = %s", (name,))
+    row = cur.fetchone()
+    if not row:
+        return 0
+    return row['version'] if isinstance(row, dict) else row[0]
+
+def bump_version(cur: Any, name: str) -> None:
+    cur.execute(
+        """INSERT INTO catalog_versions (name, version, updated_at) VALUES (%s, 1, CURRENT_TIMESTAMP)
+           ON CONFLICT (name) DO UPDATE
+           SET version = catalog_versions.version + 1, updated_at = CURRENT_TIMESTAMP""",
+        (name,)
+    )
+
+def make_etag(name: str, version: int, variant: Optional[str] = None) -> str:
+    tag = f'{name}-{version}'
+    if variant:
+        tag += '-' + hashlib.sha1(variant.encode()).hexdigest()[:12]
+    return f'"{tag}"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    candidates = [c.strip() for c in if_none_match.split(',')]
+    return etag in candidates or f'W/{etag}' in candidates
+
+def sound_from_row(row: Any) -> Dict[str, Any]:
+    return {
+        'id': row[0],
+        'title': row[1],
+        'description': row[2],
+        'file_url': row[3],
+        'category': row[4],
+        'downloads_count': row[5],
+        'duration_seconds': row[6],
+        'waveform_peaks': row[7],
+        'loudness_db': row[8]
+    }
+
+def course_from_row(row: Any) -> Dict[str, Any]:
+    return {
+        'id': row[0],
+        'title': row[1],
+        'category': row[2],
+        'description': row[3],
+        'cover_url': row[4],
+        'status': row[5],
+        'created_at': row[6].isoformat() if row[6] else None
+    }
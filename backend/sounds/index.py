@@ -1,8 +1,32 @@
+import base64
 import json
 import os
-from typing import Dict, Any
-import psycopg2
+import time
+from typing import Dict, Any, Optional
 
+from core import catalog, db, http, snapshots, trace
+from core.cache import TTLCache
+
+CATALOG_MAX_AGE = 60
+DOWNLOAD_FLUSH_INTERVAL = float(os.environ.get('DOWNLOAD_FLUSH_INTERVAL', '30'))
+DOWNLOAD_FLUSH_BATCH = 10000
+DOWNLOAD_FLUSH_LOCK = 5001
+DOWNLOAD_VERSION_INTERVAL = float(os.environ.get('DOWNLOAD_VERSION_INTERVAL', '600'))
+SEARCH_PARAMS = ('q', 'sort', 'cursor', 'limit')
+SEARCH_PAGE_SIZE = 30
+SEARCH_MAX_PAGE_SIZE = 100
+SEARCH_SORTS = {
+    'popular': ('s.downloads_count', 'integer'),
+    'new': ('s.created_at', 'timestamp'),
+    'relevance': ('ts_rank(s.search_vector, query)', 'real')
+}
+
+catalog_cache = TTLCache(maxsize=64, ttl=300.0)
+search_cache = TTLCache(maxsize=256, ttl=60.0)
+last_flush_at = 0.0
+
+@http.compressible
+@trace.traced
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Управление звуками для WB PVZ (получение списка, увеличение счетчика скачиваний)
@@ -17,13 +41,16 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type',
+                'Access-Control-Allow-Headers': 'Content-Type, If-None-Match',
                 'Access-Control-Max-Age': '86400'
             },
             'body': ''
         }
     
     if method == 'GET':
+        params = event.get('queryStringParameters') or {}
+        if params.get('action') == 'download_stats':
+            return get_download_stats()
         return get_sounds(event)
     elif method == 'POST':
         return increment_download(event)
@@ -31,44 +58,161 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         return {
             'statusCode': 405,
             'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-            'body': json.dumps({'error': 'Method not allowed'})
+            'body': http.dumps({'error': 'Method not allowed'})
         }
 
+def encode_cursor(sort: str, value: Any, sound_id: int) -> str:
+    if hasattr(value, 'isoformat'):
+        value = value.isoformat()
+    raw = json.dumps([sort, value, sound_id], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(raw: str, sort: str) -> tuple:
+    try:
+        cursor_sort, value, sound_id = json.loads(base64.urlsafe_b64decode(raw + '=' * (-len(raw) % 4)))
+        sound_id = int(sound_id)
+    except (ValueError, TypeError):
+        raise ValueError('Invalid cursor')
+    if cursor_sort != sort:
+        raise ValueError('Cursor does not match sort')
+    return value, sound_id
+
+def parse_search(params: Dict[str, Any]) -> Dict[str, Any]:
+    '''
+    Параметры постраничного поиска: q - полнотекстовый запрос, sort -
+    popular|new|relevance (relevance только вместе с q и по умолчанию для него),
+    limit - размер страницы, cursor - next_cursor предыдущей страницы.
+    '''
+    q = (params.get('q') or '').strip() or None
+    sort = params.get('sort') or ('relevance' if q else 'new')
+    if sort not in SEARCH_SORTS or (sort == 'relevance' and not q):
+        raise ValueError('sort must be popular, new or relevance (with q)')
+    try:
+        limit = int(params.get('limit') or SEARCH_PAGE_SIZE)
+    except ValueError:
+        raise ValueError('limit must be a number')
+    limit = min(max(limit, 1), SEARCH_MAX_PAGE_SIZE)
+    cursor = decode_cursor(params['cursor'], sort) if params.get('cursor') else None
+    return {'q': q, 'sort': sort, 'limit': limit, 'cursor': cursor}
+
+def search_page(cur: Any, category: Any, search: Dict[str, Any]) -> Dict[str, Any]:
+    '''
+    Страница каталога по ключу (sort_value, id) и, для первой страницы,
+    счётчики по категориям среди всех найденных звуков - одним запросом.
+    '''
+    sort_expr, sort_type = SEARCH_SORTS[search['sort']]
+    source = 'wb_sounds s'
+    match = 'TRUE'
+    match_params = []
+    if search['q']:
+        source += ", websearch_to_tsquery('russian', %s) query"
+        match = 's.search_vector @@ query'
+        match_params = [search['q']]
+    
+    page_where = [match]
+    page_params = list(match_params)
+    if category:
+        page_where.append('s.category = %s')
+        page_params.append(category)
+    if search['cursor']:
+        page_where.append(f'({sort_expr}, s.id) < (%s::{sort_type}, %s)')
+        page_params.extend(search['cursor'])
+    page_params.append(search['limit'] + 1)
+    page_sql = (
+        f"SELECT {catalog.SOUND_COLUMNS}, {sort_expr} AS sort_value FROM {source} "
+        f"WHERE {' AND '.join(page_where)} ORDER BY {sort_expr} DESC, s.id DESC LIMIT %s"
+    )
+    
+    if search['cursor'] is None:
+        cur.execute(
+            f"""SELECT c.categories, p.*
+                FROM (
+                    SELECT json_agg(json_build_object('category', category, 'count', n) ORDER BY n DESC, category) AS categories
+                    FROM (SELECT s.category, COUNT(*) AS n FROM {source} WHERE {match} GROUP BY s.category) grouped
+                ) c
+                LEFT JOIN LATERAL ({page_sql}) p ON TRUE""",
+            match_params + page_params
+        )
+    else:
+        cur.execute(f"SELECT NULL::json AS categories, p.* FROM ({page_sql}) p", page_params)
+    rows = cur.fetchall()
+    
+    found = [row for row in rows if row[1] is not None]
+    has_more = len(found) > search['limit']
+    found = found[:search['limit']]
+    result = {
+        'sounds': [catalog.sound_from_row(row[1:10]) for row in found],
+        'next_cursor': encode_cursor(search['sort'], found[-1][10], found[-1][1]) if has_more else None
+    }
+    if search['cursor'] is None:
+        result['categories'] = (rows[0][0] if rows else None) or []
+    return result
+
 def get_sounds(event: Dict[str, Any]) -> Dict[str, Any]:
     params = event.get('queryStringParameters') or {}
     category = params.get('category')
+    headers = event.get('headers') or {}
+    if_none_match = headers.get('If-None-Match') or headers.get('if-none-match')
+    
+    # Без параметров поиска отдаётся весь каталог, как раньше
+    search = None
+    variant = category
+    if any(params.get(k) for k in SEARCH_PARAMS):
+        try:
+            search = parse_search(params)
+        except ValueError as e:
+            return {
+                'statusCode': 400,
+                'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
+                'body': http.dumps({'error': str(e)})
+            }
+        variant = json.dumps([category, search['q'], search['sort'], search['limit'], search['cursor']], default=str)
     
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    if search is None:
+        # Весь каталог и категории отдаются из опубликованного снимка без базы
+        snapshot = snapshots.serve(event, 'sounds', category, CATALOG_MAX_AGE)
+        if snapshot is not None:
+            return snapshot
+    return db.run_read(lambda conn: catalog_response(conn, category, search, variant, if_none_match))
+
+def catalog_response(conn: Any, category: Any, search: Optional[Dict[str, Any]], variant: Any, if_none_match: Any) -> Dict[str, Any]:
     cur = conn.cursor()
+    version = catalog.get_version(cur, 'sounds')
+    etag = catalog.make_etag('sounds', version, variant)
+    cache_headers = {
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Expose-Headers': 'ETag',
+        'ETag': etag,
+        'Cache-Control': f'public, max-age={CATALOG_MAX_AGE}, must-revalidate'
+    }
     
-    if category:
-        cur.execute(
-            "SELECT id, title, description, file_url, category, downloads_count FROM wb_sounds WHERE category = %s ORDER BY created_at DESC",
-            (category,)
-        )
-    else:
-        cur.execute(
-            "SELECT id, title, description, file_url, category, downloads_count FROM wb_sounds ORDER BY created_at DESC"
-        )
+    if catalog.etag_matches(if_none_match, etag):
+        cur.close()
+        return {'statusCode': 304, 'headers': cache_headers, 'body': ''}
     
-    sounds = []
-    for row in cur.fetchall():
-        sounds.append({
-            'id': row[0],
-            'title': row[1],
-            'description': row[2],
-            'file_url': row[3],
-            'category': row[4],
-            'downloads_count': row[5]
-        })
+    cache = catalog_cache if search is None else search_cache
+    body = cache.get((version, variant))
+    if body is None:
+        if search is not None:
+            body = http.dumps(search_page(cur, category, search))
+        else:
+            if category:
+                cur.execute(
+                    f"SELECT {catalog.SOUND_COLUMNS} FROM wb_sounds s WHERE s.category = %s ORDER BY s.created_at DESC",
+                    (category,)
+                )
+            else:
+                cur.execute(
+                    f"SELECT {catalog.SOUND_COLUMNS} FROM wb_sounds s ORDER BY s.created_at DESC"
+                )
+            body = http.dumps({'sounds': [catalog.sound_from_row(row) for row in cur.fetchall()]})
+        cache.set((version, variant), body)
     
     cur.close()
-    conn.close()
-    
     return {
         'statusCode': 200,
-        'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-        'body': json.dumps({'sounds': sounds})
+        'headers': {**cache_headers, 'Content-Type': 'application/json'},
+        'body': body
     }
 
 def increment_download(event: Dict[str, Any]) -> Dict[str, Any]:
@@ -79,22 +223,135 @@ def increment_download(event: Dict[str, Any]) -> Dict[str, Any]:
         return {
             'statusCode': 400,
             'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-            'body': json.dumps({'error': 'sound_id required'})
+            'body': http.dumps({'error': 'sound_id required'})
         }
     
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    with db.connection() as conn:
+        cur = conn.cursor()
+        
+        cur.execute("INSERT INTO sound_download_events (sound_id) VALUES (%s)", (sound_id,))
+        conn.commit()
+        cur.close()
+        maybe_flush_downloads(conn)
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
+        'body': http.dumps({'success': True})
+    }
+
+def maybe_flush_downloads(conn: Any) -> None:
+    '''
+    Сворачивает скачивания не чаще раза в DOWNLOAD_FLUSH_INTERVAL. Вызывается
+    только из записи скачивания: чтения каталога (и 304 по ETag) не трогают
+    основной сервер и таблицу wb_sounds.
+    '''
+    global last_flush_at
+    now = time.monotonic()
+    if now - last_flush_at < DOWNLOAD_FLUSH_INTERVAL:
+        return
+    last_flush_at = now
+    flush_downloads_quietly(conn)
+
+def flush_downloads_quietly(conn: Any) -> None:
+    try:
+        flush_downloads(conn)
+    except db.DatabaseError:
+        conn.rollback()
+
+def flush_downloads(conn: Any) -> Dict[str, Any]:
+    '''
+    Сворачивает накопленные события скачиваний в wb_sounds.downloads_count
+    одним UPDATE на пачку. Advisory lock не даёт двум контейнерам сворачивать
+    одновременно; каждая непустая пачка пишется в sound_download_flushes.
+    
+    Версию каталога (а с ней ETag) счётчики меняют не чаще раза в
+    DOWNLOAD_VERSION_INTERVAL, иначе каждый flush сбрасывал бы 304 у клиентов.
+    Отложенные счётчики догоняет следующий flush, даже пустой. Снимок
+    каталога отсюда не публикуется: новая версия уводит чтения в живой
+    запрос до следующей публикации из админки.
+    '''
     cur = conn.cursor()
+    cur.execute("SELECT pg_try_advisory_xact_lock(%s)", (DOWNLOAD_FLUSH_LOCK,))
+    if not cur.fetchone()[0]:
+        conn.rollback()
+        cur.close()
+        return {'events': 0, 'sounds': 0, 'skipped': True}
     
     cur.execute(
-        "UPDATE wb_sounds SET downloads_count = downloads_count + 1 WHERE id = %s",
-        (sound_id,)
+        """WITH batch AS (
+               DELETE FROM sound_download_events
+               WHERE id IN (SELECT id FROM sound_download_events ORDER BY id LIMIT %s)
+               RETURNING sound_id, created_at
+           ), totals AS (
+               SELECT sound_id, COUNT(*) AS n FROM batch GROUP BY sound_id
+           ), updated AS (
+               UPDATE wb_sounds s SET downloads_count = s.downloads_count + t.n
+               FROM totals t WHERE s.id = t.sound_id
+               RETURNING s.id
+           )
+           SELECT (SELECT COUNT(*) FROM batch),
+                  (SELECT COUNT(*) FROM updated),
+                  (SELECT EXTRACT(EPOCH FROM LOCALTIMESTAMP - MIN(created_at)) FROM batch)""",
+        (DOWNLOAD_FLUSH_BATCH,)
     )
+    events, sounds, max_lag = cur.fetchone()
+    
+    if events:
+        cur.execute(
+            """INSERT INTO sound_download_flushes (events_count, sounds_count, max_lag_seconds, interval_seconds)
+               VALUES (%s, %s, %s, EXTRACT(EPOCH FROM LOCALTIMESTAMP - (SELECT MAX(flushed_at) FROM sound_download_flushes)))""",
+            (events, sounds, max_lag)
+        )
+    cur.execute(
+        """UPDATE catalog_versions SET version = version + 1, updated_at = CURRENT_TIMESTAMP
+           WHERE name = 'sounds'
+             AND updated_at < LOCALTIMESTAMP - make_interval(secs => %s)
+             AND updated_at < (SELECT flushed_at FROM sound_download_flushes
+                               WHERE sounds_count > 0 ORDER BY id DESC LIMIT 1)""",
+        (DOWNLOAD_VERSION_INTERVAL,)
+    )
+    version_bumped = cur.rowcount > 0
     conn.commit()
     cur.close()
-    conn.close()
+    
+    return {
+        'events': events,
+        'sounds': sounds,
+        'max_lag_seconds': float(max_lag) if max_lag is not None else None,
+        'version_bumped': version_bumped
+    }
+
+def get_download_stats() -> Dict[str, Any]:
+    with db.connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """SELECT COUNT(*), EXTRACT(EPOCH FROM LOCALTIMESTAMP - MIN(created_at))
+               FROM sound_download_events"""
+        )
+        pending, pending_lag = cur.fetchone()
+        cur.execute(
+            """SELECT flushed_at, events_count, sounds_count, max_lag_seconds, interval_seconds
+               FROM sound_download_flushes ORDER BY id DESC LIMIT 20"""
+        )
+        flushes = [{
+            'flushed_at': row[0].isoformat() if row[0] else None,
+            'events': row[1],
+            'sounds': row[2],
+            'max_lag_seconds': row[3],
+            'interval_seconds': row[4]
+        } for row in cur.fetchall()]
+        cur.close()
     
     return {
         'statusCode': 200,
         'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-        'body': json.dumps({'success': True})
+        'body': http.dumps({
+            'pending_events': pending,
+            'pending_lag_seconds': float(pending_lag) if pending_lag is not None else None,
+            'flush_interval_seconds': DOWNLOAD_FLUSH_INTERVAL,
+            'flush_batch_size': DOWNLOAD_FLUSH_BATCH,
+            'version_interval_seconds': DOWNLOAD_VERSION_INTERVAL,
+            'recent_flushes': flushes
+        })
     }
@@ -0,0 +1,265 @@
+import hashlib
+import json
+from typing import Dict, Any
+
+from core import catalog, db, http, trace
+from core.cache import TTLCache
+
+CATALOG_MAX_AGE = 60
+MANIFEST_MAX_AGE = 60
+IMMUTABLE_MAX_AGE = 31536000
+
+catalog_cache = TTLCache(maxsize=1, ttl=CATALOG_MAX_AGE)
+manifest_cache = TTLCache(maxsize=512, ttl=3600.0)
+
+@http.compressible
+@trace.traced
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Business: Магазин стикеров - каталог паков, содержимое пака, паки пользователя и покупка за FMonet
+    Args: event с httpMethod, body, queryStringParameters, headers
+    Returns: HTTP response с паками, манифестом или результатом покупки
+    '''
+    method: str = event.get('httpMethod', 'GET')
+    
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type, If-None-Match',
+                'Access-Control-Max-Age': '86400'
+            },
+            'body': ''
+        }
+    
+    headers = event.get('headers') or {}
+    if_none_match = headers.get('If-None-Match') or headers.get('if-none-match')
+    
+    if method == 'GET':
+        params = event.get('queryStringParameters') or {}
+        action = params.get('action', 'catalog')
+        if action == 'catalog':
+            return get_catalog(if_none_match)
+        elif action == 'pack':
+            return get_pack(params.get('pack_id'), params.get('v'), if_none_match)
+        elif action == 'owned':
+            return get_owned(params.get('user_id'))
+    elif method == 'POST':
+        body_data = json.loads(event.get('body') or '{}')
+        if body_data.get('action') == 'purchase':
+            return purchase_pack(body_data.get('user_id'), body_data.get('pack_id'))
+    else:
+        return {
+            'statusCode': 405,
+            'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
+            'body': http.dumps({'error': 'Method not allowed'})
+        }
+    
+    return {
+        'statusCode': 400,
+        'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
+        'body': http.dumps({'error': 'Invalid action'})
+    }
+
+def load_catalog(conn: Any) -> str:
+    cur = conn.cursor()
+    cur.execute(
+        """SELECT p.id, p.title, p.description, p.preview_url, p.price, p.manifest_hash,
+                  jsonb_array_length(p.manifest->'stickers'), u.username,
+                  (SELECT COUNT(*) FROM sticker_purchases sp WHERE sp.pack_id = p.id) AS purchases
+           FROM sticker_packs p
+           JOIN users u ON u.id = p.creator_id
+           ORDER BY purchases DESC, p.id DESC"""
+    )
+    packs = [{
+        'id': row[0],
+        'title': row[1],
+        'description': row[2],
+        'preview_url': row[3],
+        'price': row[4],
+        'manifest_hash': row[5],
+        'stickers_count': row[6] or 0,
+        'creator': row[7],
+        'downloads_count': row[8]
+    } for row in cur.fetchall()]
+    cur.close()
+    return http.dumps({'packs': packs})
+
+def get_catalog(if_none_match: Any) -> Dict[str, Any]:
+    '''
+    Список паков. Тело собирается раз в CATALOG_MAX_AGE секунд на контейнер,
+    ETag - хэш тела, так что счётчики покупок обновляются без версий каталога.
+    '''
+    cached = catalog_cache.get('catalog')
+    if cached is None:
+        body = db.run_read(load_catalog)
+        etag = '"stickers-' + hashlib.sha1(body.encode()).hexdigest()[:16] + '"'
+        cached = (body, etag)
+        catalog_cache.set('catalog', cached)
+    body, etag = cached
+    
+    cache_headers = {
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Expose-Headers': 'ETag',
+        'ETag': etag,
+        'Cache-Control': f'public, max-age={CATALOG_MAX_AGE}, must-revalidate'
+    }
+    if catalog.etag_matches(if_none_match, etag):
+        return {'statusCode': 304, 'headers': cache_headers, 'body': ''}
+    return {
+        'statusCode': 200,
+        'headers': {**cache_headers, 'Content-Type': 'application/json'},
+        'body': body
+    }
+
+def load_manifest(conn: Any, pack_id: int) -> Any:
+    cur = conn.cursor()
+    cur.execute("SELECT manifest_hash, manifest::text FROM sticker_packs WHERE id = %s", (pack_id,))
+    row = cur.fetchone()
+    cur.close()
+    return row
+
+def get_pack(pack_id: Any, version: Any, if_none_match: Any) -> Dict[str, Any]:
+    '''
+    Манифест пака - готовый JSON из sticker_packs.manifest, отдаётся как есть.
+    Запрос с ?v=<manifest_hash> из каталога неизменяем: такой ответ кэшируется
+    навсегда и при повторе обслуживается из памяти без обращения к базе.
+    '''
+    try:
+        pack_id = int(pack_id)
+    except (TypeError, ValueError):
+        return http.response(400, {'error': 'pack_id required'})
+    
+    cached = manifest_cache.get((pack_id, version)) if version else None
+    if cached is None:
+        row = db.run_read(lambda conn: load_manifest(conn, pack_id))
+        if not row:
+            return http.response(404, {'error': 'Pack not found'})
+        cached = (row[0], row[1])
+        manifest_cache.set((pack_id, row[0]), cached)
+    manifest_hash, body = cached
+    
+    if version == manifest_hash:
+        cache_control = f'public, max-age={IMMUTABLE_MAX_AGE}, immutable'
+    else:
+        cache_control = f'public, max-age={MANIFEST_MAX_AGE}, must-revalidate'
+    cache_headers = {
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Expose-Headers': 'ETag',
+        'ETag': f'"{manifest_hash}"',
+        'Cache-Control': cache_control
+    }
+    if catalog.etag_matches(if_none_match, cache_headers['ETag']):
+        return {'statusCode': 304, 'headers': cache_headers, 'body': ''}
+    return {
+        'statusCode': 200,
+        'headers': {**cache_headers, 'Content-Type': 'application/json'},
+        'body': body
+    }
+
+def load_owned(conn: Any, user_id: int) -> Any:
+    cur = conn.cursor()
+    cur.execute(
+        """SELECT u.fmonet_balance,
+                  COALESCE(json_agg(json_build_object(
+                      'pack_id', p.pack_id, 'manifest_hash', sp.manifest_hash, 'purchased_at', p.purchased_at
+                  ) ORDER BY p.purchased_at DESC) FILTER (WHERE p.id IS NOT NULL), '[]')
+           FROM users u
+           LEFT JOIN sticker_purchases p ON p.user_id = u.id
+           LEFT JOIN sticker_packs sp ON sp.id = p.pack_id
+           WHERE u.id = %s
+           GROUP BY u.id""",
+        (user_id,)
+    )
+    row = cur.fetchone()
+    cur.close()
+    return row
+
+def get_owned(user_id: Any) -> Dict[str, Any]:
+    '''
+    Паки пользователя вместе с балансом одним запросом. Ответ личный и не
+    кэшируется; манифесты клиент берёт по manifest_hash из кэша.
+    '''
+    try:
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        return http.response(400, {'error': 'user_id required'})
+    
+    row = db.run_read(lambda conn: load_owned(conn, user_id), sticky_key=user_id)
+    if not row:
+        return http.response(404, {'error': 'User not found'})
+    return {
+        'statusCode': 200,
+        'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json', 'Cache-Control': 'no-store'},
+        'body': http.dumps({'balance': row[0], 'packs': row[1]})
+    }
+
+def purchase_pack(user_id: Any, pack_id: Any) -> Dict[str, Any]:
+    '''
+    Покупка одним оператором в одной транзакции. Сначала вставляется строка
+    покупки: уникальный ключ (user_id, pack_id) ставит параллельные покупки
+    того же пака в очередь, и повтор ничего не списывает. Затем баланс
+    списывается условным UPDATE по заблокированной строке пользователя;
+    если денег не хватило, транзакция откатывается вместе с покупкой.
+    '''
+    try:
+        user_id = int(user_id)
+        pack_id = int(pack_id)
+    except (TypeError, ValueError):
+        return http.response(400, {'error': 'user_id and pack_id required'})
+    
+    with db.connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """WITH pack AS (
+                   SELECT id, price, manifest_hash FROM sticker_packs WHERE id = %(pack)s
+               ), purchase AS (
+                   INSERT INTO sticker_purchases (user_id, pack_id)
+                   SELECT %(user)s, id FROM pack
+                   WHERE EXISTS (SELECT 1 FROM users WHERE id = %(user)s)
+                   ON CONFLICT (user_id, pack_id) DO NOTHING
+                   RETURNING pack_id
+               ), debit AS (
+                   UPDATE users u SET fmonet_balance = u.fmonet_balance - pack.price
+                   FROM pack, purchase
+                   WHERE u.id = %(user)s AND u.fmonet_balance >= pack.price
+                   RETURNING u.fmonet_balance
+               )
+               SELECT (SELECT manifest_hash FROM pack),
+                      EXISTS (SELECT 1 FROM pack),
+                      EXISTS (SELECT 1 FROM purchase),
+                      (SELECT fmonet_balance FROM debit),
+                      (SELECT COALESCE(fmonet_balance, 0) FROM users WHERE id = %(user)s)""",
+            {'user': user_id, 'pack': pack_id}
+        )
+        manifest_hash, pack_exists, purchased, new_balance, balance = cur.fetchone()
+        
+        if not pack_exists:
+            conn.rollback()
+            cur.close()
+            return http.response(404, {'error': 'Pack not found'})
+        if balance is None:
+            conn.rollback()
+            cur.close()
+            return http.response(404, {'error': 'User not found'})
+        if purchased and new_balance is None:
+            conn.rollback()
+            cur.close()
+            return http.response(402, {'error': 'Недостаточно FMonet'})
+        conn.commit()
+        cur.close()
+    db.mark_written(user_id)
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
+        'body': http.dumps({
+            'success': True,
+            'already_owned': not purchased,
+            'pack_id': pack_id,
+            'manifest_hash': manifest_hash,
+            'balance': new_balance if purchased else balance
+        })
+    }
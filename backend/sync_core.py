@@ -0,0 +1,77 @@
+'''
+Раскладывает общий пакет backend/core по каталогам функций.
+
+Каждая функция деплоится только своим каталогом backend/<функция>, и
+`from core import ...` в развёрнутой функции находит лишь копию, лежащую
+рядом с index.py. Источник - backend/core; копии в backend/<функция>/core
+генерируются этим скриптом, коммитятся вместе с правкой и руками не правятся.
+
+    python backend/sync_core.py          # обновить копии после правки core
+    python backend/sync_core.py --check  # проверить, что копии совпадают с core
+'''
+import argparse
+import filecmp
+import os
+import shutil
+import sys
+from typing import List
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+CORE_DIR = os.path.join(BACKEND_DIR, 'core')
+
+def functions() -> List[str]:
+    return sorted(
+        name for name in os.listdir(BACKEND_DIR)
+        if name != 'core' and os.path.isfile(os.path.join(BACKEND_DIR, name, 'index.py'))
+    )
+
+def core_files(path: str) -> List[str]:
+    if not os.path.isdir(path):
+        return []
+    return sorted(f for f in os.listdir(path) if f.endswith('.py'))
+
+def stale_copies() -> List[str]:
+    '''
+    Файлы копий, которые отличаются от core, отсутствуют или лишние.
+    '''
+    expected = core_files(CORE_DIR)
+    problems = []
+    for function in functions():
+        target = os.path.join(BACKEND_DIR, function, 'core')
+        actual = core_files(target)
+        for name in sorted(set(expected) | set(actual)):
+            path = os.path.join(target, name)
+            if name not in expected or name not in actual or not filecmp.cmp(os.path.join(CORE_DIR, name), path, shallow=False):
+                problems.append(os.path.relpath(path, BACKEND_DIR))
+    return problems
+
+def sync() -> List[str]:
+    expected = core_files(CORE_DIR)
+    changed = stale_copies()
+    for function in functions():
+        target = os.path.join(BACKEND_DIR, function, 'core')
+        os.makedirs(target, exist_ok=True)
+        for name in core_files(target):
+            if name not in expected:
+                os.remove(os.path.join(target, name))
+        for name in expected:
+            shutil.copyfile(os.path.join(CORE_DIR, name), os.path.join(target, name))
+    return changed
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--check', action='store_true', help='only report copies that differ from backend/core')
+    args = parser.parse_args()
+
+    if args.check:
+        problems = stale_copies()
+        for path in problems:
+            print(f'out of sync: {path}')
+        if problems:
+            sys.exit('Run python backend/sync_core.py and commit the copies')
+        return
+    for path in sync():
+        print(f'updated: {path}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+'''
+Статические снимки read-mostly каталогов (звуки, курсы). После записи каталог
+целиком рендерится в JSON под своей версией, рядом кладутся заранее сжатые
+.gz и .br, и только потом указатель latest.json переключается на новую версию.
+
+Публичные чтения берут версию из указателя, а тело - готовым файлом из
+хранилища; живой запрос нужен, только если снимка нет или он отстал от
+catalog_versions. ETag у снимка тот же, что у живого ответа той же версии.
+
+Снимки публикует только админка и только в общее хранилище: в хранилище
+отдельного контейнера их не увидят остальные, а свой latest.json там
+быстро устаревает.
+'''
+import base64
+import datetime
+import gzip
+import hashlib
+import json
+import os
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from core import catalog, db, http
+from core.cache import TTLCache
+from core.storage import StorageError, get_storage
+
+SNAPSHOT_PREFIX = 'snapshots'
+SNAPSHOT_POINTER_TTL = float(os.environ.get('SNAPSHOT_POINTER_TTL', '5'))
+SNAPSHOT_KEEP_VERSIONS = 3
+SNAPSHOT_PUBLISH_LOCK = 5002
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 11
+SUFFIXES = {'br': '.json.br', 'gzip': '.json.gz', None: '.json'}
+
+# Указатель перечитывается раз в SNAPSHOT_POINTER_TTL секунд на контейнер,
+# файлы версий неизменяемы и кэшируются дольше
+pointer_cache = TTLCache(maxsize=16, ttl=SNAPSHOT_POINTER_TTL)
+# Версия каталога для сверки с указателем - с тем же шагом
+version_cache = TTLCache(maxsize=16, ttl=SNAPSHOT_POINTER_TTL)
+file_cache = TTLCache(maxsize=64, ttl=3600.0)
+
+Variants = Dict[Optional[str], Dict[str, Any]]
+
+def by_category(items: List[Dict[str, Any]], key: str) -> Variants:
+    variants: Variants = {None: {key: items}}
+    for item in items:
+        if item['category']:
+            variants.setdefault(item['category'], {key: []})[key].append(item)
+    return variants
+
+def render_sounds(cur: Any) -> Tuple[int, Variants]:
+    # Версия и строки одним запросом - из одного снимка базы
+    cur.execute(
+        f"""SELECT v.version, {catalog.SOUND_COLUMNS}
+            FROM (SELECT COALESCE((SELECT version FROM catalog_versions WHERE name = 'sounds'), 0) AS version) v
+            LEFT JOIN wb_sounds s ON TRUE
+            ORDER BY s.created_at DESC"""
+    )
+    rows = cur.fetchall()
+    sounds = [catalog.sound_from_row(row[1:]) for row in rows if row[1] is not None]
+    return rows[0][0], by_category(sounds, 'sounds')
+
+def render_courses(cur: Any) -> Tuple[int, Variants]:
+    cur.execute(
+        f"""SELECT v.version, {catalog.COURSE_COLUMNS}
+            FROM (SELECT COALESCE((SELECT version FROM catalog_versions WHERE name = 'courses'), 0) AS version) v
+            LEFT JOIN courses c ON TRUE
+            ORDER BY c.id"""
+    )
+    rows = cur.fetchall()
+    courses = [catalog.course_from_row(row[1:]) for row in rows if row[1] is not None]
+    return rows[0][0], by_category(courses, 'courses')
+
+RENDERERS: Dict[str, Callable[[Any], Tuple[int, Variants]]] = {
+    'sounds': render_sounds,
+    'courses': render_courses
+}
+
+def pointer_key(name: str) -> str:
+    return f'{SNAPSHOT_PREFIX}/{name}/latest.json'
+
+def file_key(name: str, version: int, variant: Optional[str]) -> str:
+    slug = 'category-' + hashlib.sha1(variant.encode()).hexdigest()[:12] if variant else 'all'
+    return f'{SNAPSHOT_PREFIX}/{name}/v{version}/{slug}'
+
+def read_pointer(name: str) -> Optional[Dict[str, Any]]:
+    try:
+        with get_storage().open(pointer_key(name)) as f:
+            return json.load(f)
+    except (OSError, StorageError, ValueError):
+        return None
+
+def current_pointer(name: str) -> Optional[Dict[str, Any]]:
+    pointer = pointer_cache.get(name)
+    if pointer is None:
+        # Отсутствие снимка тоже кэшируется, пустым словарём
+        pointer = read_pointer(name) or {}
+        pointer_cache.set(name, pointer)
+    return pointer or None
+
+def current_version(name: str) -> int:
+    version = version_cache.get(name)
+    if version is None:
+        version = db.run_read(lambda conn: catalog.get_version(conn.cursor(), name))
+        version_cache.set(name, version)
+    return version
+
+def publish(conn: Any, name: str, force: bool = False) -> Optional[int]:
+    '''
+    Рендерит и публикует снимок каталога name. Вызывается после commit записи.
+    Advisory lock выстраивает публикации в очередь, поэтому указатель не
+    откатывается на старую версию; уже опубликованная версия пропускается,
+    если не передан force. Возвращает опубликованную версию или None - в том
+    числе без общего хранилища, где снимки не публикуются.
+    '''
+    storage = get_storage()
+    if not storage.shared:
+        return None
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (SNAPSHOT_PUBLISH_LOCK,))
+        version, variants = RENDERERS[name](cur)
+        previous = read_pointer(name)
+        if previous and (previous['version'] > version or (previous['version'] == version and not force)):
+            return None
+
+        encodings = ['br', 'gzip'] if http.brotli is not None else ['gzip']
+        files: Dict[str, str] = {}
+        written: List[str] = []
+        for variant, payload in variants.items():
+            key = file_key(name, version, variant)
+            raw = http.dumps(payload).encode('utf-8')
+            blobs = {None: raw, 'gzip': gzip.compress(raw, compresslevel=GZIP_LEVEL, mtime=0)}
+            if 'br' in encodings:
+                blobs['br'] = http.brotli.compress(raw, quality=BROTLI_QUALITY)
+            for encoding, data in blobs.items():
+                storage.put(key + SUFFIXES[encoding], data)
+                written.append(key + SUFFIXES[encoding])
+            files[variant or ''] = key
+
+        history = [[version, written]] + [
+            entry for entry in (previous or {}).get('history', []) if entry[0] != version
+        ]
+        pointer = {
+            'version': version,
+            'published_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'encodings': encodings,
+            'variants': files,
+            'history': history[:SNAPSHOT_KEEP_VERSIONS]
+        }
+        storage.put(pointer_key(name), json.dumps(pointer).encode('utf-8'))
+        pointer_cache.set(name, pointer)
+        version_cache.set(name, version)
+
+        for _, keys in history[SNAPSHOT_KEEP_VERSIONS:]:
+            for key in keys:
+                storage.delete(key)
+        return version
+    finally:
+        conn.rollback()
+        cur.close()
+
+def publish_quietly(conn: Any, name: str) -> None:
+    '''
+    Публикация, которая не ломает уже закоммиченную запись. Если снимок
+    выпустить не удалось, указатель удаляется: пусть лучше чтения уйдут в
+    живой запрос, чем отдают устаревший каталог.
+    '''
+    try:
+        publish(conn, name)
+    except (OSError, StorageError, db.DatabaseError):
+        conn.rollback()
+        pointer_cache.pop(name)
+        try:
+            get_storage().delete(pointer_key(name))
+        except (OSError, StorageError):
+            pass
+
+def read_file(key: str) -> bytes:
+    data = file_cache.get(key)
+    if data is None:
+        with get_storage().open(key) as f:
+            data = f.read()
+        file_cache.set(key, data)
+    return data
+
+def serve(event: Dict[str, Any], name: str, variant: Optional[str], max_age: int) -> Optional[Dict[str, Any]]:
+    '''
+    Ответ из опубликованного снимка: 304 по ETag или готовый файл в лучшей
+    кодировке из Accept-Encoding. None, если хранилище не общее, снимка или
+    варианта нет, или снимок старше версии каталога в базе - например, после
+    сворачивания скачиваний, до следующей публикации из админки.
+    '''
+    storage = get_storage()
+    if not storage.shared:
+        return None
+    pointer = current_pointer(name)
+    key = pointer['variants'].get(variant or '') if pointer else None
+    if not key or pointer['version'] != current_version(name):
+        return None
+
+    etag = catalog.make_etag(name, pointer['version'], variant)
+    cache_headers = {
+        **http.CORS_HEADERS,
+        'Access-Control-Expose-Headers': 'ETag, X-Snapshot-Url',
+        'ETag': etag,
+        'Cache-Control': f'public, max-age={max_age}, must-revalidate',
+        'Vary': 'Accept-Encoding',
+        'X-Snapshot-Url': storage.url(key + SUFFIXES[None])
+    }
+    headers = event.get('headers') or {}
+    if catalog.etag_matches(headers.get('If-None-Match') or headers.get('if-none-match'), etag):
+        return {'statusCode': 304, 'headers': cache_headers, 'body': ''}
+
+    accepted = http.accepted_encodings(event)
+    encoding = next((e for e in pointer.get('encodings', []) if accepted.get(e, 0) > 0), None)
+    try:
+        data = read_file(key + SUFFIXES[encoding])
+    except (OSError, StorageError):
+        return None
+
+    if encoding is None:
+        return {
+            'statusCode': 200,
+            'headers': {**cache_headers, 'Content-Type': 'application/json'},
+            'isBase64Encoded': False,
+            'body': data.decode('utf-8')
+        }
+    return {
+        'statusCode': 200,
+        'headers': {**cache_headers, 'Content-Type': 'application/json', 'Content-Encoding': encoding},
+        'isBase64Encoded': True,
+        'body': base64.b64encode(data).decode('ascii')
+    }
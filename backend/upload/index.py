@@ -1,16 +1,31 @@
 import json
 import base64
-import uuid
+import hashlib
 import os
+import re
+import uuid
 from typing import Dict, Any
 
+from core import audio, catalog, db, http, trace
+from core.storage import get_storage, StorageError
+
 ADMIN_PASSWORD = "2501"
 
+CHUNK_SIZE = 2 * 1024 * 1024
+MAX_CHUNK_SIZE = 5 * 1024 * 1024
+MAX_FILE_SIZE = 100 * 1024 * 1024
+HASH_BLOCK_SIZE = 1024 * 1024
+
+UPLOAD_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+SHA256_RE = re.compile(r'^[0-9a-f]{64}$')
+
+@http.compressible
+@trace.traced
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
-    Business: Загрузка аудиофайлов для звуков WB PVZ
-    Args: event с httpMethod, body, headers
-    Returns: HTTP response с URL загруженного файла
+    Business: Загрузка аудиофайлов для звуков WB PVZ - целиком или по чанкам с докачкой
+    Args: event с httpMethod, body, headers, queryStringParameters
+    Returns: HTTP response с URL загруженного файла или состоянием загрузки
     '''
     method: str = event.get('httpMethod', 'POST')
     
@@ -19,52 +34,220 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'statusCode': 200,
             'headers': {
                 'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS',
+                'Access-Control-Allow-Methods': 'GET, POST, PUT, OPTIONS',
                 'Access-Control-Allow-Headers': 'Content-Type, X-Admin-Password',
                 'Access-Control-Max-Age': '86400'
             },
             'body': ''
         }
     
-    if method != 'POST':
-        return {
-            'statusCode': 405,
-            'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-            'body': json.dumps({'error': 'Method not allowed'})
-        }
+    if method not in ('GET', 'POST', 'PUT'):
+        return http.response(405, {'error': 'Method not allowed'})
     
     headers = event.get('headers', {})
     admin_password = headers.get('X-Admin-Password') or headers.get('x-admin-password')
     
     if admin_password != ADMIN_PASSWORD:
-        return {
-            'statusCode': 401,
-            'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-            'body': json.dumps({'error': 'Unauthorized'})
-        }
+        return http.response(401, {'error': 'Unauthorized'})
+    
+    params = event.get('queryStringParameters') or {}
+    
+    if method == 'PUT':
+        return put_chunk(event, params)
+    if method == 'GET':
+        return upload_status(params)
     
-    body_data = json.loads(event.get('body', '{}'))
+    body_data = json.loads(event.get('body') or '{}')
+    action = params.get('action') or body_data.get('action')
+    
+    if action == 'init':
+        return init_upload(body_data)
+    elif action == 'complete':
+        return complete_upload(body_data)
+    elif action == 'abort':
+        return abort_upload(body_data)
+    return upload_whole(body_data)
+
+def file_ext(filename: str) -> str:
+    ext = filename.rsplit('.', 1)[-1].lower() if '.' in filename else 'mp3'
+    return ext if re.match(r'^[a-z0-9]{1,8}$', ext) else 'mp3'
+
+def content_key(sha256: str, ext: str) -> str:
+    return f'sounds/{sha256}.{ext}'
+
+def stored_file(key: str, sha256: str, deduplicated: bool) -> Dict[str, Any]:
+    storage = get_storage()
+    analysis = process_upload(key)
+    status = audio.analysis_status(analysis)
+    return http.response(200, {
+        'file_url': storage.url(key),
+        'filename': key.split('/')[-1],
+        'sha256': sha256,
+        'deduplicated': deduplicated,
+        'analysis': analysis if status == 'done' else None,
+        'analysis_status': status,
+        'analysis_error': analysis.get('error')
+    })
+
+def process_upload(key: str) -> Dict[str, Any]:
+    '''
+    Анализ файла прямо в запросе загрузки: после ответа контейнер могут
+    заморозить, и фоновая работа не доделается. Размер анализируемого файла
+    ограничен audio.ANALYSIS_MAX_SIZE. Результат сохраняется в базе по URL
+    файла и проставляется звукам, уже ссылающимся на него; звуки, созданные
+    позже, админка заполнит из той же таблицы. Уже проанализированный файл
+    не разбирается заново.
+    '''
+    storage = get_storage()
+    file_url = storage.url(key)
+    with db.connection() as conn:
+        cur = conn.cursor()
+        analysis = audio.load_analysis(cur, file_url)
+        # Транзакция не держится открытой, пока идёт анализ
+        conn.rollback()
+        if analysis is None:
+            analysis = audio.analyze_stored(storage, key)
+            changed = audio.save_analysis(cur, file_url, analysis)
+            if changed:
+                catalog.bump_version(cur, 'sounds')
+            conn.commit()
+        cur.close()
+    return analysis
+
+def upload_whole(body_data: Dict[str, Any]) -> Dict[str, Any]:
     file_content = body_data.get('file')
     filename = body_data.get('filename', 'audio.mp3')
     
     if not file_content:
-        return {
-            'statusCode': 400,
-            'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-            'body': json.dumps({'error': 'File content required'})
-        }
+        return http.response(400, {'error': 'File content required'})
+    
+    # Размер проверяется до декодирования: base64 длиннее файла на треть
+    encoded = file_content.split(',', 1)[-1]
+    if len(encoded) // 4 * 3 > MAX_FILE_SIZE:
+        return http.response(400, {'error': f'File must be at most {MAX_FILE_SIZE} bytes'})
+    try:
+        data = base64.b64decode(encoded, validate=False)
+    except ValueError:
+        return http.response(400, {'error': 'File must be base64 encoded'})
+    if not data or len(data) > MAX_FILE_SIZE:
+        return http.response(400, {'error': f'File must be between 1 and {MAX_FILE_SIZE} bytes'})
+    
+    sha256 = hashlib.sha256(data).hexdigest()
+    key = content_key(sha256, file_ext(filename))
+    storage = get_storage()
+    if storage.exists(key):
+        return stored_file(key, sha256, True)
+    storage.put(key, data)
+    return stored_file(key, sha256, False)
+
+def init_upload(body_data: Dict[str, Any]) -> Dict[str, Any]:
+    filename = body_data.get('filename', 'audio.mp3')
+    size = body_data.get('size')
+    sha256 = (body_data.get('sha256') or '').lower()
+    
+    if not isinstance(size, int) or size <= 0 or size > MAX_FILE_SIZE:
+        return http.response(400, {'error': f'size must be between 1 and {MAX_FILE_SIZE} bytes'})
+    if sha256 and not SHA256_RE.match(sha256):
+        return http.response(400, {'error': 'sha256 must be a hex digest'})
+    
+    ext = file_ext(filename)
+    storage = get_storage()
+    
+    if sha256 and storage.exists(content_key(sha256, ext)):
+        return stored_file(content_key(sha256, ext), sha256, True)
+    
+    upload_id = uuid.uuid4().hex
+    storage.create_upload(upload_id, {'filename': filename, 'ext': ext, 'size': size, 'sha256': sha256})
+    return http.response(200, {'upload_id': upload_id, 'chunk_size': CHUNK_SIZE, 'received': 0, 'size': size})
+
+def load_upload(upload_id: str):
+    if not UPLOAD_ID_RE.match(upload_id or ''):
+        return None
+    return get_storage().upload_meta(upload_id)
+
+def upload_status(params: Dict[str, Any]) -> Dict[str, Any]:
+    upload_id = params.get('upload_id', '')
+    meta = load_upload(upload_id)
+    if meta is None:
+        return http.response(404, {'error': 'Upload not found'})
+    return http.response(200, {
+        'upload_id': upload_id,
+        'received': get_storage().uploaded_size(upload_id),
+        'size': meta['size'],
+        'chunk_size': CHUNK_SIZE
+    })
+
+def put_chunk(event: Dict[str, Any], params: Dict[str, Any]) -> Dict[str, Any]:
+    '''
+    Принимает очередной чанк тела запроса как есть (бинарное тело приходит
+    с isBase64Encoded). Повтор уже принятого чанка подтверждается без записи,
+    чанк с пропуском отклоняется с текущим received для докачки.
+    '''
+    upload_id = params.get('upload_id', '')
+    meta = load_upload(upload_id)
+    if meta is None:
+        return http.response(404, {'error': 'Upload not found'})
+    
+    try:
+        offset = int(params.get('offset', ''))
+    except ValueError:
+        return http.response(400, {'error': 'offset required'})
+    
+    body = event.get('body') or ''
+    try:
+        data = base64.b64decode(body) if event.get('isBase64Encoded') else body.encode()
+    except ValueError:
+        return http.response(400, {'error': 'Chunk body must be valid base64'})
+    if not data or len(data) > MAX_CHUNK_SIZE:
+        return http.response(400, {'error': f'Chunk must be between 1 and {MAX_CHUNK_SIZE} bytes'})
+    
+    storage = get_storage()
+    received = storage.uploaded_size(upload_id)
+    
+    if offset + len(data) <= received:
+        return http.response(200, {'upload_id': upload_id, 'received': received, 'size': meta['size']})
+    if offset != received:
+        return http.response(409, {'error': 'Unexpected offset', 'received': received})
+    if offset + len(data) > meta['size']:
+        return http.response(400, {'error': 'Chunk exceeds declared size', 'received': received})
+    
+    received = storage.write_chunk(upload_id, offset, data)
+    return http.response(200, {'upload_id': upload_id, 'received': received, 'size': meta['size']})
+
+def abort_upload(body_data: Dict[str, Any]) -> Dict[str, Any]:
+    upload_id = body_data.get('upload_id', '')
+    if load_upload(upload_id) is None:
+        return http.response(404, {'error': 'Upload not found'})
+    get_storage().abort_upload(upload_id)
+    return http.response(200, {'success': True})
+
+def complete_upload(body_data: Dict[str, Any]) -> Dict[str, Any]:
+    upload_id = body_data.get('upload_id', '')
+    meta = load_upload(upload_id)
+    if meta is None:
+        return http.response(404, {'error': 'Upload not found'})
+    
+    storage = get_storage()
+    received = storage.uploaded_size(upload_id)
+    if received != meta['size']:
+        return http.response(409, {'error': 'Upload incomplete', 'received': received, 'size': meta['size']})
     
-    file_id = str(uuid.uuid4())
-    ext = filename.split('.')[-1] if '.' in filename else 'mp3'
-    file_key = f'sounds/{file_id}.{ext}'
+    digest = hashlib.sha256()
+    with storage.open_upload(upload_id) as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    sha256 = digest.hexdigest()
     
-    mock_url = f'https://cdn.poehali.dev/{file_key}'
+    if meta.get('sha256') and meta['sha256'] != sha256:
+        storage.abort_upload(upload_id)
+        return http.response(422, {'error': 'Checksum mismatch'})
     
-    return {
-        'statusCode': 200,
-        'headers': {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'},
-        'body': json.dumps({
-            'file_url': mock_url,
-            'filename': f'{file_id}.{ext}'
-        })
-    }
+    key = content_key(sha256, meta['ext'])
+    try:
+        if storage.exists(key):
+            storage.abort_upload(upload_id)
+            return stored_file(key, sha256, True)
+        storage.complete_upload(upload_id, key)
+    except StorageError as e:
+        return http.response(500, {'error': str(e)})
+    return stored_file(key, sha256, False)
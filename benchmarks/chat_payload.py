@@ -0,0 +1,70 @@
+'''
+Сравнение размера страницы переписки в полном (format=full) и компактном
+формате действия messages. Страница собирается синтетически тем же кодом
+сериализации, что и в social, поэтому база не нужна.
+
+    python benchmarks/chat_payload.py --messages 100
+'''
+import argparse
+import datetime
+import gzip
+import random
+
+from common import load_module
+
+PHRASES = [
+    'Привет! Заказ уже пришёл?', 'Да, можно забирать до 21:00', 'Спасибо!',
+    'Сегодня много возвратов, задержусь', 'Звук сканера опять тихий', 'Ок, понял',
+]
+
+def synthetic_page(count: int, seed: int):
+    rng = random.Random(seed)
+    users = {
+        1: {'id': 1, 'username': 'Анна Смирнова', 'avatar_url': 'https://cdn.poehali.dev/avatars/anna-smirnova-2024.jpg'},
+        2: {'id': 2, 'username': 'Пётр Иванов', 'avatar_url': 'https://cdn.poehali.dev/avatars/petr-ivanov-pvz.jpg'},
+    }
+    start = datetime.datetime(2024, 5, 1, 9, 0, 0)
+    full_rows, compact_rows = [], []
+    for i in range(count):
+        sender, receiver = (1, 2) if rng.random() < 0.5 else (2, 1)
+        is_media = rng.random() < 0.1
+        row = {
+            'id': 100000 + i,
+            'sender_id': sender,
+            'receiver_id': receiver,
+            'message_type': 'image' if is_media else 'text',
+            'content': None if is_media else rng.choice(PHRASES),
+            'media_url': f'https://cdn.poehali.dev/chat/{rng.getrandbits(64):016x}.jpg' if is_media else None,
+            'sticker_id': None,
+            'is_read': True,
+            'created_at': start + datetime.timedelta(seconds=37 * i),
+        }
+        compact_rows.append({k: v for k, v in row.items() if k != 'sticker_id'})
+        full_rows.append(dict(row,
+                              sender_name=users[sender]['username'], sender_avatar=users[sender]['avatar_url'],
+                              receiver_name=users[receiver]['username'], receiver_avatar=users[receiver]['avatar_url']))
+    return full_rows, compact_rows, list(users.values())
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args()
+
+    social = load_module('social')
+    http = social.http
+    full_rows, compact_rows, users = synthetic_page(args.messages, args.seed)
+
+    bodies = {
+        'full': http.dumps({'messages': full_rows}),
+        'compact': http.dumps(social.compact_messages(compact_rows, users)),
+    }
+    base_raw = len(bodies['full'].encode())
+    base_gzip = len(gzip.compress(bodies['full'].encode()))
+    for name, body in bodies.items():
+        raw = len(body.encode())
+        packed = len(gzip.compress(body.encode()))
+        print(f'{name:<8} raw={raw:>7} B ({raw / base_raw:6.1%})  gzip={packed:>6} B ({packed / base_gzip:6.1%})')
+
+if __name__ == '__main__':
+    main()
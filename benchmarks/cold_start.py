@@ -0,0 +1,129 @@
+'''
+Холодный старт backend-функций: время импорта модуля handler'а и первого
+вызова в свежем интерпретаторе, как в новом контейнере после scale-out.
+
+Для каждой функции прогоняются пути без базы (OPTIONS и ранние 401/405) и
+проверяется, что тяжёлые зависимости (psycopg2, jwt, numpy) на них не
+загружаются. С --with-db добавляется первый запрос, идущий в базу
+(нужен DATABASE_URL).
+
+    python benchmarks/cold_start.py --runs 15
+    python benchmarks/cold_start.py --save-baseline benchmarks/cold_start_baseline.json
+    python benchmarks/cold_start.py --baseline benchmarks/cold_start_baseline.json --tolerance 0.3
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from common import compare_to_baseline
+
+HEAVY_MODULES = ('psycopg2', 'jwt', 'numpy')
+
+EARLY_EVENTS = {
+    'admin': [('options', {'httpMethod': 'OPTIONS'}), ('unauthorized', {'httpMethod': 'GET', 'headers': {}})],
+    'auth': [('options', {'httpMethod': 'OPTIONS'}), ('wrong_method', {'httpMethod': 'GET'})],
+    'courses': [('options', {'httpMethod': 'OPTIONS'}), ('wrong_method', {'httpMethod': 'POST'})],
+    'social': [('options', {'httpMethod': 'OPTIONS'})],
+    'sounds': [('options', {'httpMethod': 'OPTIONS'}), ('wrong_method', {'httpMethod': 'DELETE'})],
+    'stickers': [('options', {'httpMethod': 'OPTIONS'}), ('bad_request', {'httpMethod': 'GET', 'queryStringParameters': {'action': 'pack'}})],
+    'upload': [('options', {'httpMethod': 'OPTIONS'}), ('unauthorized', {'httpMethod': 'POST', 'headers': {}})],
+}
+
+DB_EVENTS = {
+    'admin': ('list', {'httpMethod': 'GET', 'headers': {'X-Admin-Password': '2501'}}),
+    'auth': ('login', {'httpMethod': 'POST', 'body': json.dumps({'action': 'login', 'email': 'nobody@bench.local', 'password': 'x'})}),
+    'courses': ('catalog', {'httpMethod': 'GET', 'queryStringParameters': {}}),
+    'social': ('search', {'httpMethod': 'GET', 'queryStringParameters': {'action': 'search', 'q': 'test'}}),
+    'sounds': ('catalog', {'httpMethod': 'GET', 'queryStringParameters': {}}),
+    'stickers': ('catalog', {'httpMethod': 'GET', 'queryStringParameters': {'action': 'catalog'}}),
+}
+
+def child(function: str, with_db: bool) -> None:
+    '''
+    Запускается в отдельном процессе: импортирует handler и вызывает его
+    один раз на каждое событие, печатает замеры в JSON.
+    '''
+    from common import load_module
+
+    start = time.perf_counter()
+    module = load_module(function)
+    result = {'import_ms': (time.perf_counter() - start) * 1000, 'events': {}}
+
+    for name, event in EARLY_EVENTS[function]:
+        start = time.perf_counter()
+        module.handler(event, None)
+        result['events'][name] = (time.perf_counter() - start) * 1000
+    result['heavy_loaded'] = sorted(m for m in HEAVY_MODULES if m in sys.modules)
+
+    if with_db and function in DB_EVENTS:
+        name, event = DB_EVENTS[function]
+        start = time.perf_counter()
+        module.handler(event, None)
+        result['events'][f'db_{name}'] = (time.perf_counter() - start) * 1000
+    print(json.dumps(result))
+
+def measure(function: str, runs: int, with_db: bool) -> dict:
+    samples = []
+    for _ in range(runs):
+        cmd = [sys.executable, os.path.abspath(__file__), '--child', function]
+        if with_db:
+            cmd.append('--with-db')
+        out = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, text=True).stdout
+        samples.append(json.loads(out.strip().splitlines()[-1]))
+
+    summary = {'import_ms': round(statistics.median(s['import_ms'] for s in samples), 3), 'events': {}}
+    for name in samples[0]['events']:
+        summary['events'][name] = round(statistics.median(s['events'][name] for s in samples), 3)
+    summary['heavy_loaded'] = samples[0]['heavy_loaded']
+    return summary
+
+def flatten(results: dict) -> dict:
+    return {f: {'import_ms': r['import_ms'], **r['events']} for f, r in results.items()}
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--functions', default=','.join(EARLY_EVENTS))
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--with-db', action='store_true', help='also time the first database-backed request')
+    parser.add_argument('--baseline', help='compare against a stored baseline JSON and fail on regressions')
+    parser.add_argument('--save-baseline', help='write results to this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown vs baseline (0.25 = 25%%)')
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.with_db)
+        return
+
+    results = {}
+    for function in args.functions.split(','):
+        results[function] = summary = measure(function, args.runs, args.with_db)
+        events = ' '.join(f'{k}={v:.2f}ms' for k, v in summary['events'].items())
+        heavy = ','.join(summary['heavy_loaded']) or '-'
+        print(f'{function:<8} import={summary["import_ms"]:>8.2f}ms  {events}  heavy-on-early-path={heavy}')
+
+    failures = [f'{f}: {", ".join(r["heavy_loaded"])} loaded on OPTIONS/early-exit path'
+                for f, r in results.items() if r['heavy_loaded']]
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        failures += compare_to_baseline(flatten(results), flatten(baseline), args.tolerance)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f'Baseline written to {args.save_baseline}')
+
+    if failures:
+        print('Regressions:')
+        for failure in failures:
+            print(f'  {failure}')
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
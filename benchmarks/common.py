@@ -0,0 +1,148 @@
+'''
+Общие утилиты бенчмарков: отдельная схема в тестовой базе, собранная из
+db_migrations, и загрузка handler'ов backend-функций напрямую.
+
+База берётся из BENCH_DATABASE_URL (или DATABASE_URL). Каждый прогон создаёт
+свою схему и удаляет её в конце, поэтому рабочие таблицы не затрагиваются.
+'''
+import importlib.util
+import os
+import re
+import statistics
+import sys
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKEND_DIR = os.path.join(ROOT_DIR, 'backend')
+MIGRATIONS_DIR = os.path.join(ROOT_DIR, 'db_migrations')
+SEED_AFTER_VERSION = 3
+
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+
+def database_url() -> str:
+    url = os.environ.get('BENCH_DATABASE_URL') or os.environ.get('DATABASE_URL')
+    if not url:
+        sys.exit('Set BENCH_DATABASE_URL to a scratch PostgreSQL database')
+    return url
+
+def migration_files() -> List[str]:
+    files = [f for f in os.listdir(MIGRATIONS_DIR) if re.match(r'^V\d+__.*\.sql$', f)]
+    files.sort(key=migration_version)
+    return [os.path.join(MIGRATIONS_DIR, f) for f in files]
+
+def migration_version(path: str) -> int:
+    return int(re.match(r'^V(\d+)', os.path.basename(path)).group(1))
+
+@contextmanager
+def scratch_schema(keep: bool = False, seed: Optional[Callable[[Any], None]] = None, url: Optional[str] = None,
+                   schema: Optional[str] = None, env: str = 'DATABASE_URL') -> Iterator[Any]:
+    '''
+    Создаёт схему bench_<random>, применяет к ней все миграции и направляет
+    туда же соединения handler'ов через PGOPTIONS. Отдаёт открытое соединение.
+
+    url, schema и env позволяют поднять схему с тем же именем во второй базе
+    и выставить её адрес в другую переменную, например DATABASE_READ_URL.
+
+    seed(cursor) вызывается сразу после SEED_AFTER_VERSION, когда базовые
+    таблицы уже есть, а производные (сводки, индексы, партиции) ещё нет -
+    их заполнят бэкфиллы последующих миграций, как на живой базе.
+    '''
+    import psycopg2
+
+    url = url or database_url()
+    schema = schema or f'bench_{uuid.uuid4().hex[:8]}'
+    conn = psycopg2.connect(url)
+    cur = conn.cursor()
+    cur.execute(f'CREATE SCHEMA {schema}')
+    cur.execute(f'SET search_path TO {schema}, public')
+    seeded = seed is None
+    for path in migration_files():
+        if not seeded and migration_version(path) > SEED_AFTER_VERSION:
+            seed(cur)
+            seeded = True
+        with open(path, encoding='utf-8') as f:
+            cur.execute(f.read())
+    if not seeded:
+        seed(cur)
+    cur.execute('ANALYZE')
+    conn.commit()
+
+    previous = {k: os.environ.get(k) for k in (env, 'PGOPTIONS')}
+    os.environ[env] = url
+    os.environ['PGOPTIONS'] = f'-c search_path={schema},public'
+    try:
+        yield conn
+    finally:
+        for key, value in previous.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+        conn.rollback()
+        if keep:
+            print(f'Schema {schema} kept')
+        else:
+            cur.execute(f'DROP SCHEMA {schema} CASCADE')
+            conn.commit()
+        conn.close()
+
+def load_module(function: str) -> Any:
+    path = os.path.join(BACKEND_DIR, function, 'index.py')
+    spec = importlib.util.spec_from_file_location(f'{function}_index', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def load_handler(function: str) -> Callable[[Dict[str, Any], Any], Dict[str, Any]]:
+    return load_module(function).handler
+
+def copy_rows(cur: Any, table: str, columns: List[str], rows: Iterator[tuple]) -> None:
+    import io
+
+    buf = io.StringIO()
+    for row in rows:
+        buf.write('\t'.join('\\N' if v is None else str(v) for v in row))
+        buf.write('\n')
+    buf.seek(0)
+    cur.copy_from(buf, table, columns=columns)
+
+def timed(fn: Callable[[], Any]) -> float:
+    start = time.perf_counter()
+    fn()
+    return (time.perf_counter() - start) * 1000
+
+def percentiles(samples_ms: List[float]) -> Dict[str, float]:
+    ordered = sorted(samples_ms)
+    if not ordered:
+        return {'p50': 0.0, 'p95': 0.0, 'p99': 0.0, 'mean': 0.0}
+
+    def pick(q: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 3)
+
+    return {'p50': pick(0.50), 'p95': pick(0.95), 'p99': pick(0.99), 'mean': round(statistics.fmean(ordered), 3)}
+
+def report(title: str, samples_ms: List[float]) -> None:
+    stats = percentiles(samples_ms)
+    print(f'{title:<40} n={len(samples_ms):<6} p50={stats["p50"]:>9.3f}ms p95={stats["p95"]:>9.3f}ms '
+          f'p99={stats["p99"]:>9.3f}ms mean={stats["mean"]:>9.3f}ms')
+
+def compare_to_baseline(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]],
+                        tolerance: float, min_delta: float = 1.0) -> List[str]:
+    '''
+    Сравнивает плоские метрики {сценарий: {метрика: значение}} с сохранённым
+    базовым прогоном. Регрессия - рост больше чем на tolerance и больше min_delta.
+    '''
+    failures = []
+    for name, metrics in results.items():
+        base = baseline.get(name) or {}
+        for metric, value in metrics.items():
+            before = base.get(metric)
+            if not isinstance(before, (int, float)) or not isinstance(value, (int, float)):
+                continue
+            if value > before * (1 + tolerance) and value - before > min_delta:
+                failures.append(f'{name}.{metric}: {before:.2f} -> {value:.2f}')
+    return failures
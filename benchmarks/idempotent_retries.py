@@ -0,0 +1,98 @@
+'''
+Агрессивные повторы записей с Idempotency-Key: каждый логический запрос
+(сообщение, заявка, принятие заявки) отправляется несколько раз параллельно
+и вперемешку с другими, как это делает мобильный клиент после таймаутов.
+
+После прогона проверяется, что каждое сообщение записано ровно один раз и
+все повторы получили тот же ответ, что и первый запрос.
+
+    BENCH_DATABASE_URL=postgresql://localhost/bench python benchmarks/idempotent_retries.py --retries 5
+'''
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+from common import copy_rows, load_handler, percentiles, scratch_schema, timed
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--writes', type=int, default=500, help='logical send_message requests')
+    parser.add_argument('--retries', type=int, default=5, help='copies of each request')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--keep', action='store_true', help='keep the scratch schema')
+    args = parser.parse_args()
+
+    def seed(cur: Any) -> None:
+        copy_rows(cur, 'users', ['id', 'email', 'password_hash', 'username'], (
+            (i, f'user{i}@bench.local', 'x', f'user{i}') for i in range(1, args.users + 1)
+        ))
+        cur.execute("SELECT setval('users_id_seq', %s)", (args.users,))
+
+    # Лимитер здесь только мешал бы: проверяется повтор, а не частота
+    os.environ['RATE_LIMIT_ENABLED'] = '0'
+    os.environ['DB_POOL_MAX_IDLE'] = str(args.concurrency)
+    rng = random.Random(args.seed)
+    with scratch_schema(keep=args.keep, seed=seed) as conn:
+        handler = load_handler('social')
+        plan: List[Dict[str, Any]] = []
+        for i in range(args.writes):
+            sender, receiver = rng.sample(range(1, args.users + 1), 2)
+            body = json.dumps({'action': 'send_message', 'sender_id': sender, 'receiver_id': receiver,
+                               'message_type': 'text', 'content': f'retry-{i}'})
+            plan += [{'httpMethod': 'POST', 'headers': {'Idempotency-Key': f'msg-{i}'}, 'body': body}] * args.retries
+        rng.shuffle(plan)
+
+        bodies: Dict[str, set] = {}
+        samples: Dict[str, List[float]] = {'first': [], 'replayed': []}
+        lock = threading.Lock()
+
+        def send(event: Dict[str, Any]) -> None:
+            result = {}
+            ms = timed(lambda: result.update(handler(event, None)))
+            replayed = result['headers'].get('Idempotent-Replayed') == 'true'
+            with lock:
+                bodies.setdefault(event['headers']['Idempotency-Key'], set()).add((result['statusCode'], result['body']))
+                samples['replayed' if replayed else 'first'].append(ms)
+
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            list(pool.map(send, plan))
+
+        for name, ms in samples.items():
+            if ms:
+                stats = percentiles(ms)
+                print(f'{name}: {len(ms)} responses, p50={stats["p50"]:.2f}ms p95={stats["p95"]:.2f}ms')
+
+        cur = conn.cursor()
+        cur.execute(
+            """SELECT content, COUNT(*) FROM messages WHERE content LIKE 'retry-%%'
+               GROUP BY content HAVING COUNT(*) > 1"""
+        )
+        duplicates = cur.fetchall()
+        cur.execute("SELECT COUNT(*) FROM messages WHERE content LIKE 'retry-%%'")
+        stored = cur.fetchone()[0]
+        conn.rollback()
+
+    problems = []
+    if stored != args.writes:
+        problems.append(f'{stored} messages stored, expected {args.writes}')
+    if duplicates:
+        problems.append(f'{len(duplicates)} messages stored more than once')
+    diverged = [key for key, responses in bodies.items() if len(responses) != 1]
+    if diverged:
+        problems.append(f'{len(diverged)} keys got different responses, e.g. {diverged[0]}')
+    if problems:
+        print('Failures:')
+        for problem in problems:
+            print(f'  {problem}')
+        sys.exit(1)
+    print(f'{args.writes} messages stored once each across {len(plan)} requests')
+
+if __name__ == '__main__':
+    main()
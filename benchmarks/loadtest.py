@@ -0,0 +1,352 @@
+'''
+Нагрузочный стенд backend-функций: handler'ы вызываются напрямую против
+локального PostgreSQL со схемой из db_migrations и синтетическими данными.
+
+Сначала прогоняются все сценарии из backend/*/tests.json с проверкой
+expectedStatus и expectedBody, затем - смешанный трафик (каталог звуков,
+чаты, поиск, логин) с заданной конкурентностью. Для каждого сценария
+печатаются p50/p95/p99 и число SQL-запросов на вызов (по замерам core.trace),
+а также самые дорогие нормализованные запросы.
+
+    BENCH_DATABASE_URL=postgresql://localhost/bench python benchmarks/loadtest.py
+    python benchmarks/loadtest.py --users 20000 --messages 500000 --concurrency 16
+    python benchmarks/loadtest.py --save-baseline benchmarks/loadtest_baseline.json
+    python benchmarks/loadtest.py --baseline benchmarks/loadtest_baseline.json --tolerance 0.3
+'''
+import argparse
+import glob
+import hashlib
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from common import BACKEND_DIR, compare_to_baseline, copy_rows, load_handler, percentiles, scratch_schema
+
+SEED_PASSWORD = 'test123'
+CATEGORIES = ['Уведомления', 'Выдача', 'Ошибки', 'Система']
+WORDS = ['привет', 'заказ', 'выдача', 'смена', 'клиент', 'возврат', 'склад', 'ok', 'спасибо', 'завтра']
+
+def seed_data(args: argparse.Namespace, rng: random.Random) -> Tuple[Callable[[Any], None], List[Tuple[int, int]]]:
+    '''
+    Готовит seed-функцию для scratch_schema и список пар друзей, по которым
+    потом ходит синтетический трафик. Пара (1, 2) намеренно не дружит -
+    на ней проверяется send_request из tests.json.
+    '''
+    pairs = set()
+    for user in range(1, args.users + 1):
+        for _ in range(args.degree // 2):
+            friend = rng.randint(1, args.users)
+            if friend != user and {user, friend} != {1, 2}:
+                pairs.add((min(user, friend), max(user, friend)))
+    pairs = sorted(pairs)
+
+    def seed(cur: Any) -> None:
+        password_hash = hashlib.sha256(SEED_PASSWORD.encode()).hexdigest()
+        copy_rows(cur, 'users', ['id', 'email', 'password_hash', 'username', 'workplace', 'fmonet_balance'], (
+            (i, f'user{i}@bench.local', password_hash, f'user{i}', f'ПВЗ #{i % 500}', 1000000)
+            for i in range(1, args.users + 1)
+        ))
+        cur.execute("SELECT setval('users_id_seq', %s)", (args.users,))
+        copy_rows(cur, 'friendships', ['user_id', 'friend_id', 'status'], (
+            row for a, b in pairs for row in ((a, b, 'accepted'), (b, a, 'accepted'))
+        ))
+
+        start = time.time() - args.messages
+        copy_rows(cur, 'messages', ['sender_id', 'receiver_id', 'message_type', 'content', 'is_read', 'created_at'], (
+            (*(pair if rng.random() < 0.5 else pair[::-1]), 'text', ' '.join(rng.choices(WORDS, k=rng.randint(1, 8))),
+             't' if i < args.messages * 0.9 else 'f',
+             time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(start + i)))
+            for i, pair in enumerate(rng.choice(pairs) for _ in range(args.messages))
+        ))
+        copy_rows(cur, 'wb_sounds', ['title', 'description', 'file_url', 'category', 'downloads_count'], (
+            (f'Звук {i}', f'Синтетический звук {i} для нагрузочного теста', f'https://cdn.poehali.dev/sounds/bench-{i}.mp3',
+             rng.choice(CATEGORIES), rng.randint(0, 1000))
+            for i in range(args.sounds)
+        ))
+        copy_rows(cur, 'sticker_packs', ['id', 'creator_id', 'title', 'description', 'preview_url', 'price'], (
+            (i, rng.randint(1, args.users), f'Пак {i}', f'Синтетический пак {i}', f'https://cdn.poehali.dev/stickers/{i}/preview.png',
+             rng.choice([0, 50, 100, 200]))
+            for i in range(1, args.packs + 1)
+        ))
+        cur.execute("SELECT setval('sticker_packs_id_seq', %s)", (max(args.packs, 1),))
+        copy_rows(cur, 'stickers', ['pack_id', 'image_url', 'emoji_tag'], (
+            (pack, f'https://cdn.poehali.dev/stickers/{pack}/{i}.png', rng.choice(['😀', '👍', '📦', '🔥']))
+            for pack in range(1, args.packs + 1) for i in range(rng.randint(8, 24))
+        ))
+
+    return seed, pairs
+
+def event_from_test(test: Dict[str, Any]) -> Dict[str, Any]:
+    parts = urlsplit(test.get('path') or '/')
+    event = {'httpMethod': test.get('method', 'GET'), 'headers': dict(test.get('headers') or {})}
+    if parts.query:
+        event['queryStringParameters'] = {k: v[0] for k, v in parse_qs(parts.query).items()}
+    if 'body' in test:
+        body = test['body']
+        event['body'] = body if isinstance(body, str) else json.dumps(body)
+    return event
+
+def body_mismatches(expected: Any, actual: Any, path: str = '') -> List[str]:
+    '''
+    Частичное сравнение в духе tests.json: "array", "object" и "string"
+    проверяют тип, вложенные объекты сравниваются по указанным ключам,
+    остальное - на равенство.
+    '''
+    if expected == 'array':
+        return [] if isinstance(actual, list) else [f'{path.rstrip(".") or "body"}: expected array']
+    if expected == 'object':
+        return [] if isinstance(actual, dict) else [f'{path.rstrip(".") or "body"}: expected object']
+    if expected == 'string':
+        return [] if isinstance(actual, str) else [f'{path.rstrip(".") or "body"}: expected string']
+    if isinstance(expected, dict):
+        if not isinstance(actual, dict):
+            return [f'{path.rstrip(".") or "body"}: expected object']
+        problems = []
+        for key, value in expected.items():
+            if key not in actual:
+                problems.append(f'{path}{key}: missing')
+            else:
+                problems += body_mismatches(value, actual[key], f'{path}{key}.')
+        return problems
+    return [] if expected == actual else [f'{path.rstrip(".") or "body"}: expected {expected!r}, got {actual!r}']
+
+def call(handler: Callable[[Dict[str, Any], Any], Dict[str, Any]], event: Dict[str, Any]) -> Tuple[Dict[str, Any], float, Any]:
+    '''
+    Вызывает handler и возвращает ответ, время и замеры запросов к базе
+    из core.trace за этот вызов.
+    '''
+    from core import trace
+
+    start = time.perf_counter()
+    result = handler(event, None)
+    return result, (time.perf_counter() - start) * 1000, trace.last_request()
+
+def replay_tests(handlers: Dict[str, Any]) -> Tuple[Dict[str, Dict[str, float]], List[str]]:
+    results, failures = {}, []
+    for path in sorted(glob.glob(os.path.join(BACKEND_DIR, '*', 'tests.json'))):
+        function = os.path.basename(os.path.dirname(path))
+        with open(path, encoding='utf-8') as f:
+            tests = json.load(f).get('tests', [])
+        for test in tests:
+            name = f'{function}: {test.get("name", "unnamed")}'
+            try:
+                result, ms, request = call(handlers[function], event_from_test(test))
+                queries = len(request.queries)
+            except Exception as e:
+                failures.append(f'{name}: {type(e).__name__}: {e}')
+                continue
+            problems = []
+            if result['statusCode'] != test.get('expectedStatus', 200):
+                problems.append(f'status {result["statusCode"]}, expected {test.get("expectedStatus")}')
+            elif 'expectedBody' in test:
+                try:
+                    problems += body_mismatches(test['expectedBody'], json.loads(result.get('body') or 'null'))
+                except ValueError:
+                    problems.append('body is not JSON')
+            mark = 'ok  ' if not problems else 'FAIL'
+            print(f'  {mark} {name:<60} {ms:>9.2f}ms  queries={queries}')
+            failures += [f'{name}: {p}' for p in problems]
+            results[f'test {name}'] = {'ms': round(ms, 3), 'queries': queries}
+    return results, failures
+
+def traffic_mix(args: argparse.Namespace, pairs: List[Tuple[int, int]]) -> List[Tuple[str, str, int, Callable[[random.Random], Dict[str, Any]]]]:
+    '''
+    Сценарии синтетического трафика: (имя, функция, вес, построитель события).
+    Веса примерно повторяют реальную долю запросов: каталог и чаты - основное.
+    '''
+    def get(params: Dict[str, Any]) -> Dict[str, Any]:
+        return {'httpMethod': 'GET', 'queryStringParameters': {k: str(v) for k, v in params.items()}}
+
+    def post(body: Dict[str, Any]) -> Dict[str, Any]:
+        return {'httpMethod': 'POST', 'body': json.dumps(body)}
+
+    def user(rng: random.Random) -> int:
+        return rng.randint(1, args.users)
+
+    def login(u: int) -> Dict[str, Any]:
+        # Свой адрес у каждого пользователя, иначе весь вход упрётся в лимит одного IP
+        event = post({'action': 'login', 'email': f'user{u}@bench.local', 'password': SEED_PASSWORD})
+        event['requestContext'] = {'identity': {'sourceIp': f'10.{u // 65536 % 256}.{u // 256 % 256}.{u % 256}'}}
+        return event
+
+    def pair(rng: random.Random) -> Tuple[int, int]:
+        a, b = rng.choice(pairs)
+        return (a, b) if rng.random() < 0.5 else (b, a)
+
+    return [
+        ('sounds catalog', 'sounds', 20, lambda rng: get({} if rng.random() < 0.5 else {'category': rng.choice(CATEGORIES)})),
+        ('sounds search', 'sounds', 10, lambda rng: get({'q': rng.choice(['звук', 'синтетический', 'звук 1']), 'sort': rng.choice(['popular', 'new', 'relevance']), 'limit': 30})),
+        ('courses catalog', 'courses', 3, lambda rng: get({} if rng.random() < 0.5 else {'category': rng.choice(['photography', 'video', 'design'])})),
+        ('sounds download', 'sounds', 5, lambda rng: post({'sound_id': rng.randint(1, args.sounds)})),
+        ('auth login', 'auth', 3, lambda rng: login(user(rng))),
+        ('social autocomplete', 'social', 10, lambda rng: get({'action': 'search', 'mode': 'autocomplete', 'q': f'user{rng.randint(1, 99)}'})),
+        ('social conversations', 'social', 15, lambda rng: get({'action': 'conversations', 'user_id': user(rng)})),
+        ('social messages', 'social', 20, lambda rng: get(dict(zip(('user_id', 'friend_id'), pair(rng)), action='messages', limit=50))),
+        ('social send_message', 'social', 10, lambda rng: post(dict(
+            zip(('sender_id', 'receiver_id'), pair(rng)), action='send_message', message_type='text', content=rng.choice(WORDS)))),
+        ('social suggestions', 'social', 5, lambda rng: get({'action': 'suggestions', 'user_id': user(rng)})),
+        ('social batch', 'social', 5, lambda rng: post({'action': 'batch', 'requests': [
+            {'action': 'friends', 'user_id': (u := user(rng))}, {'action': 'requests', 'user_id': u},
+            {'action': 'conversations', 'user_id': u}]})),
+        ('stickers catalog', 'stickers', 3, lambda rng: get({'action': 'catalog'})),
+        ('stickers pack', 'stickers', 5, lambda rng: get({'action': 'pack', 'pack_id': rng.randint(1, args.packs)})),
+        ('stickers owned', 'stickers', 3, lambda rng: get({'action': 'owned', 'user_id': user(rng)})),
+        ('stickers purchase', 'stickers', 2, lambda rng: post({'action': 'purchase', 'user_id': user(rng), 'pack_id': rng.randint(1, args.packs)})),
+        ('admin list', 'admin', 1, lambda rng: {'httpMethod': 'GET', 'headers': {'X-Admin-Password': '2501'}}),
+    ]
+
+def run_mix(args: argparse.Namespace, handlers: Dict[str, Any], pairs: List[Tuple[int, int]]) -> Tuple[Dict[str, Dict[str, float]], List[str]]:
+    scenarios = traffic_mix(args, pairs)
+    weights = [s[2] for s in scenarios]
+    rng = random.Random(args.seed + 1)
+    plan = [(s, s[3](rng)) for s in rng.choices(scenarios, weights=weights, k=args.warmup + args.requests)]
+
+    samples: Dict[str, List[Tuple[float, int]]] = {s[0]: [] for s in scenarios}
+    errors: Dict[str, int] = {s[0]: 0 for s in scenarios}
+    statements: Dict[str, List[float]] = {}
+    lock = threading.Lock()
+
+    def run(index: int) -> None:
+        (name, function, _, _), event = plan[index]
+        try:
+            result, ms, request = call(handlers[function], event)
+            ok = result['statusCode'] < 400
+        except Exception:
+            ok = False
+        if index < args.warmup:
+            return
+        with lock:
+            if not ok:
+                errors[name] += 1
+                return
+            samples[name].append((ms, len(request.queries)))
+            for row in request.statements():
+                total = statements.setdefault(row['sql'], [0, 0.0])
+                total[0] += row['count']
+                total[1] += row['ms']
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(run, range(args.warmup)))
+        start = time.perf_counter()
+        list(pool.map(run, range(args.warmup, len(plan))))
+        elapsed = time.perf_counter() - start
+
+    results, failures = {}, []
+    print(f'{"scenario":<24} {"n":>6} {"err":>4} {"p50":>9} {"p95":>9} {"p99":>9} {"queries":>8}')
+    for name, _, _, _ in scenarios:
+        timings = [ms for ms, _ in samples[name]]
+        queries = [q for _, q in samples[name]]
+        stats = percentiles(timings)
+        per_request = round(sum(queries) / len(queries), 2) if queries else 0.0
+        print(f'{name:<24} {len(timings):>6} {errors[name]:>4} {stats["p50"]:>7.2f}ms {stats["p95"]:>7.2f}ms '
+              f'{stats["p99"]:>7.2f}ms {per_request:>8.2f}')
+        results[name] = {**stats, 'queries': per_request}
+        if errors[name]:
+            failures.append(f'{name}: {errors[name]} failed requests')
+    total = args.requests
+    print(f'{total} requests in {elapsed:.2f}s, {total / elapsed:.0f} req/s at concurrency {args.concurrency}')
+    results['throughput'] = {'req_per_s': round(total / elapsed, 1)}
+
+    print(f'Top {args.top_statements} statements by total time:')
+    for sql, (count, ms) in sorted(statements.items(), key=lambda item: item[1][1], reverse=True)[:args.top_statements]:
+        print(f'  {ms:>10.1f}ms {count:>7}x  {sql[:140]}')
+    return results, failures
+
+def regressions(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]], tolerance: float) -> List[str]:
+    '''
+    Время смешанного трафика сравнивается с допуском tolerance, число запросов -
+    строго: лишний запрос на вызов (в среднем больше чем на 0.5) уже регрессия.
+    Одиночные замеры tests.json слишком шумные и проверяются только по запросам.
+    '''
+    def timing_only(data: Dict[str, Dict[str, float]]) -> Dict[str, Dict[str, float]]:
+        return {k: {m: v for m, v in r.items() if m != 'queries'} for k, r in data.items()
+                if k != 'throughput' and not k.startswith('test ')}
+
+    timing, base_timing = timing_only(results), timing_only(baseline)
+    queries = {k: {'queries': r['queries']} for k, r in results.items() if 'queries' in r}
+    base_queries = {k: {'queries': r['queries']} for k, r in baseline.items() if 'queries' in r}
+    failures = compare_to_baseline(timing, base_timing, tolerance)
+    failures += compare_to_baseline(queries, base_queries, 0.0, min_delta=0.5)
+
+    before, after = baseline.get('throughput', {}).get('req_per_s'), results.get('throughput', {}).get('req_per_s')
+    if before and after and after < before * (1 - tolerance):
+        failures.append(f'throughput.req_per_s: {before:.1f} -> {after:.1f}')
+    return failures
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--degree', type=int, default=10, help='average friends per user')
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--sounds', type=int, default=500)
+    parser.add_argument('--packs', type=int, default=50, help='sticker packs')
+    parser.add_argument('--requests', type=int, default=5000, help='synthetic requests after warm-up')
+    parser.add_argument('--warmup', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--top-statements', type=int, default=10, help='normalized SQL statements to list')
+    parser.add_argument('--skip-tests', action='store_true', help='do not replay tests.json')
+    parser.add_argument('--no-snapshots', action='store_true', help='serve catalogs by live queries instead of published snapshots')
+    parser.add_argument('--baseline', help='compare against a stored baseline JSON and fail on regressions')
+    parser.add_argument('--save-baseline', help='write results to this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown vs baseline (0.25 = 25%%)')
+    parser.add_argument('--keep', action='store_true', help='keep the scratch schema')
+    args = parser.parse_args()
+
+    # Настройки модулей core читаются при импорте, поэтому задаются до загрузки handler'ов
+    os.environ['DB_POOL_MAX_IDLE'] = str(args.concurrency)
+    os.environ['DB_TRACE'] = '1'
+    os.environ.setdefault('JWT_SECRET', 'bench-secret')
+    os.environ.setdefault('STORAGE_ROOT', tempfile.mkdtemp(prefix='bench-storage-'))
+    # Все handler'ы стенда в одном процессе, локальное хранилище у них общее
+    if not args.no_snapshots:
+        os.environ.setdefault('STORAGE_SHARED', '1')
+
+    rng = random.Random(args.seed)
+    seed, pairs = seed_data(args, rng)
+    print(f'Seeding {args.users} users, {len(pairs)} friendships, {args.messages} messages, '
+          f'{args.sounds} sounds, {args.packs} sticker packs')
+    with scratch_schema(keep=args.keep, seed=seed):
+        from core import db
+        functions = sorted(os.path.basename(os.path.dirname(p)) for p in glob.glob(os.path.join(BACKEND_DIR, '*', 'index.py')))
+        handlers = {f: load_handler(f) for f in functions}
+        if not args.no_snapshots:
+            from core import snapshots
+            with db.connection() as conn:
+                for name in snapshots.RENDERERS:
+                    snapshots.publish(conn, name)
+
+        results, failures = {}, []
+        if not args.skip_tests:
+            print('Replaying tests.json')
+            results, failures = replay_tests(handlers)
+        print(f'Synthetic mix: {args.requests} requests')
+        mix_results, mix_failures = run_mix(args, handlers, pairs)
+        results.update(mix_results)
+        failures += mix_failures
+        print(f'Pool: {db.pool_stats()}')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            failures += regressions(results, json.load(f), args.tolerance)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True, ensure_ascii=False)
+        print(f'Baseline written to {args.save_baseline}')
+
+    if failures:
+        print('Failures:')
+        for failure in failures:
+            print(f'  {failure}')
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
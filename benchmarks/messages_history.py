@@ -0,0 +1,124 @@
+'''
+Задержка переписки при растущей истории сообщений. Для каждого объёма
+истории (--months месяцев по --per-month сообщений) поднимается своя схема,
+а затем замеряются последняя страница диалога, страница по before_id внутри
+недавнего окна, long-poll проверка новых сообщений и отправка сообщения.
+
+Сообщения разбиты на помесячные партиции, и эти запросы трогают только
+последние месяцы, поэтому задержка не должна расти вместе с историей.
+
+    BENCH_DATABASE_URL=postgresql://localhost/bench python benchmarks/messages_history.py --months 1,6,24
+'''
+import argparse
+import datetime
+import json
+import os
+import random
+import uuid
+from typing import Any, Dict, List
+
+from common import copy_rows, load_module, percentiles, scratch_schema, timed
+
+HOT_PAIR = (1, 2)
+
+def seed_history(cur: Any, users: int, months: int, per_month: int, rng: random.Random) -> None:
+    copy_rows(cur, 'users', ['id', 'email', 'password_hash', 'username'], (
+        (i, f'user{i}@bench.local', 'x', f'user{i}') for i in range(1, users + 1)
+    ))
+    cur.execute("SELECT setval('users_id_seq', %s)", (users,))
+
+    # id растут вместе с created_at, как у живых сообщений; каждое десятое - в горячем диалоге
+    total = months * per_month
+    now = datetime.datetime.now().replace(microsecond=0)
+    step = datetime.timedelta(days=30 * months) / total
+
+    def rows():
+        for i in range(1, total + 1):
+            if i % 10 == 0:
+                sender, receiver = HOT_PAIR if i % 20 else HOT_PAIR[::-1]
+            else:
+                sender, receiver = rng.sample(range(1, users + 1), 2)
+            created_at = now - step * (total - i) - datetime.timedelta(minutes=1)
+            yield i, sender, receiver, f'message {i}', created_at.isoformat(sep=' ')
+
+    copy_rows(cur, 'messages', ['id', 'sender_id', 'receiver_id', 'content', 'created_at'], rows())
+    cur.execute("SELECT setval('messages_id_seq', %s)", (total,))
+
+def measure(social: Any, conn: Any, requests: int, rng: random.Random) -> Dict[str, Dict[str, float]]:
+    cur = conn.cursor()
+    cur.execute(
+        """SELECT MIN(id) FROM (
+               SELECT id FROM messages
+               WHERE LEAST(sender_id, receiver_id) = %s AND GREATEST(sender_id, receiver_id) = %s
+               ORDER BY id DESC LIMIT 200
+           ) recent""",
+        HOT_PAIR
+    )
+    recent_cursor = cur.fetchone()[0]
+    cur.execute("SELECT MAX(id) FROM messages")
+    last_id = cur.fetchone()[0]
+    conn.rollback()
+
+    page = {'action': 'messages', 'user_id': str(HOT_PAIR[0]), 'friend_id': str(HOT_PAIR[1])}
+    scenarios = {
+        'latest page': lambda: {'httpMethod': 'GET', 'queryStringParameters': page},
+        'before_id page': lambda: {'httpMethod': 'GET', 'queryStringParameters': {
+            **page, 'before_id': str(rng.randint(recent_cursor, last_id))
+        }},
+        'poll new messages': lambda: {'httpMethod': 'GET', 'queryStringParameters': {
+            'action': 'wait', 'user_id': str(HOT_PAIR[0]), 'after_id': str(last_id), 'timeout': '0'
+        }},
+        'send_message': lambda: {'httpMethod': 'POST', 'body': json.dumps({
+            'action': 'send_message', 'sender_id': HOT_PAIR[0], 'receiver_id': HOT_PAIR[1],
+            'message_type': 'text', 'content': 'bench'
+        })}
+    }
+    results = {}
+    for name, make_event in scenarios.items():
+        samples: List[float] = []
+        for _ in range(requests):
+            event = make_event()
+            result: Dict[str, Any] = {}
+            samples.append(timed(lambda: result.update(social.handler(event, None))))
+            if result['statusCode'] != 200:
+                raise SystemExit(f'{name}: HTTP {result["statusCode"]} {result.get("body")}')
+        results[name] = percentiles(samples)
+    return results
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--months', default='1,6,24', help='comma-separated history sizes in months')
+    parser.add_argument('--per-month', type=int, default=50000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--requests', type=int, default=200, help='requests per scenario')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    # Лимитер отклонил бы серию отправок одного пользователя
+    os.environ['RATE_LIMIT_ENABLED'] = '0'
+    # Одно имя схемы на все прогоны: соединения из пула core.db, открытые с её
+    # search_path, остаются годными и после пересоздания схемы
+    schema = f'bench_{uuid.uuid4().hex[:8]}'
+    table: Dict[int, Dict[str, Dict[str, float]]] = {}
+    for months in [int(m) for m in args.months.split(',')]:
+        rng = random.Random(args.seed)
+        seed = lambda cur: seed_history(cur, args.users, months, args.per_month, rng)
+        with scratch_schema(seed=seed, schema=schema) as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT COUNT(*) FROM pg_inherits WHERE inhparent = 'messages'::regclass")
+            partitions = cur.fetchone()[0]
+            conn.rollback()
+            # Свежий модуль на каждую схему, чтобы кэши social не переходили между прогонами
+            table[months] = measure(load_module('social'), conn, args.requests, rng)
+        print(f'{months:>3} months, {months * args.per_month} messages, {partitions} partitions')
+        for name, stats in table[months].items():
+            print(f'    {name:<20} p50={stats["p50"]:>8.3f}ms p95={stats["p95"]:>8.3f}ms')
+
+    smallest, largest = min(table), max(table)
+    print(f'p95 growth from {smallest} to {largest} months:')
+    for name in table[smallest]:
+        before, after = table[smallest][name]['p95'], table[largest][name]['p95']
+        print(f'    {name:<20} {before:>8.3f}ms -> {after:>8.3f}ms ({after / before if before else 0:.2f}x)')
+
+if __name__ == '__main__':
+    main()
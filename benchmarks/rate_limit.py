@@ -0,0 +1,110 @@
+'''
+Наплыв попыток входа и сообщений против лимитера: перебор паролей одного
+email с разных адресов и поток сообщений одного отправителя.
+
+Проверяется, что пропущено не больше, чем позволяет bucket за время прогона,
+у отказов есть Retry-After, а большая часть отказов обходится без базы.
+
+    BENCH_DATABASE_URL=postgresql://localhost/bench python benchmarks/rate_limit.py --concurrency 16
+'''
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+from common import load_module, percentiles, scratch_schema, timed
+
+def seed(cur: Any) -> None:
+    cur.execute(
+        """INSERT INTO users (id, email, password_hash, username) VALUES
+           (1, 'victim@bench.local', 'x', 'victim'), (2, 'friend@bench.local', 'x', 'friend')"""
+    )
+    cur.execute("SELECT setval('users_id_seq', 2)")
+
+def burst(name: str, handler: Any, events: List[Dict[str, Any]], concurrency: int, limit: Any) -> List[str]:
+    statuses: Dict[int, int] = {}
+    samples: Dict[int, List[float]] = {}
+    missing_retry_after = []
+    lock = threading.Lock()
+
+    def call(event: Dict[str, Any]) -> None:
+        result = {}
+        ms = timed(lambda: result.update(handler(event, None)))
+        with lock:
+            status = result['statusCode']
+            statuses[status] = statuses.get(status, 0) + 1
+            samples.setdefault(status, []).append(ms)
+            if status == 429 and 'Retry-After' not in result['headers']:
+                missing_retry_after.append(event)
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(call, events))
+    elapsed = time.monotonic() - start
+
+    allowed = sum(n for status, n in statuses.items() if status != 429)
+    budget = limit.capacity + limit.rate * elapsed
+    print(f'{name}: {len(events)} requests in {elapsed:.2f}s, statuses={statuses}, allowed {allowed} of budget {budget:.1f}')
+    for status, ms in sorted(samples.items()):
+        stats = percentiles(ms)
+        print(f'  {status}: p50={stats["p50"]:.2f}ms p95={stats["p95"]:.2f}ms')
+
+    problems = []
+    if allowed > budget:
+        problems.append(f'{name}: {allowed} requests passed, limit allows {budget:.1f}')
+    if missing_retry_after:
+        problems.append(f'{name}: {len(missing_retry_after)} responses 429 without Retry-After')
+    return problems
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=1000, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--keep', action='store_true', help='keep the scratch schema')
+    args = parser.parse_args()
+
+    os.environ['DB_POOL_MAX_IDLE'] = str(args.concurrency)
+    os.environ.setdefault('JWT_SECRET', 'bench-secret')
+    with scratch_schema(keep=args.keep, seed=seed) as conn:
+        from core import ratelimit
+        auth = load_module('auth')
+        social = load_module('social')
+
+        problems = []
+        logins = [{
+            'httpMethod': 'POST',
+            'body': json.dumps({'action': 'login', 'email': 'victim@bench.local', 'password': f'guess{i}'}),
+            'requestContext': {'identity': {'sourceIp': f'10.0.{i // 256 % 256}.{i % 256}'}}
+        } for i in range(args.requests)]
+        problems += burst('credential stuffing', auth.handler, logins, args.concurrency, auth.LOGIN_BY_EMAIL)
+
+        messages = [{
+            'httpMethod': 'POST',
+            'body': json.dumps({'action': 'send_message', 'sender_id': 1, 'receiver_id': 2, 'message_type': 'text', 'content': f'spam {i}'})
+        } for i in range(args.requests)]
+        problems += burst('message flood', social.handler, messages, args.concurrency, social.MESSAGE_LIMIT)
+
+        stats = ratelimit.stats()
+        print(f'Limiter: {stats}')
+        rejects = stats['local_rejects'] + stats['shared_rejects']
+        if rejects and stats['local_rejects'] < stats['shared_rejects']:
+            problems.append(f'most rejects went to PostgreSQL: {stats}')
+
+        cur = conn.cursor()
+        cur.execute("SELECT COUNT(*) FROM messages WHERE sender_id = 1")
+        stored = cur.fetchone()[0]
+        conn.rollback()
+        print(f'Messages stored: {stored}')
+
+    if problems:
+        print('Failures:')
+        for problem in problems:
+            print(f'  {problem}')
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
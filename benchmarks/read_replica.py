@@ -0,0 +1,117 @@
+'''
+Проверка маршрутизации чтений на реплику на двух локальных PostgreSQL.
+
+Вторая база здесь не настоящая реплика, а независимый сервер с той же схемой
+и немного другими данными - так по ответу видно, откуда пришло чтение:
+
+1. search без недавних записей читается с реплики;
+2. после send_request чтения обоих участников DB_READ_STICKY_SECONDS идут на
+   основной сервер и видят заявку, потом снова на реплику;
+3. после обрыва соединений реплики чтение повторяется на основном сервере,
+   и реплика временно исключается.
+
+    BENCH_DATABASE_URL=postgresql://localhost:5432/bench \\
+    BENCH_READ_DATABASE_URL=postgresql://localhost:5433/bench \\
+    python benchmarks/read_replica.py
+'''
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+from typing import Any, Callable, Dict, List
+
+from common import load_handler, scratch_schema, timed
+
+APP_NAME = 'bench-read-replica'
+
+def seed_users(marker: str) -> Callable[[Any], None]:
+    def seed(cur: Any) -> None:
+        cur.execute(
+            """INSERT INTO users (id, email, password_hash, username) VALUES
+               (1, 'alice@bench.local', 'x', 'alice'),
+               (2, 'bob@bench.local', 'x', 'bob'),
+               (3, %s, 'x', %s)""",
+            (f'{marker}@bench.local', marker)
+        )
+        cur.execute("SELECT setval('users_id_seq', 3)")
+    return seed
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sticky-seconds', type=float, default=1.0)
+    parser.add_argument('--samples', type=int, default=200, help='reads per target for the latency comparison')
+    parser.add_argument('--keep', action='store_true', help='keep the scratch schemas')
+    args = parser.parse_args()
+
+    read_url = os.environ.get('BENCH_READ_DATABASE_URL')
+    if not read_url:
+        sys.exit('Set BENCH_READ_DATABASE_URL to a second scratch PostgreSQL database')
+    os.environ['DB_READ_STICKY_SECONDS'] = str(args.sticky_seconds)
+
+    schema = f'bench_{uuid.uuid4().hex[:8]}'
+    failures: List[str] = []
+
+    def check(name: str, ok: bool) -> None:
+        print(f'  {"ok  " if ok else "FAIL"} {name}')
+        if not ok:
+            failures.append(name)
+
+    with scratch_schema(keep=args.keep, schema=schema, seed=seed_users('primary_only')), \
+            scratch_schema(keep=args.keep, schema=schema, seed=seed_users('replica_only'),
+                           url=read_url, env='DATABASE_READ_URL') as replica_admin:
+        # Имя приложения только у соединений handler'ов - по нему обрываем их на реплике
+        os.environ['PGAPPNAME'] = APP_NAME
+        from core import db
+        handler = load_handler('social')
+
+        def get(params: Dict[str, Any]) -> Dict[str, Any]:
+            result = handler({'httpMethod': 'GET', 'queryStringParameters': params}, None)
+            assert result['statusCode'] == 200, result
+            return json.loads(result['body'])
+
+        def usernames(q: str) -> List[str]:
+            return [u['username'] for u in get({'action': 'search', 'q': q})['users']]
+
+        print('Routing')
+        check('search is served by the replica', usernames('replica_only') == ['replica_only'])
+        check('primary-only rows are not visible there', usernames('primary_on') == [])
+
+        print('Read-your-writes')
+        result = handler({'httpMethod': 'POST', 'body': json.dumps({'action': 'send_request', 'user_id': 1, 'friend_id': 2})}, None)
+        check('send_request succeeds on the primary', result['statusCode'] == 200)
+        check('the receiver sees the request right away', len(get({'action': 'requests', 'user_id': 2})['requests']) == 1)
+        time.sleep(args.sticky_seconds + 0.2)
+        check('after the sticky window reads go back to the replica',
+              get({'action': 'requests', 'user_id': 2})['requests'] == [])
+
+        print('Latency')
+        replica_ms = [timed(lambda: get({'action': 'friends', 'user_id': 1})) for _ in range(args.samples)]
+        db.mark_written(1)
+        primary_ms = [timed(lambda: get({'action': 'friends', 'user_id': 1})) for _ in range(min(args.samples, 50))]
+        print(f'  friends via replica p50={sorted(replica_ms)[len(replica_ms) // 2]:.2f}ms, '
+              f'via primary (sticky) p50={sorted(primary_ms)[len(primary_ms) // 2]:.2f}ms')
+        time.sleep(args.sticky_seconds + 0.2)
+
+        print('Fallback')
+        cur = replica_admin.cursor()
+        cur.execute(
+            """SELECT pg_terminate_backend(pid) FROM pg_stat_activity
+               WHERE application_name = %s AND datname = current_database() AND pid <> pg_backend_pid()""",
+            (APP_NAME,)
+        )
+        replica_admin.commit()
+        before = db.pool_stats()['replica_fallbacks']
+        check('a broken replica connection falls back to the primary', usernames('primary_only') == ['primary_only'])
+        check('the fallback is counted', db.pool_stats()['replica_fallbacks'] == before + 1)
+        replica_reads = db.pool_stats()['replica_reads']
+        check('the replica is skipped afterwards', usernames('alice') == ['alice'] and db.pool_stats()['replica_reads'] == replica_reads)
+
+        print(f'Pool: {db.pool_stats()}')
+
+    if failures:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
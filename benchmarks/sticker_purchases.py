@@ -0,0 +1,95 @@
+'''
+Наплыв покупок стикер-паков: много параллельных покупок одних и тех же
+паков одними и теми же пользователями, включая повторы и нехватку FMonet.
+
+После прогона проверяется, что баланс каждого пользователя равен начальному
+минус цены купленных паков и ни один пак не куплен дважды.
+
+    BENCH_DATABASE_URL=postgresql://localhost/bench python benchmarks/sticker_purchases.py --concurrency 32
+'''
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict
+
+from common import copy_rows, load_handler, percentiles, scratch_schema, timed
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--packs', type=int, default=10)
+    parser.add_argument('--balance', type=int, default=300, help='starting FMonet per user')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--keep', action='store_true', help='keep the scratch schema')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    prices = {pack: rng.choice([0, 50, 100, 150]) for pack in range(1, args.packs + 1)}
+
+    def seed(cur: Any) -> None:
+        copy_rows(cur, 'users', ['id', 'email', 'password_hash', 'username', 'fmonet_balance'], (
+            (i, f'user{i}@bench.local', 'x', f'user{i}', args.balance) for i in range(1, args.users + 1)
+        ))
+        copy_rows(cur, 'sticker_packs', ['id', 'creator_id', 'title', 'price'], (
+            (pack, 1, f'Пак {pack}', price) for pack, price in prices.items()
+        ))
+
+    os.environ['DB_POOL_MAX_IDLE'] = str(args.concurrency)
+    with scratch_schema(keep=args.keep, seed=seed) as conn:
+        handler = load_handler('stickers')
+        plan = [(rng.randint(1, args.users), rng.randint(1, args.packs)) for _ in range(args.requests)]
+        statuses: Dict[int, int] = {}
+        samples = []
+        lock = threading.Lock()
+
+        def buy(item: tuple) -> None:
+            user_id, pack_id = item
+            result = {}
+
+            def call() -> None:
+                result.update(handler({'httpMethod': 'POST', 'body': json.dumps(
+                    {'action': 'purchase', 'user_id': user_id, 'pack_id': pack_id})}, None))
+
+            ms = timed(call)
+            with lock:
+                samples.append(ms)
+                statuses[result['statusCode']] = statuses.get(result['statusCode'], 0) + 1
+
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            list(pool.map(buy, plan))
+
+        stats = percentiles(samples)
+        print(f'{args.requests} purchases at concurrency {args.concurrency}: '
+              f'p50={stats["p50"]:.2f}ms p95={stats["p95"]:.2f}ms p99={stats["p99"]:.2f}ms statuses={statuses}')
+
+        cur = conn.cursor()
+        cur.execute(
+            """SELECT u.id, u.fmonet_balance, COALESCE(SUM(p.price), 0), COUNT(sp.id), COUNT(DISTINCT sp.pack_id)
+               FROM users u
+               LEFT JOIN sticker_purchases sp ON sp.user_id = u.id
+               LEFT JOIN sticker_packs p ON p.id = sp.pack_id
+               GROUP BY u.id ORDER BY u.id"""
+        )
+        problems = []
+        for user_id, balance, spent, purchases, distinct in cur.fetchall():
+            if balance != args.balance - spent or balance < 0:
+                problems.append(f'user {user_id}: balance {balance}, expected {args.balance - spent}')
+            if purchases != distinct:
+                problems.append(f'user {user_id}: {purchases - distinct} duplicate purchases')
+        conn.rollback()
+
+    if problems:
+        print('Inconsistent balances:')
+        for problem in problems:
+            print(f'  {problem}')
+        sys.exit(1)
+    print('Balances and purchases are consistent')
+
+if __name__ == '__main__':
+    main()
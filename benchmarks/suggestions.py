@@ -0,0 +1,122 @@
+'''
+Бенчмарк «Возможно, вы знакомы» на синтетическом графе дружбы.
+
+Строит граф из --users пользователей (по умолчанию 100 000), сгруппированных по
+местам работы, заполняет friend_mutuals и сравнивает действие suggestions из
+предрасчитанной таблицы с живым самосоединением friendships, а также меряет
+стоимость инкрементального обновления при принятии заявки.
+
+    BENCH_DATABASE_URL=postgresql://localhost/bench python benchmarks/suggestions.py
+'''
+import argparse
+import json
+import random
+
+from common import copy_rows, load_handler, report, scratch_schema, timed
+
+LIVE_QUERY = """
+SELECT u.id, COUNT(*) AS mutual_friends
+FROM friendships f1
+JOIN friendships f2 ON f2.user_id = f1.friend_id AND f2.status = 'accepted'
+JOIN users u ON u.id = f2.friend_id
+WHERE f1.user_id = %s AND f1.status = 'accepted' AND f2.friend_id <> f1.user_id
+  AND NOT EXISTS (SELECT 1 FROM friendships f WHERE f.user_id = f1.user_id AND f.friend_id = u.id)
+GROUP BY u.id
+ORDER BY mutual_friends DESC
+LIMIT 20
+"""
+
+def build_graph(users: int, degree: int, workplace_size: int, seed: int):
+    rng = random.Random(seed)
+    edges = set()
+    for user in range(1, users + 1):
+        workplace = (user - 1) // workplace_size
+        for _ in range(degree // 2):
+            if rng.random() < 0.7:
+                friend = workplace * workplace_size + rng.randint(1, workplace_size)
+            else:
+                friend = rng.randint(1, users)
+            if friend != user and friend <= users:
+                edges.add((user, friend))
+                edges.add((friend, user))
+    return edges
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--degree', type=int, default=10, help='average friends per user')
+    parser.add_argument('--workplace-size', type=int, default=50)
+    parser.add_argument('--samples', type=int, default=200)
+    parser.add_argument('--accepts', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--keep', action='store_true', help='keep the scratch schema')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    with scratch_schema(keep=args.keep) as conn:
+        cur = conn.cursor()
+
+        print(f'Generating {args.users} users, ~{args.degree} friends each')
+        copy_rows(cur, 'users', ['id', 'email', 'password_hash', 'username', 'workplace'], (
+            (i, f'user{i}@bench.local', 'x', f'user{i}', f'ПВЗ #{(i - 1) // args.workplace_size}')
+            for i in range(1, args.users + 1)
+        ))
+        cur.execute("SELECT setval('users_id_seq', %s)", (args.users,))
+        edges = build_graph(args.users, args.degree, args.workplace_size, args.seed)
+        copy_rows(cur, 'friendships', ['user_id', 'friend_id', 'status'], ((a, b, 'accepted') for a, b in edges))
+        conn.commit()
+        print(f'{len(edges)} directed friendship rows')
+
+        cur.execute('TRUNCATE friend_mutuals')
+        backfill_ms = timed(lambda: cur.execute(
+            """INSERT INTO friend_mutuals (user_id, candidate_id, mutual_count)
+               SELECT f1.user_id, f2.friend_id, COUNT(*)
+               FROM friendships f1 JOIN friendships f2 ON f2.user_id = f1.friend_id
+               WHERE f1.status = 'accepted' AND f2.status = 'accepted' AND f2.friend_id <> f1.user_id
+               GROUP BY f1.user_id, f2.friend_id"""
+        ))
+        cur.execute('ANALYZE')
+        conn.commit()
+        cur.execute('SELECT COUNT(*) FROM friend_mutuals')
+        print(f'Full backfill of {cur.fetchone()[0]} friend_mutuals rows: {backfill_ms:.0f}ms')
+
+        handler = load_handler('social')
+        sample_users = [rng.randint(1, args.users) for _ in range(args.samples)]
+
+        def suggestions(user_id: int) -> None:
+            result = handler({'httpMethod': 'GET', 'queryStringParameters': {'action': 'suggestions', 'user_id': str(user_id)}}, None)
+            assert result['statusCode'] == 200, result
+
+        def live(user_id: int) -> None:
+            cur.execute(LIVE_QUERY, (user_id,))
+            cur.fetchall()
+
+        for user_id in sample_users[:10]:
+            suggestions(user_id)
+        report('suggestions (precomputed)', [timed(lambda u=u: suggestions(u)) for u in sample_users])
+        report('live self-join', [timed(lambda u=u: live(u)) for u in sample_users])
+        conn.rollback()
+
+        pairs = set()
+        while len(pairs) < args.accepts:
+            a, b = rng.randint(1, args.users), rng.randint(1, args.users)
+            if a != b and (a, b) not in edges and (b, a) not in edges:
+                pairs.add((a, b))
+        request_ids = []
+        for a, b in pairs:
+            cur.execute(
+                "INSERT INTO friendships (user_id, friend_id, status) VALUES (%s, %s, 'pending') RETURNING id",
+                (a, b)
+            )
+            request_ids.append(cur.fetchone()[0])
+        conn.commit()
+
+        def accept(request_id: int) -> None:
+            body = json.dumps({'action': 'accept_request', 'request_id': request_id})
+            result = handler({'httpMethod': 'POST', 'body': body}, None)
+            assert result['statusCode'] == 200, result
+
+        report('accept_request (incremental)', [timed(lambda r=r: accept(r)) for r in request_ids])
+
+if __name__ == '__main__':
+    main()
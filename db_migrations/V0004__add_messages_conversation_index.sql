@@ -0,0 +1,5 @@
+-- Составной индекс по переписке: пара собеседников в упорядоченном виде и id сообщения.
+-- Покрывает обе стороны диалога одним диапазоном, поэтому страница истории
+-- по курсору before_id / after_id стоит одинаково при любой длине переписки
+CREATE INDEX IF NOT EXISTS idx_messages_conversation
+  ON messages (LEAST(sender_id, receiver_id), GREATEST(sender_id, receiver_id), id DESC);
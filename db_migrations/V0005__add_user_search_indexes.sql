@@ -0,0 +1,9 @@
+-- Триграммные индексы для поиска друзей: ILIKE '%q%' и нечёткое сравнение username % q
+-- идут по GIN вместо последовательного чтения всей таблицы users
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX IF NOT EXISTS idx_users_username_trgm ON users USING GIN (username gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_users_email_trgm ON users USING GIN (email gin_trgm_ops);
+
+-- Префиксный индекс для режима autocomplete: lower(username) LIKE 'q%'
+CREATE INDEX IF NOT EXISTS idx_users_username_prefix ON users (lower(username) text_pattern_ops);
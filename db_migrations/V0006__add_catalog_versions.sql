@@ -0,0 +1,10 @@
+-- Версии каталогов для ETag: админка увеличивает версию при каждом изменении,
+-- публичные ответы с совпавшим If-None-Match отдаются как 304 без чтения каталога
+CREATE TABLE IF NOT EXISTS catalog_versions (
+  name VARCHAR(50) PRIMARY KEY,
+  version BIGINT NOT NULL DEFAULT 1,
+  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+INSERT INTO catalog_versions (name, version) VALUES ('sounds', 1), ('courses', 1)
+ON CONFLICT (name) DO NOTHING;
@@ -0,0 +1,17 @@
+-- Журнал скачиваний: клик по звуку - дешёвая вставка без блокировки строки wb_sounds.
+-- Периодический flush сворачивает журнал в downloads_count одним UPDATE на пачку
+CREATE TABLE IF NOT EXISTS sound_download_events (
+  id BIGSERIAL PRIMARY KEY,
+  sound_id INTEGER NOT NULL,
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- История сворачиваний: размер пачки, задержка и интервал между flush
+CREATE TABLE IF NOT EXISTS sound_download_flushes (
+  id SERIAL PRIMARY KEY,
+  flushed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  events_count INTEGER NOT NULL,
+  sounds_count INTEGER NOT NULL,
+  max_lag_seconds DOUBLE PRECISION,
+  interval_seconds DOUBLE PRECISION
+);
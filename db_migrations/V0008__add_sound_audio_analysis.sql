@@ -0,0 +1,10 @@
+-- Результаты анализа аудио при загрузке: каталог рисует волну и длительность
+-- без скачивания mp3
+ALTER TABLE wb_sounds
+ADD COLUMN IF NOT EXISTS duration_seconds REAL,
+ADD COLUMN IF NOT EXISTS waveform_peaks JSONB,
+ADD COLUMN IF NOT EXISTS loudness_db REAL,
+ADD COLUMN IF NOT EXISTS analysis_status VARCHAR(20) DEFAULT 'pending';
+
+-- Воркер анализа находит звуки по URL загруженного файла
+CREATE INDEX IF NOT EXISTS idx_sounds_file_url ON wb_sounds(file_url);
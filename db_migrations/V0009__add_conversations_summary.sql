@@ -0,0 +1,39 @@
+-- Сводка диалогов: по строке на каждого участника пары с последним сообщением
+-- и числом непрочитанных. send_message и чтение переписки обновляют её
+-- инкрементально, поэтому список чатов - один запрос по индексу
+CREATE TABLE IF NOT EXISTS conversations (
+  user_id INTEGER NOT NULL REFERENCES users(id),
+  peer_id INTEGER NOT NULL REFERENCES users(id),
+  last_message_id INTEGER NOT NULL,
+  last_message_at TIMESTAMP NOT NULL,
+  last_sender_id INTEGER NOT NULL,
+  last_message_type VARCHAR(20),
+  last_message_preview VARCHAR(200),
+  unread_count INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY (user_id, peer_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_conversations_user_recent ON conversations(user_id, last_message_at DESC);
+
+-- Заполняем сводку из существующих сообщений
+INSERT INTO conversations
+  (user_id, peer_id, last_message_id, last_message_at, last_sender_id,
+   last_message_type, last_message_preview, unread_count)
+SELECT last.owner_id, last.peer_id, last.id, last.created_at, last.sender_id,
+       last.message_type, LEFT(last.content, 200), COALESCE(unread.n, 0)
+FROM (
+  SELECT DISTINCT ON (owner_id, peer_id) owner_id, peer_id, id, created_at, sender_id, message_type, content
+  FROM (
+    SELECT sender_id AS owner_id, receiver_id AS peer_id, id, created_at, sender_id, message_type, content FROM messages
+    UNION ALL
+    SELECT receiver_id AS owner_id, sender_id AS peer_id, id, created_at, sender_id, message_type, content FROM messages
+  ) both_sides
+  ORDER BY owner_id, peer_id, id DESC
+) last
+LEFT JOIN (
+  SELECT receiver_id, sender_id, COUNT(*) AS n
+  FROM messages
+  WHERE is_read = false
+  GROUP BY receiver_id, sender_id
+) unread ON unread.receiver_id = last.owner_id AND unread.sender_id = last.peer_id
+ON CONFLICT (user_id, peer_id) DO NOTHING;
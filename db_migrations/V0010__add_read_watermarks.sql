@@ -0,0 +1,22 @@
+-- Прочитанность переписки как водяной знак: id последнего прочитанного сообщения
+-- от собеседника. Сообщение прочитано, если его id <= last_read_message_id
+-- получателя; messages.is_read больше не обновляется
+ALTER TABLE conversations
+ADD COLUMN IF NOT EXISTS last_read_message_id INTEGER NOT NULL DEFAULT 0;
+
+-- Переносим существующие отметки is_read
+UPDATE conversations c
+SET last_read_message_id = r.max_read_id
+FROM (
+  SELECT receiver_id, sender_id, MAX(id) AS max_read_id
+  FROM messages
+  WHERE is_read = true
+  GROUP BY receiver_id, sender_id
+) r
+WHERE c.user_id = r.receiver_id AND c.peer_id = r.sender_id;
+
+UPDATE conversations c
+SET unread_count = (
+  SELECT COUNT(*) FROM messages m
+  WHERE m.receiver_id = c.user_id AND m.sender_id = c.peer_id AND m.id > c.last_read_message_id
+);
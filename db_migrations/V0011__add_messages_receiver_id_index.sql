@@ -0,0 +1,2 @@
+-- Дельта входящих сообщений для long-poll: receiver_id = ? AND id > курсор
+CREATE INDEX IF NOT EXISTS idx_messages_receiver_id ON messages(receiver_id, id);
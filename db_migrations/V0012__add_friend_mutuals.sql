@@ -0,0 +1,21 @@
+-- Предрасчитанное число общих друзей для «Возможно, вы знакомы».
+-- Строка (user_id, candidate_id) - сколько общих друзей у пары; обновляется
+-- инкрементально при принятии заявки, без самосоединений на каждый запрос
+CREATE TABLE IF NOT EXISTS friend_mutuals (
+  user_id INTEGER NOT NULL REFERENCES users(id),
+  candidate_id INTEGER NOT NULL REFERENCES users(id),
+  mutual_count INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY (user_id, candidate_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_friend_mutuals_rank ON friend_mutuals(user_id, mutual_count DESC);
+CREATE INDEX IF NOT EXISTS idx_users_workplace ON users(workplace);
+
+-- Заполняем по текущему графу дружбы
+INSERT INTO friend_mutuals (user_id, candidate_id, mutual_count)
+SELECT f1.user_id, f2.friend_id, COUNT(*)
+FROM friendships f1
+JOIN friendships f2 ON f2.user_id = f1.friend_id
+WHERE f1.status = 'accepted' AND f2.status = 'accepted' AND f2.friend_id <> f1.user_id
+GROUP BY f1.user_id, f2.friend_id
+ON CONFLICT (user_id, candidate_id) DO NOTHING;
@@ -0,0 +1,21 @@
+-- Полнотекстовый поиск по каталогу звуков: русская морфология, название
+-- весит больше описания. Колонка генерируется самой базой при каждой записи
+ALTER TABLE wb_sounds
+ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS (
+  setweight(to_tsvector('russian', coalesce(title, '')), 'A') ||
+  setweight(to_tsvector('russian', coalesce(description, '')), 'B')
+) STORED;
+
+CREATE INDEX IF NOT EXISTS idx_sounds_search ON wb_sounds USING GIN (search_vector);
+
+-- Ключи сортировки не должны быть NULL, иначе keyset-пагинация теряет строки
+UPDATE wb_sounds SET downloads_count = 0 WHERE downloads_count IS NULL;
+UPDATE wb_sounds SET created_at = CURRENT_TIMESTAMP WHERE created_at IS NULL;
+ALTER TABLE wb_sounds ALTER COLUMN downloads_count SET NOT NULL;
+ALTER TABLE wb_sounds ALTER COLUMN created_at SET NOT NULL;
+
+-- Страницы sort=popular и sort=new по всему каталогу и внутри категории
+CREATE INDEX IF NOT EXISTS idx_sounds_popular ON wb_sounds(downloads_count DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_sounds_new ON wb_sounds(created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_sounds_category_popular ON wb_sounds(category, downloads_count DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_sounds_category_new ON wb_sounds(category, created_at DESC, id DESC);
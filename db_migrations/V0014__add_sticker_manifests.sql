@@ -0,0 +1,59 @@
+-- Манифест стикер-пака (описание и список стикеров) хранится готовым JSON
+-- рядом с паком, а его хэш служит версией: ответ по ?v=<hash> неизменяем и
+-- кэшируется клиентом и CDN навсегда
+ALTER TABLE sticker_packs
+ADD COLUMN IF NOT EXISTS manifest JSONB,
+ADD COLUMN IF NOT EXISTS manifest_hash VARCHAR(32);
+
+-- Манифест пересобирается при создании пака, при смене его полей и когда
+-- триггер стикеров сбрасывает manifest в NULL
+CREATE OR REPLACE FUNCTION sticker_packs_build_manifest() RETURNS trigger AS $$
+BEGIN
+  IF TG_OP = 'INSERT' OR NEW.manifest IS NULL
+     OR (NEW.title, NEW.description, NEW.preview_url, NEW.price)
+        IS DISTINCT FROM (OLD.title, OLD.description, OLD.preview_url, OLD.price) THEN
+    NEW.manifest := jsonb_build_object(
+      'id', NEW.id,
+      'title', NEW.title,
+      'description', NEW.description,
+      'preview_url', NEW.preview_url,
+      'price', NEW.price,
+      'stickers', COALESCE((
+        SELECT jsonb_agg(jsonb_build_object('id', s.id, 'image_url', s.image_url, 'emoji_tag', s.emoji_tag) ORDER BY s.id)
+        FROM stickers s WHERE s.pack_id = NEW.id
+      ), '[]'::jsonb)
+    );
+    NEW.manifest_hash := md5(NEW.manifest::text);
+  END IF;
+  RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_sticker_packs_manifest ON sticker_packs;
+CREATE TRIGGER trg_sticker_packs_manifest
+BEFORE INSERT OR UPDATE ON sticker_packs
+FOR EACH ROW EXECUTE FUNCTION sticker_packs_build_manifest();
+
+CREATE OR REPLACE FUNCTION stickers_refresh_pack_manifest() RETURNS trigger AS $$
+BEGIN
+  IF TG_OP IN ('UPDATE', 'DELETE') THEN
+    UPDATE sticker_packs SET manifest = NULL WHERE id = OLD.pack_id;
+  END IF;
+  IF TG_OP = 'INSERT' OR (TG_OP = 'UPDATE' AND NEW.pack_id <> OLD.pack_id) THEN
+    UPDATE sticker_packs SET manifest = NULL WHERE id = NEW.pack_id;
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_stickers_manifest ON stickers;
+CREATE TRIGGER trg_stickers_manifest
+AFTER INSERT OR UPDATE OR DELETE ON stickers
+FOR EACH ROW EXECUTE FUNCTION stickers_refresh_pack_manifest();
+
+-- Счётчик покупок считается по sticker_purchases, а не инкрементом строки
+-- пака: иначе при наплыве покупок все покупатели пака ждали бы одну блокировку
+CREATE INDEX IF NOT EXISTS idx_purchases_pack ON sticker_purchases(pack_id);
+
+-- Собираем манифесты существующих паков
+UPDATE sticker_packs SET manifest = NULL;
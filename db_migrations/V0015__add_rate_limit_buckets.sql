@@ -0,0 +1,39 @@
+-- Общие для всех контейнеров token bucket'ы ограничения частоты запросов.
+-- Ключ - имя лимита и идентификатор клиента (пользователь, email, IP)
+CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+  bucket VARCHAR(255) PRIMARY KEY,
+  tokens DOUBLE PRECISION NOT NULL,
+  updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Давно не тронутые bucket'ы полны и удаляются пачками
+CREATE INDEX IF NOT EXISTS idx_rate_limit_buckets_updated ON rate_limit_buckets(updated_at);
+
+-- Пополняет bucket по прошедшему времени и, если хватает, списывает p_cost.
+-- Строка блокируется, поэтому параллельные вызовы с разных контейнеров
+-- списывают токены по очереди и не превышают лимит
+CREATE OR REPLACE FUNCTION rate_limit_take(p_bucket TEXT, p_capacity DOUBLE PRECISION, p_rate DOUBLE PRECISION, p_cost DOUBLE PRECISION DEFAULT 1)
+RETURNS TABLE (allowed BOOLEAN, remaining DOUBLE PRECISION, retry_after DOUBLE PRECISION) AS $$
+DECLARE
+  now_ts TIMESTAMP := clock_timestamp();
+  available DOUBLE PRECISION;
+BEGIN
+  INSERT INTO rate_limit_buckets (bucket, tokens, updated_at) VALUES (p_bucket, p_capacity, now_ts)
+  ON CONFLICT (bucket) DO NOTHING;
+
+  SELECT LEAST(p_capacity, b.tokens + GREATEST(EXTRACT(EPOCH FROM now_ts - b.updated_at), 0) * p_rate)
+  INTO available
+  FROM rate_limit_buckets b WHERE b.bucket = p_bucket
+  FOR UPDATE;
+
+  allowed := available >= p_cost;
+  IF allowed THEN
+    available := available - p_cost;
+  END IF;
+  UPDATE rate_limit_buckets b SET tokens = available, updated_at = now_ts WHERE b.bucket = p_bucket;
+
+  remaining := available;
+  retry_after := CASE WHEN allowed THEN 0 ELSE (p_cost - available) / p_rate END;
+  RETURN NEXT;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,12 @@
+-- Ответы на повторяемые записи (send_message, send_request, accept_request)
+-- по заголовку Idempotency-Key. Ключ и отпечаток запроса хранятся как md5 в
+-- uuid - по 16 байт; строки старше суток удаляются пачками
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+  id UUID PRIMARY KEY,
+  request_hash UUID NOT NULL,
+  status_code SMALLINT NOT NULL DEFAULT 0,
+  response TEXT,
+  created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created ON idempotency_keys(created_at);
@@ -0,0 +1,113 @@
+-- Сообщения разбиваются на помесячные партиции по created_at: индексы и
+-- vacuum каждой партиции покрывают только свой месяц, запросы переписки
+-- отсекают старые месяцы, а вышедшие за срок хранения отцепляются в архив
+ALTER TABLE messages RENAME TO messages_unpartitioned;
+ALTER TABLE messages_unpartitioned RENAME CONSTRAINT messages_pkey TO messages_unpartitioned_pkey;
+ALTER SEQUENCE messages_id_seq OWNED BY NONE;
+
+CREATE TABLE messages (
+  id INTEGER NOT NULL DEFAULT nextval('messages_id_seq'),
+  sender_id INTEGER NOT NULL REFERENCES users(id),
+  receiver_id INTEGER NOT NULL REFERENCES users(id),
+  message_type VARCHAR(20) DEFAULT 'text',
+  content TEXT,
+  media_url TEXT,
+  sticker_id INTEGER,
+  is_read BOOLEAN DEFAULT false,
+  created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+-- Страховка на случай, если обслуживание не успело создать месяц заранее:
+-- такие строки переносятся в свою партицию при её создании
+CREATE TABLE IF NOT EXISTS messages_default PARTITION OF messages DEFAULT;
+
+-- Партиция messages_YYYY_MM для месяца p_month; NULL, если она уже есть
+CREATE OR REPLACE FUNCTION messages_ensure_partition(p_month DATE) RETURNS TEXT AS $$
+DECLARE
+  part TEXT := 'messages_' || to_char(p_month, 'YYYY_MM');
+  from_ts TIMESTAMP := date_trunc('month', p_month);
+  to_ts TIMESTAMP := date_trunc('month', p_month) + interval '1 month';
+BEGIN
+  IF to_regclass(part) IS NOT NULL THEN
+    RETURN NULL;
+  END IF;
+  EXECUTE format('CREATE TABLE %I (LIKE messages INCLUDING DEFAULTS)', part);
+  EXECUTE format(
+    'WITH moved AS (DELETE FROM messages_default WHERE created_at >= %L AND created_at < %L RETURNING *)
+     INSERT INTO %I SELECT * FROM moved', from_ts, to_ts, part);
+  -- С CHECK по диапазону ATTACH не сканирует партицию заново
+  EXECUTE format('ALTER TABLE %I ADD CONSTRAINT %I CHECK (created_at >= %L AND created_at < %L)',
+                 part, part || '_range', from_ts, to_ts);
+  EXECUTE format('ALTER TABLE messages ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)', part, from_ts, to_ts);
+  EXECUTE format('ALTER TABLE %I DROP CONSTRAINT %I', part, part || '_range');
+  RETURN part;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Обслуживание: партиции на p_months_ahead месяцев вперёд и, если
+-- p_retention_months > 0, отцепление месяцев старше срока хранения. Отцеплённая
+-- партиция остаётся таблицей messages_archive_YYYY_MM и при нужде
+-- подключается обратно через ATTACH PARTITION
+CREATE OR REPLACE FUNCTION messages_maintain(p_months_ahead INTEGER, p_retention_months INTEGER)
+RETURNS TABLE (action TEXT, partition_name TEXT) AS $$
+DECLARE
+  month_start DATE;
+  part TEXT;
+  cutoff DATE := date_trunc('month', LOCALTIMESTAMP) - make_interval(months => p_retention_months);
+BEGIN
+  FOR month_start IN
+    SELECT generate_series(date_trunc('month', LOCALTIMESTAMP),
+                           date_trunc('month', LOCALTIMESTAMP) + make_interval(months => p_months_ahead),
+                           interval '1 month')::date
+  LOOP
+    part := messages_ensure_partition(month_start);
+    IF part IS NOT NULL THEN
+      action := 'created';
+      partition_name := part;
+      RETURN NEXT;
+    END IF;
+  END LOOP;
+
+  IF p_retention_months > 0 THEN
+    FOR part IN
+      SELECT c.relname FROM pg_inherits i
+      JOIN pg_class c ON c.oid = i.inhrelid
+      WHERE i.inhparent = 'messages'::regclass
+        AND c.relname ~ '^messages_\d{4}_\d{2}$'
+        AND to_date(substring(c.relname FROM '(\d{4}_\d{2})$'), 'YYYY_MM') < cutoff
+      ORDER BY c.relname
+    LOOP
+      EXECUTE format('ALTER TABLE messages DETACH PARTITION %I', part);
+      EXECUTE format('ALTER TABLE %I RENAME TO %I', part, replace(part, 'messages_', 'messages_archive_'));
+      action := 'archived';
+      partition_name := replace(part, 'messages_', 'messages_archive_');
+      RETURN NEXT;
+    END LOOP;
+  END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Месяцы существующей истории и три месяца вперёд
+SELECT messages_ensure_partition(m.month_start::date)
+FROM generate_series(
+  date_trunc('month', LEAST(COALESCE((SELECT MIN(created_at) FROM messages_unpartitioned), LOCALTIMESTAMP), LOCALTIMESTAMP)),
+  date_trunc('month', LOCALTIMESTAMP) + interval '3 months',
+  interval '1 month'
+) AS m(month_start);
+
+INSERT INTO messages (id, sender_id, receiver_id, message_type, content, media_url, sticker_id, is_read, created_at)
+SELECT id, sender_id, receiver_id, message_type, content, media_url, sticker_id, is_read, COALESCE(created_at, LOCALTIMESTAMP)
+FROM messages_unpartitioned;
+
+DROP TABLE messages_unpartitioned;
+ALTER SEQUENCE messages_id_seq OWNED BY messages.id;
+
+-- Индексы строятся после переноса данных и создаются в каждой партиции.
+-- Одиночные индексы по receiver_id и created_at больше не нужны: первый
+-- покрывает (receiver_id, id), второй заменяет отсечение партиций; по
+-- sender_id индекс остаётся для проверок внешнего ключа при удалении users
+CREATE INDEX IF NOT EXISTS idx_messages_conversation
+  ON messages (LEAST(sender_id, receiver_id), GREATEST(sender_id, receiver_id), id DESC);
+CREATE INDEX IF NOT EXISTS idx_messages_receiver_id ON messages(receiver_id, id);
+CREATE INDEX IF NOT EXISTS idx_messages_sender ON messages(sender_id);
@@ -0,0 +1,20 @@
+-- Результаты анализа по файлу, а не по звуку: upload анализирует файл, когда
+-- звука с ним обычно ещё нет, а админка при создании звука берёт результат
+-- отсюда. Хранилище контейнера для этого не годится - у каждого оно своё
+CREATE TABLE IF NOT EXISTS sound_file_analysis (
+  file_url VARCHAR(500) PRIMARY KEY,
+  status VARCHAR(20) NOT NULL,
+  duration_seconds REAL,
+  waveform_peaks JSONB,
+  loudness_db REAL,
+  error TEXT,
+  analyzed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Уже проанализированные звуки переносят свой результат на файл
+INSERT INTO sound_file_analysis (file_url, status, duration_seconds, waveform_peaks, loudness_db)
+SELECT DISTINCT ON (file_url) file_url, analysis_status, duration_seconds, waveform_peaks, loudness_db
+FROM wb_sounds
+WHERE analysis_status IN ('done', 'failed') AND file_url IS NOT NULL
+ORDER BY file_url, id DESC
+ON CONFLICT (file_url) DO NOTHING;
@@ -0,0 +1,5 @@
+-- Заполнение из V0012 не отсеивало пары, которые уже дружат, и такие
+-- кандидаты вытесняли из пула подсказок настоящих незнакомцев
+DELETE FROM friend_mutuals m
+USING friendships f
+WHERE f.user_id = m.user_id AND f.friend_id = m.candidate_id AND f.status = 'accepted';